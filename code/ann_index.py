@@ -0,0 +1,245 @@
+import math
+import torch
+
+
+def squared_norms(embeddings: torch.Tensor):
+    return (embeddings * embeddings).sum(dim=1)
+
+
+def pairwise_distances(queries: torch.Tensor, embeddings: torch.Tensor, norms: torch.Tensor = None):
+    """
+    The euclidean distance between every query and every embedding, as a (q, n) tensor.
+    :param norms: The squared norms of the embeddings, if they are known. Otherwise torch.cdist computes them.
+    """
+    if norms is None:
+        return torch.cdist(queries, embeddings, p=2)
+    distances = torch.addmm(norms.unsqueeze(0), queries, embeddings.T, alpha=-2)
+    distances += squared_norms(queries).unsqueeze(1)
+    return distances.clamp_(min=0).sqrt_()
+
+
+def exact_search(queries: torch.Tensor, embeddings: torch.Tensor, k: int = 1, chunk_size: int = 65536,
+                 squared_norms: torch.Tensor = None):
+    """
+    Find the k nearest embeddings of every query by brute force.
+    The gallery is searched in chunks, so the full distance matrix is never materialized.
+    :param queries: A (q, d) tensor.
+    :param embeddings: A (n, d) tensor on the same device as queries.
+    :param k: How many neighbours to return.
+    :param chunk_size: How many gallery rows to compare at once.
+    :param squared_norms: The (n,) squared norms of the embeddings, so that they are not computed for every search.
+    :return: (distances, indices), two (q, k) tensors sorted by distance. If the gallery has fewer than k rows, the
+             missing neighbours have distance inf and index -1.
+    """
+    best_distances = torch.full((len(queries), k), math.inf, device=queries.device)
+    best_indices = torch.full((len(queries), k), -1, dtype=torch.long, device=queries.device)
+    for start in range(0, len(embeddings), chunk_size):
+        distances = pairwise_distances(queries, embeddings[start:start + chunk_size],
+                                       None if squared_norms is None else squared_norms[start:start + chunk_size])
+        chunk_k = min(k, distances.shape[1])
+        distances, indices = torch.topk(distances, chunk_k, dim=1, largest=False)
+        best_distances, order = torch.topk(torch.cat([best_distances, distances], dim=1), k, dim=1, largest=False)
+        best_indices = torch.gather(torch.cat([best_indices, indices + start], dim=1), 1, order)
+    return best_distances, best_indices
+
+
+def class_search(queries: torch.Tensor, embeddings: torch.Tensor, owners: torch.Tensor, n_classes: int, k: int = 1,
+                 chunk_size: int = 65536, squared_norms: torch.Tensor = None):
+    """
+    Find the k nearest classes of every query when classes have several embeddings. The distance to a class is the
+    distance to its nearest embedding, and every class is returned at most once.
+    :param queries: A (q, d) tensor.
+    :param embeddings: A (n, d) tensor on the same device as queries.
+    :param owners: The (n,) class of every embedding, on the same device as queries.
+    :param n_classes: The number of classes.
+    :param k: How many classes to return.
+    :param chunk_size: How many embeddings to compare at once.
+    :param squared_norms: See exact_search.
+    :return: (distances, indices) like exact_search, where indices are classes.
+    """
+    nearest = torch.full((len(queries), n_classes), math.inf, device=queries.device)
+    for start in range(0, len(embeddings), chunk_size):
+        distances = pairwise_distances(queries, embeddings[start:start + chunk_size],
+                                       None if squared_norms is None else squared_norms[start:start + chunk_size])
+        chunk_owners = owners[start:start + chunk_size].unsqueeze(0).expand(len(queries), -1)
+        nearest.scatter_reduce_(1, chunk_owners, distances, reduce='amin')
+
+    distances, indices = torch.topk(nearest, min(k, n_classes), dim=1, largest=False)
+    if k > n_classes:
+        distances = torch.cat([distances, distances.new_full((len(queries), k - n_classes), math.inf)], dim=1)
+        indices = torch.cat([indices, indices.new_full((len(queries), k - n_classes), -1)], dim=1)
+    return distances, indices
+
+
+def kmeans(embeddings: torch.Tensor, n_clusters: int, iterations: int = 20, seed: int = 0,
+           chunk_size: int = 65536):
+    """
+    Cluster the embeddings with Lloyd's algorithm.
+    :return: (centroids, assignments), a (n_clusters, d) tensor and the cluster of every embedding.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    n = len(embeddings)
+    centroids = embeddings[torch.randperm(n, generator=generator)[:n_clusters].to(embeddings.device)].clone()
+    assignments = torch.zeros(n, dtype=torch.long, device=embeddings.device)
+
+    for _ in range(iterations):
+        for start in range(0, n, chunk_size):
+            chunk = embeddings[start:start + chunk_size]
+            assignments[start:start + chunk_size] = torch.cdist(chunk, centroids).argmin(dim=1)
+
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, embeddings)
+        counts = torch.bincount(assignments, minlength=n_clusters)
+        empty = counts == 0
+        centroids = sums / counts.clamp(min=1).unsqueeze(1).to(sums.dtype)
+        if empty.any():
+            # restart empty clusters from random embeddings
+            refill = torch.randint(n, (int(empty.sum()),), generator=generator).to(embeddings.device)
+            centroids[empty] = embeddings[refill]
+
+    return centroids, assignments
+
+
+class IVFIndex:
+    """
+    An inverted file index. The gallery is clustered with k-means, and a query is only compared with the embeddings
+    of the n_probe clusters whose centroids are nearest to it.
+    The index stores cluster assignments, not embeddings, so the gallery has to be passed to every search.
+    """
+
+    def __init__(self, n_lists: int = None, n_probe: int = 8, iterations: int = 20, seed: int = 0):
+        """
+        :param n_lists: The number of clusters. By default 4 * sqrt(n) for a gallery of n embeddings.
+        :param n_probe: How many clusters are searched for every query. More is slower but more accurate.
+        :param iterations: The number of k-means iterations.
+        :param seed: The random seed of k-means.
+        """
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids = None
+        self.assignments = None
+        self._order = None
+        self._offsets = None
+        self._device_lists = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_order'] = None
+        state['_offsets'] = None
+        state['_device_lists'] = {}
+        return state
+
+    def __setstate__(self, state):
+        # indexes pickled before the lists were kept for every device
+        state.setdefault('_device_lists', {})
+        self.__dict__.update(state)
+
+    def is_built(self):
+        return self.centroids is not None
+
+    def build(self, embeddings: torch.Tensor):
+        embeddings = embeddings.detach().float().cpu()
+        n_lists = self.n_lists or max(1, int(4 * math.sqrt(len(embeddings))))
+        n_lists = min(n_lists, len(embeddings))
+        self.centroids, self.assignments = kmeans(embeddings, n_lists, self.iterations, self.seed)
+        self._order = None
+        self._device_lists = {}
+        return self
+
+    def set_row(self, row: int, embedding: torch.Tensor):
+        """
+        Assign a gallery row which was changed, or appended if row is the size of the gallery, to its nearest cluster.
+        The clusters themselves are not moved. Rebuild the index after many changes.
+        """
+        cluster = torch.cdist(embedding.detach().float().cpu().view(1, -1), self.centroids).argmin()
+        if row == len(self.assignments):
+            self.assignments = torch.cat([self.assignments, cluster.view(1)])
+        else:
+            self.assignments[row] = cluster
+        self._order = None
+        self._device_lists = {}
+
+    def remove_row(self, row: int):
+        """
+        Forget a gallery row which was removed. The rows after it move one place up, as in the gallery.
+        """
+        self.assignments = torch.cat([self.assignments[:row], self.assignments[row + 1:]])
+        self._order = None
+        self._device_lists = {}
+
+    def _lists(self):
+        """
+        The gallery rows sorted by cluster, and where every cluster starts in that order.
+        """
+        if self._order is None:
+            self._order = torch.argsort(self.assignments, stable=True)
+            counts = torch.bincount(self.assignments, minlength=len(self.centroids))
+            self._offsets = torch.cat([torch.zeros(1, dtype=torch.long), torch.cumsum(counts, dim=0)])
+        return self._order, self._offsets
+
+    def device_lists(self, device=torch.device('cpu')):
+        """
+        The centroids as float32, the rows sorted by cluster and where every cluster starts, on device. They are made
+        once for every device and kept until the index changes, like Memory.device_rows, so searches copy nothing to
+        the device.
+        :return: (centroids, order, offsets)
+        """
+        order, offsets = self._lists()
+        if device not in self._device_lists:
+            self._device_lists[device] = (self.centroids.to(device=device, dtype=torch.float32).contiguous(),
+                                          order.to(device), offsets.to(device))
+        return self._device_lists[device]
+
+    def search(self, queries: torch.Tensor, embeddings: torch.Tensor, k: int = 1, n_probe: int = None,
+               squared_norms: torch.Tensor = None, chunk_size: int = 65536):
+        """
+        Find about the k nearest embeddings of every query.
+        The candidates of every query, the rows of its n_probe clusters, are gathered into one padded (q, c) tensor,
+        and the queries are compared with their candidates together, as many queries at a time as make about
+        chunk_size candidates.
+        :param queries: A (q, d) tensor.
+        :param embeddings: The gallery the index was built on, on the same device as queries.
+        :param k: How many neighbours to return.
+        :param n_probe: Overrides the n_probe of the index.
+        :param squared_norms: See exact_search.
+        :param chunk_size: About how many candidates to compare at once.
+        :return: (distances, indices) like exact_search.
+        """
+        if not self.is_built():
+            raise Exception('Index is not built.')
+
+        device = queries.device
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        centroids, order, offsets = self.device_lists(device)
+        probes = torch.topk(torch.cdist(queries, centroids), n_probe, dim=1, largest=False).indices
+
+        # every (query, probed cluster) pair gives the range offsets[cluster]:offsets[cluster + 1] of order
+        sizes = (offsets[1:] - offsets[:-1])[probes].flatten()
+        totals = sizes.view(len(queries), n_probe).sum(dim=1)
+        width = max(int(totals.max()), 1) if len(queries) else 1
+        pairs = torch.repeat_interleave(torch.arange(len(sizes), device=device), sizes)
+        pair_starts = torch.cumsum(sizes, dim=0) - sizes
+        positions = torch.arange(len(pairs), device=device)
+        query_rows = pairs // n_probe
+        query_starts = torch.cumsum(totals, dim=0) - totals
+        candidates = torch.full((len(queries), width), -1, dtype=torch.long, device=device)
+        candidates[query_rows, positions - query_starts[query_rows]] = \
+            order[offsets[probes.flatten()][pairs] + positions - pair_starts[pairs]]
+
+        distances = torch.full((len(queries), k), math.inf, device=device)
+        indices = torch.full((len(queries), k), -1, dtype=torch.long, device=device)
+        step = max(1, chunk_size // width)
+        for start in range(0, len(queries), step):
+            chunk = candidates[start:start + step]
+            rows = embeddings[chunk.clamp(min=0)]
+            chunk_queries = queries[start:start + step]
+            norms = squared_norms[chunk.clamp(min=0)] if squared_norms is not None else (rows * rows).sum(dim=2)
+            found_distances = torch.baddbmm(norms.unsqueeze(2), rows, chunk_queries.unsqueeze(2), alpha=-2).squeeze(2)
+            found_distances += (chunk_queries * chunk_queries).sum(dim=1, keepdim=True)
+            found_distances = found_distances.clamp_(min=0).sqrt_().masked_fill_(chunk < 0, math.inf)
+            found_distances, found = torch.topk(found_distances, min(k, width), dim=1, largest=False)
+            found = torch.gather(chunk, 1, found).masked_fill_(torch.isinf(found_distances), -1)
+            distances[start:start + step, :found.shape[1]] = found_distances
+            indices[start:start + step, :found.shape[1]] = found
+        return distances, indices
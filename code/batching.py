@@ -0,0 +1,154 @@
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from memory import Memory
+from process import percentile
+from face_recognition import batch_face_recognition
+
+
+class BatchStats:
+    """
+    Counters of a MicroBatcher. Latencies are measured from submitting an image to getting its result, and only the
+    most recent ones are kept for the percentiles.
+    """
+
+    def __init__(self, window: int = 10000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.start_time = time.perf_counter()
+        self.requests = 0
+        self.batches = 0
+        self.faces = 0
+        self.busy_time = 0.0
+
+    def record_batch(self, latencies, faces, busy_time):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.requests += len(latencies)
+            self.batches += 1
+            self.faces += faces
+            self.busy_time += busy_time
+
+    def reset(self):
+        with self.lock:
+            self.latencies.clear()
+            self.start_time = time.perf_counter()
+            self.requests = 0
+            self.batches = 0
+            self.faces = 0
+            self.busy_time = 0.0
+
+    def snapshot(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            elapsed = time.perf_counter() - self.start_time
+            return {
+                'requests': self.requests,
+                'batches': self.batches,
+                'faces': self.faces,
+                'mean_batch_size': self.requests / self.batches if self.batches else 0.0,
+                'throughput': self.requests / elapsed if elapsed > 0 else 0.0,
+                'utilization': self.busy_time / elapsed if elapsed > 0 else 0.0,
+                'latency_p50': percentile(latencies, 50),
+                'latency_p99': percentile(latencies, 99),
+            }
+
+
+class MicroBatcher:
+    """
+    A request queue in front of batch_face_recognition.
+    Images submitted by concurrent callers are collected until max_batch_size images are waiting or the first of
+    them has waited max_wait seconds. Then the whole batch is recognized at once and each caller gets its own result.
+    """
+
+    def __init__(self, memory: Memory, device, mtcnn, resnet, max_batch_size: int = 16, max_wait: float = 0.01,
+                 model_lock: threading.Lock = None):
+        """
+        :param memory: The memory of the program.
+        :param device: The device to use.
+        :param mtcnn: The mtcnn model.
+        :param resnet: The resnet model.
+        :param max_batch_size: The most images recognized in one batch.
+        :param max_wait: The longest time in seconds a request waits for other requests to join its batch.
+        :param model_lock: The lock to hold while the models are used. Needed if the models are also used elsewhere.
+        """
+        if max_batch_size < 1:
+            raise Exception('max_batch_size must be at least 1.')
+
+        self.memory = memory
+        self.device = device
+        self.mtcnn = mtcnn
+        self.resnet = resnet
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.model_lock = model_lock or threading.Lock()
+        self.stats = BatchStats()
+
+        self.requests = queue.Queue()
+        self.closed = False
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, image, multi_face: bool = False, threshold: float = 0.85) -> Future:
+        """
+        Queue an image for recognition.
+        :return: A Future whose result is the same as the result of face_recognition for the image.
+        """
+        if self.closed:
+            raise Exception('MicroBatcher is closed.')
+        future = Future()
+        self.requests.put((image, multi_face, threshold, future, time.perf_counter()))
+        return future
+
+    def recognize(self, image, multi_face: bool = False, threshold: float = 0.85):
+        return self.submit(image, multi_face, threshold).result()
+
+    def close(self):
+        self.closed = True
+        self.requests.put(None)
+        self.worker.join()
+
+    def _collect(self):
+        first = self.requests.get()
+        if first is None:
+            return None
+
+        batch = [first]
+        deadline = first[4] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # let the loop see the sentinel after this batch
+                self.requests.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+
+            images, multi_faces, thresholds, futures, submitted = zip(*batch)
+            start = time.perf_counter()
+            try:
+                with self.model_lock:
+                    results = batch_face_recognition(self.memory, self.device, self.mtcnn, self.resnet,
+                                                     list(images), list(multi_faces), list(thresholds))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            end = time.perf_counter()
+            for future, result in zip(futures, results):
+                future.set_result(result)
+            self.stats.record_batch([end - t for t in submitted], sum(len(r) for r in results), end - start)
@@ -0,0 +1,928 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from process import current_folder, percentile
+from server_client import server_available, forward
+
+MAIN_PATH = os.path.join(current_folder(), 'main.py')
+SUITE_CASES = ('init', 'rec', 'rec_all_same_size', 'rec_all_mixed')
+
+
+def report(title, latencies):
+    print(f"{title}: n={len(latencies)} mean={sum(latencies) / len(latencies) * 1000:.1f}ms "
+          f"p50={percentile(latencies, 50) * 1000:.1f}ms p99={percentile(latencies, 99) * 1000:.1f}ms")
+
+
+def time_command(command):
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def bench_server(image, runs=5, port=8799, cpu=False):
+    """
+    Compare cold `rec` calls, which load the models and the memory every time, with calls to a warm server.
+    :param image: The image to recognize.
+    :param runs: How many times to run every mode.
+    :param port: The port for the temporary server.
+    :param cpu: Whether to use CPU.
+    """
+    image = os.path.abspath(image)
+    device_args = ['-c'] if cpu else []
+    address = f'127.0.0.1:{port}'
+
+    cold = [time_command([sys.executable, MAIN_PATH, 'rec', image, '-ns'] + device_args) for _ in range(runs)]
+    report("cold cli", cold)
+
+    server = subprocess.Popen([sys.executable, MAIN_PATH, 'serve', '-p', str(port)] + device_args,
+                              stdout=subprocess.DEVNULL)
+    try:
+        start = time.perf_counter()
+        while not server_available('127.0.0.1', port):
+            if server.poll() is not None:
+                raise Exception("The server exited before it was ready.")
+            time.sleep(0.1)
+        print(f"server ready after {time.perf_counter() - start:.2f}s")
+
+        cli = [time_command([sys.executable, MAIN_PATH, 'rec', image, '-sv', address]) for _ in range(runs)]
+        report("warm cli (forwarded)", cli)
+
+        warm = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            forward('rec', {'filepath': image}, '127.0.0.1', port)
+            warm.append(time.perf_counter() - start)
+        report("warm request", warm)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def bench_startup(runs=5, cases=None):
+    """
+    The time from starting main.py to its exit, for commands which end quickly, and whether they import torch.
+    Importing torch takes seconds, so only the commands running the models should import it.
+    :param runs: How many times to run every command.
+    :param cases: The commands to time, as lists of arguments. By default the help of every command and a resize.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        if cases is None:
+            make_image_dir(os.path.join(directory, 'input'), images=4)
+            cases = [['--help'], ['resize', '--help'], ['init', '--help'], ['rec', '--help'], ['rec_all', '--help'],
+                     ['serve', '--help'],
+                     ['resize', '64', '64', os.path.join(directory, 'input'), os.path.join(directory, 'output'),
+                      '-f', '-w', '1']]
+
+        for case in cases:
+            command = [sys.executable, MAIN_PATH] + case
+            latencies = [time_command(command) for _ in range(runs)]
+            # -X importtime reports every module imported on stderr
+            imports = subprocess.run([sys.executable, '-X', 'importtime', MAIN_PATH] + case, check=True,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+            torch_imported = any(line.rstrip().endswith('| torch') for line in imports.splitlines())
+            name = ' '.join(os.path.basename(arg) if os.path.isabs(arg) else arg for arg in case)
+            report(f"{name} ({'imports' if torch_imported else 'no'} torch)", latencies)
+
+
+def bench_batching(memory, device, mtcnn, resnet, images, requests=64, clients=8, max_batch_size=16, max_wait=0.01):
+    """
+    Send requests from concurrent clients through a MicroBatcher and print its counters.
+    :param memory: The memory of the program.
+    :param device: The device to use.
+    :param mtcnn: The mtcnn model.
+    :param resnet: The resnet model.
+    :param images: The PIL Images to recognize, used in turn.
+    :param requests: How many requests to send.
+    :param clients: How many clients send requests at the same time.
+    :param max_batch_size: The most images recognized in one batch.
+    :param max_wait: The longest time in seconds a request waits for other requests to join its batch.
+    """
+    from batching import MicroBatcher
+
+    batcher = MicroBatcher(memory, device, mtcnn, resnet, max_batch_size, max_wait)
+    try:
+        # warm up, so that the first batch does not count
+        batcher.recognize(images[0])
+        batcher.stats.reset()
+        with ThreadPoolExecutor(clients) as executor:
+            list(executor.map(batcher.recognize, (images[i % len(images)] for i in range(requests))))
+        stats = batcher.stats.snapshot()
+    finally:
+        batcher.close()
+
+    print(f"max_batch_size={max_batch_size} max_wait={max_wait * 1000:.1f}ms clients={clients}: "
+          f"{stats['throughput']:.1f} images/s, mean batch {stats['mean_batch_size']:.1f}, "
+          f"p50={stats['latency_p50'] * 1000:.1f}ms p99={stats['latency_p99'] * 1000:.1f}ms")
+    return stats
+
+
+def synthetic_gallery(persons, queries, dim=512, noise=0.6, seed=0):
+    """
+    Random unit embeddings for a gallery, and queries which are noisy copies of random gallery embeddings,
+    like new photos of known persons.
+    :return: (gallery, queries, labels), where labels are the gallery rows the queries were made from.
+    """
+    import torch
+
+    generator = torch.Generator().manual_seed(seed)
+    gallery = torch.nn.functional.normalize(torch.randn(persons, dim, generator=generator), dim=1)
+    labels = torch.randint(persons, (queries,), generator=generator)
+    noisy = gallery[labels] + noise * torch.randn(queries, dim, generator=generator) / dim ** 0.5
+    return gallery, torch.nn.functional.normalize(noisy, dim=1), labels
+
+
+def bench_ann(persons=100000, queries=200, n_lists=None, n_probes=(1, 4, 8, 16), k=1):
+    """
+    Compare the recall and the latency of the IVF index with exact search on a synthetic gallery.
+    """
+    from ann_index import IVFIndex, exact_search
+
+    gallery, query_embeddings, _ = synthetic_gallery(persons, queries)
+
+    exact = []
+    truth = []
+    for query in query_embeddings:
+        start = time.perf_counter()
+        truth.append(exact_search(query.unsqueeze(0), gallery, k)[1])
+        exact.append(time.perf_counter() - start)
+    report(f"exact, {persons} persons", exact)
+
+    start = time.perf_counter()
+    index = IVFIndex(n_lists).build(gallery)
+    print(f"index with {len(index.centroids)} lists built in {time.perf_counter() - start:.2f}s")
+
+    for n_probe in n_probes:
+        latencies = []
+        hits = 0
+        for query, expected in zip(query_embeddings, truth):
+            start = time.perf_counter()
+            found = index.search(query.unsqueeze(0), gallery, k, n_probe)[1]
+            latencies.append(time.perf_counter() - start)
+            hits += len(set(found[0].tolist()) & set(expected[0].tolist()))
+        report(f"ivf n_probe={n_probe}, recall@{k}={hits / (k * queries):.3f}", latencies)
+
+
+def synthetic_identities(persons, samples, queries, dim=512, looks=4, spread=2.0, noise=0.6, seed=0):
+    """
+    Random identities with several looks each, such as with and without glasses, and noisy samples and queries of
+    random looks, like enrollment pictures and new photos taken in varied conditions.
+    :return: (samples, sample_labels, queries, labels), with the identity of every sample and every query.
+    """
+    import torch
+
+    generator = torch.Generator().manual_seed(seed)
+    centers = torch.randn(persons, 1, dim, generator=generator)
+    looks = torch.nn.functional.normalize(centers + spread * torch.randn(persons, looks, dim, generator=generator),
+                                          dim=2)
+
+    def draw(n):
+        labels = torch.randint(persons, (n,), generator=generator)
+        chosen = looks[labels, torch.randint(looks.shape[1], (n,), generator=generator)]
+        return torch.nn.functional.normalize(chosen + noise * torch.randn(n, dim, generator=generator) / dim ** 0.5,
+                                             dim=1), labels
+
+    sample_embeddings, sample_labels = draw(samples)
+    query_embeddings, labels = draw(queries)
+    return sample_embeddings, sample_labels, query_embeddings, labels
+
+
+def bench_prototypes(persons=10000, samples_per_person=8, queries=1000, max_prototypes=(0, 2, 4, 8), batch_size=32):
+    """
+    Compare the accuracy and the search latency of matching the mean embedding of every person with matching several
+    prototypes, on synthetic identities with several looks.
+    """
+    import torch
+    from memory import Memory
+
+    samples, sample_labels, query_embeddings, labels = synthetic_identities(persons, persons * samples_per_person,
+                                                                             queries)
+    sums = torch.zeros(persons, samples.shape[1]).index_add_(0, sample_labels, samples)
+    counts = torch.bincount(sample_labels, minlength=persons)
+    # identities without samples cannot be recognized by any setting
+    enrolled = counts[labels] > 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        Memory.MEMORY_PATH = os.path.join(directory, 'faces_memory.fgal')
+        for prototypes in max_prototypes:
+            memory = Memory()
+            start = time.perf_counter()
+            memory.initialize_sums({f'person_{i}': i for i in range(persons)}, sums, counts.clamp(min=1),
+                                   torch.device('cpu'), prototypes, samples, sample_labels)
+            built = time.perf_counter() - start
+
+            latencies = []
+            found = []
+            for batch in query_embeddings.split(batch_size):
+                start = time.perf_counter()
+                found.append(memory.search(batch)[1][:, 0])
+                memory.get_names(found[-1])
+                latencies.append(time.perf_counter() - start)
+            accuracy = (torch.cat(found) == labels)[enrolled].float().mean().item()
+            rows = persons if memory.prototypes is None else len(memory.prototypes)
+            report(f"max_prototypes={prototypes}: {rows} rows built in {built:.2f}s, top-1 accuracy {accuracy:.3f}, "
+                   f"batches of {batch_size}", latencies)
+
+
+def bench_shards(persons=500000, workers=(1, 2, 4, 8), batch_size=32, runs=20):
+    """
+    Compare searching a synthetic memory in this process with searching it in 1 to n worker processes.
+    """
+    import torch
+    from memory import Memory
+
+    gallery, queries, _ = synthetic_gallery(persons, batch_size * runs)
+    with tempfile.TemporaryDirectory() as directory:
+        Memory.MEMORY_PATH = os.path.join(directory, 'faces_memory.fgal')
+        memory = Memory()
+        memory.initialize({f'person_{i}': i for i in range(persons)}, gallery, torch.device('cpu'))
+        del gallery
+        memory = Memory.load(Memory.MEMORY_PATH)
+
+        for shards in [0] + list(workers):
+            memory.use_shards(shards)
+            # the first search maps the shards into the workers
+            memory.search(queries[:batch_size])
+            latencies = []
+            for batch in queries.split(batch_size):
+                start = time.perf_counter()
+                found = memory.search(batch)[1]
+                latencies.append(time.perf_counter() - start)
+            title = f"{shards} worker(s)" if shards else "in process"
+            report(f"{title}, {persons} persons, {batch_size / (sum(latencies) / len(latencies)):.0f} faces/s, "
+                   f"batches of {batch_size}", latencies)
+            if shards and not torch.equal(found, memory.search(queries[-batch_size:], exact=True)[1]):
+                print("results differ from the search in process")
+        memory.use_shards(0)
+
+
+def synthetic_face(rng, size):
+    """
+    A drawn face on a plain background, which mtcnn detects. Good enough to time the pipeline without a network or
+    pictures of real persons, not to measure accuracy.
+    :param rng: A random.Random.
+    :param size: The size of the picture.
+    """
+    from PIL import Image, ImageDraw, ImageFilter
+
+    width, height = size
+    image = Image.new('RGB', size, tuple(rng.randint(60, 200) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    face_width = rng.uniform(0.3, 0.5) * min(width, height)
+    face_height = face_width * 1.3
+    x, y = rng.uniform(0.35, 0.65) * width, rng.uniform(0.4, 0.6) * height
+    skin = (rng.randint(170, 235), rng.randint(120, 180), rng.randint(90, 140))
+    draw.ellipse([x - face_width / 2, y - face_height / 2, x + face_width / 2, y + face_height / 2], fill=skin)
+    eye_y = y - face_height * 0.12
+    for eye_x in (x - 0.2 * face_width, x + 0.2 * face_width):
+        draw.ellipse([eye_x - face_width * 0.08, eye_y - face_width * 0.05, eye_x + face_width * 0.08,
+                      eye_y + face_width * 0.05], fill=(255, 255, 255))
+        draw.ellipse([eye_x - face_width * 0.04, eye_y - face_width * 0.04, eye_x + face_width * 0.04,
+                      eye_y + face_width * 0.04], fill=(40, 30, 20))
+        draw.line([eye_x - face_width * 0.1, y - face_height * 0.22, eye_x + face_width * 0.1, y - face_height * 0.22],
+                  fill=(60, 40, 30), width=max(1, int(face_width * 0.03)))
+    draw.polygon([(x, y - face_height * 0.05), (x - face_width * 0.07, y + face_height * 0.1),
+                  (x + face_width * 0.07, y + face_height * 0.1)], fill=tuple(c - 30 for c in skin))
+    draw.chord([x - face_width * 0.2, y + face_height * 0.12, x + face_width * 0.2, y + face_height * 0.3], 0, 180,
+               fill=(150, 50, 60))
+    return image.filter(ImageFilter.GaussianBlur(min(width, height) / 200))
+
+
+def synthetic_image(rng, size, source=None, synthetic_faces=False):
+    """
+    A randomly cropped and brightened copy of source if there is one, else a drawn face or random noise.
+    """
+    from PIL import Image, ImageEnhance
+
+    if source is None:
+        if synthetic_faces:
+            return synthetic_face(rng, size)
+        return Image.frombytes('RGB', size, rng.randbytes(size[0] * size[1] * 3))
+    width, height = source.size
+    dx, dy = rng.randint(0, width // 20), rng.randint(0, height // 20)
+    image = source.crop((dx, dy, width - width // 20 + dx, height - height // 20 + dy)).resize(size)
+    return ImageEnhance.Brightness(image).enhance(rng.uniform(0.7, 1.3))
+
+
+def make_image_tree(path, images=10000, classes=100, size=(250, 250), source=None, seed=0, synthetic_faces=False):
+    """
+    Write a synthetic dataset with the structure needed by init.
+    :param path: The directory of the dataset.
+    :param images: The number of images.
+    :param classes: The number of classes, the images are spread evenly over them.
+    :param size: The size of every image.
+    :param source: A picture with a face. Every image is a randomly cropped and brightened copy of it, so faces are
+                   found in them.
+    :param seed: The random seed.
+    :param synthetic_faces: Without source, whether the images are drawn faces rather than random noise.
+    """
+    import random
+    from process import load_image
+
+    rng = random.Random(seed)
+    source = load_image(source) if source is not None else None
+    for i in range(images):
+        class_dir = os.path.join(path, f'class_{i % classes}')
+        os.makedirs(class_dir, exist_ok=True)
+        synthetic_image(rng, size, source, synthetic_faces).save(os.path.join(class_dir, f'{i}.jpg'))
+
+
+def make_image_dir(path, images=64, sizes=((320, 240),), source=None, seed=0):
+    """
+    Write a directory of synthetic images with faces, as used by rec_all. The sizes are used in turn.
+    """
+    import random
+    from process import load_image
+
+    rng = random.Random(seed)
+    source = load_image(source) if source is not None else None
+    os.makedirs(path, exist_ok=True)
+    for i in range(images):
+        synthetic_image(rng, sizes[i % len(sizes)], source, True).save(os.path.join(path, f'{i:06d}.jpg'))
+
+
+def peak_rss_mb():
+    import resource
+
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def enroll_worker(tree, batch_size, cpu=False):
+    """
+    Run init on the tree with a temporary memory file, and print the peak memory before and after.
+    """
+    from main import get_device, get_mtcnn, get_resnet
+    from memory import Memory
+    from read_dataset import read_dataset
+
+    device = get_device(cpu)
+    mtcnn = get_mtcnn(device)
+    resnet = get_resnet(device)
+    with tempfile.TemporaryDirectory() as directory:
+        Memory.MEMORY_PATH = os.path.join(directory, 'faces_memory.fgal')
+        before = peak_rss_mb()
+        start = time.perf_counter()
+        read_dataset(Memory(), device, mtcnn, resnet, tree, batch_size=batch_size)
+        print(f"{before:.1f} {peak_rss_mb():.1f} {time.perf_counter() - start:.2f}")
+
+
+def bench_enroll_memory(tree, batch_sizes=(8, 32, 128), cpu=False):
+    """
+    Peak memory of init for several batch sizes. Every run is a new process, so that the peaks do not mix.
+    """
+    device_args = ['-c'] if cpu else []
+    for batch_size in batch_sizes:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), 'enroll_worker', tree,
+                                 '-bs', str(batch_size)] + device_args,
+                                check=True, capture_output=True, text=True).stdout.split()
+        before, after, seconds = map(float, output[-3:])
+        print(f"batch_size={batch_size}: peak rss {after:.1f}MB ({after - before:+.1f}MB over the loaded models), "
+              f"{seconds:.2f}s")
+
+
+def bench_gallery_load(persons=100000, runs=5):
+    """
+    Compare loading a synthetic memory pickled by torch.save with mapping it in the gallery format.
+    """
+    import torch
+    from memory import Memory
+
+    gallery, queries, _ = synthetic_gallery(persons, 1)
+    memory = Memory()
+    with tempfile.TemporaryDirectory() as directory:
+        Memory.MEMORY_PATH = os.path.join(directory, 'faces_memory.fgal')
+        memory.initialize({f'person_{i}': i for i in range(persons)}, gallery, torch.device('cpu'))
+        legacy_path = os.path.join(directory, 'faces_memory.mpt')
+        torch.save(memory, legacy_path)
+        memory.half = True
+        half_path = os.path.join(directory, 'faces_memory_half.fgal')
+        memory.save(half_path)
+
+        for title, load, path in (("torch.load", Memory.load_legacy, legacy_path),
+                                  ("gallery float32", Memory.load, Memory.MEMORY_PATH),
+                                  ("gallery float16", Memory.load, half_path)):
+            latencies = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                load(path)
+                latencies.append(time.perf_counter() - start)
+            loaded = load(path)
+            start = time.perf_counter()
+            loaded.search(queries)
+            first_search = time.perf_counter() - start
+            report(f"{title} ({os.path.getsize(path) / 2 ** 20:.1f}MB, first search "
+                   f"{first_search * 1000:.1f}ms)", latencies)
+
+
+def bench_decode(paths, workers=(0, 1, 2, 4), rotation=True, processes=False):
+    """
+    Images per second decoded by a DecodePool for several numbers of workers.
+    """
+    from process import DecodePool
+
+    for n in workers:
+        with DecodePool(n, processes) as pool:
+            start = time.perf_counter()
+            for _ in pool.map(paths, rotation):
+                pass
+            elapsed = time.perf_counter() - start
+        print(f"{'processes' if processes else 'threads'} workers={n}: {len(paths) / elapsed:.1f} images/s")
+
+
+def bench_backends(resnet, device, faces, backends=('eager', 'quantized', 'torchscript', 'onnx'), batch_size=16,
+                   runs=10, threshold=0.85):
+    """
+    Latency, throughput and embedding drift of the embedding backends. The drift is the distance between the
+    embedding of a face by a backend and by the eager float32 resnet, and should stay far below the threshold.
+    :param resnet: The eager resnet.
+    :param device: The device to use.
+    :param faces: A (n, 3, 160, 160) tensor of aligned faces.
+    :param backends: The backends to compare.
+    :param batch_size: How many faces are embedded at once.
+    :param runs: How many times the faces are embedded by every backend.
+    :param threshold: The recognition threshold the drift is compared with.
+    """
+    import torch
+    from embedding_backend import create_backend
+
+    resnet = resnet.eval().to(device)
+    faces = faces.to(device)
+    batches = [faces[start:start + batch_size] for start in range(0, len(faces), batch_size)]
+    with torch.no_grad():
+        baseline = torch.cat([resnet(batch) for batch in batches])
+
+    for name in backends:
+        try:
+            start = time.perf_counter()
+            backend = create_backend(name, resnet, device)
+            prepared = time.perf_counter() - start
+        except Exception as e:
+            print(f"{name}: unavailable, {e}")
+            continue
+
+        # warm up, so that lazy initialization does not count
+        backend(batches[0])
+        latencies = []
+        for _ in range(runs):
+            for batch in batches:
+                start = time.perf_counter()
+                embeddings = backend(batch)
+                latencies.append(time.perf_counter() - start)
+        embeddings = torch.cat([backend(batch) for batch in batches])
+        drift = torch.linalg.vector_norm(embeddings - baseline, dim=1)
+        report(f"{name} batch_size={batch_size} ({runs * len(faces) / sum(latencies):.1f} "
+               f"faces/s, prepared in {prepared:.2f}s, drift mean={drift.mean():.5f} max={drift.max():.5f} "
+               f"= {drift.max() / threshold:.2%} of the threshold)", latencies)
+
+
+def bench_detect(images, detect_sizes=(960, 640), fast_sizes=(320,), min_face_size=20, cpu=True):
+    """
+    Time face detection on full pictures, on downscaled pictures and with a fast first pass, and count the pictures
+    in which the largest face is found where full detection finds it.
+    :param images: The PIL Images to detect.
+    :param detect_sizes: The longest sides to downscale to.
+    :param fast_sizes: The longest sides of the first pass to try.
+    :param min_face_size: The min_face_size of the detection.
+    :param cpu: Whether to use CPU.
+    """
+    from main import get_device
+    from stream import box_iou
+    from detector import FaceDetector
+
+    device = get_device(cpu)
+    configurations = [('full', FaceDetector(device=device, min_face_size=min_face_size))]
+    configurations += [(f'detect_size={size}', FaceDetector(size, device=device, min_face_size=min_face_size))
+                       for size in detect_sizes]
+    configurations += [(f'fast_size={size}', FaceDetector(None, size, device=device, min_face_size=min_face_size))
+                       for size in fast_sizes]
+
+    baseline = None
+    for title, detector in configurations:
+        latencies = []
+        boxes = []
+        for image in images:
+            start = time.perf_counter()
+            found = detector.detect(image)[0]
+            latencies.append(time.perf_counter() - start)
+            boxes.append(None if found is None else found[:1])
+        if baseline is None:
+            baseline = boxes
+        agree = sum(1 for box, expected in zip(boxes, baseline)
+                    if (box is None) == (expected is None)
+                    and (box is None or box_iou(box, expected)[0, 0] >= 0.5))
+        stats = detector.stats()
+        report(f"{title}: {sum(box is not None for box in boxes)}/{len(images)} with faces, {agree} agree with "
+               f"full, fast {stats['fast_time']:.2f}s ({stats['fast_found']}/{stats['fast_images']} found), "
+               f"full {stats['full_time']:.2f}s ({stats['full_images']})", latencies)
+
+
+def suite_worker(case, path, gallery_size, batch_size, runs=20, seed=0, threads=None):
+    """
+    Run one case of the suite in this process and print its result as JSON.
+    The models have random weights, so no network is needed. Their speed does not depend on the weights.
+    :param case: One of SUITE_CASES.
+    :param path: The dataset for init, or the directory of pictures for the other cases.
+    :param gallery_size: The number of persons in the memory. Not used by init, whose memory is the dataset.
+    :param batch_size: The batch size of init and rec_all.
+    :param runs: The number of pictures recognized one by one by rec.
+    :param seed: The random seed of the weights and the memory.
+    :param threads: The number of threads of torch, or None for its default.
+    """
+    import json
+    import torch
+    from facenet_pytorch import InceptionResnetV1
+    from main import get_mtcnn
+    from memory import Memory
+    from embedding_backend import create_backend
+    from images_dataset import ImageDataset
+    from read_dataset import read_dataset
+    from face_recognition import face_recognition, images_recognition
+    from process import list_images, load_image
+
+    if threads is not None:
+        torch.set_num_threads(threads)
+    torch.manual_seed(seed)
+    device = torch.device('cpu')
+    mtcnn = get_mtcnn(device)
+    resnet = create_backend('eager', InceptionResnetV1(), device)
+
+    latencies = []
+    with tempfile.TemporaryDirectory() as directory:
+        Memory.MEMORY_PATH = os.path.join(directory, 'faces_memory.fgal')
+        if case == 'init':
+            images = sum(len(files) for _, _, files in os.walk(path))
+            start = time.perf_counter()
+            read_dataset(Memory(), device, mtcnn, resnet, path, batch_size=batch_size)
+            seconds = time.perf_counter() - start
+        else:
+            gallery, _, _ = synthetic_gallery(gallery_size, 1, seed=seed)
+            memory = Memory()
+            memory.initialize({f'person_{i}': i for i in range(gallery_size)}, gallery, device)
+            paths = list_images([path])
+            # warm up, so that lazy initialization does not count
+            face_recognition(memory, device, mtcnn, resnet, load_image(paths[0]))
+            if case == 'rec':
+                paths = [paths[i % len(paths)] for i in range(runs)]
+                for image_path in paths:
+                    start = time.perf_counter()
+                    face_recognition(memory, device, mtcnn, resnet, load_image(image_path))
+                    latencies.append(time.perf_counter() - start)
+                images, seconds = len(paths), sum(latencies)
+            else:
+                dataset = ImageDataset(path, device)
+                start = time.perf_counter()
+                images_recognition(memory, device, mtcnn, resnet, dataset, case == 'rec_all_same_size',
+                                   batch_size=batch_size)
+                images, seconds = len(dataset), time.perf_counter() - start
+
+    print(json.dumps({
+        'case': case,
+        'gallery_size': gallery_size,
+        'batch_size': batch_size,
+        'images': images,
+        'seconds': seconds,
+        'images_per_second': images / seconds,
+        'latency_p50': percentile(latencies, 50) if latencies else None,
+        'latency_p99': percentile(latencies, 99) if latencies else None,
+        'peak_rss_mb': peak_rss_mb(),
+    }))
+
+
+def environment():
+    """
+    What the results of a run depend on besides the code.
+    """
+    import platform
+    import torch
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=current_folder(), capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'torch': torch.__version__, 'platform': platform.platform(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count(), 'torch_threads': torch.get_num_threads()}
+
+
+def run_suite(output, gallery_sizes=(1000, 10000, 100000), batch_sizes=(8, 32), images=64, classes=8, runs=20,
+              source=None, seed=0, threads=None):
+    """
+    Time init, rec and rec_all with same-size and mixed-size pictures on CPU, on synthetic data made from seed.
+    Every case runs in its own process, so that the peak memory of one case does not hide the next.
+    :param output: The JSON file to save the results in.
+    :param gallery_sizes: The numbers of persons in the memory to try.
+    :param batch_sizes: The batch sizes of init and rec_all to try.
+    :param images: The number of pictures of every dataset.
+    :param classes: The number of persons of the init dataset.
+    :param runs: The number of pictures recognized one by one by rec.
+    :param source: A picture with a face to make the pictures from, drawn faces by default.
+    :param seed: The random seed of the data and the weights.
+    :param threads: The number of threads of torch, or None for its default.
+    """
+    import json
+
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        tree, same_size, mixed = (os.path.join(root, name) for name in ('tree', 'same_size', 'mixed'))
+        make_image_tree(tree, images, classes, (250, 250), source, seed, synthetic_faces=True)
+        make_image_dir(same_size, images, ((320, 240),), source, seed + 1)
+        make_image_dir(mixed, images, ((320, 240), (400, 300), (240, 320), (500, 500)), source, seed + 2)
+
+        cases = [('init', tree, classes, batch_size) for batch_size in batch_sizes]
+        cases += [('rec', same_size, gallery_size, 1) for gallery_size in gallery_sizes]
+        cases += [(case, path, gallery_size, batch_size)
+                  for case, path in (('rec_all_same_size', same_size), ('rec_all_mixed', mixed))
+                  for gallery_size in gallery_sizes for batch_size in batch_sizes]
+
+        for case, path, gallery_size, batch_size in cases:
+            command = [sys.executable, os.path.abspath(__file__), 'suite_worker', case, path, '-g', str(gallery_size),
+                       '-bs', str(batch_size), '-r', str(runs), '--seed', str(seed)]
+            if threads is not None:
+                command += ['-t', str(threads)]
+            completed = subprocess.run(command, capture_output=True, text=True)
+            if completed.returncode != 0:
+                error = (completed.stderr.strip().splitlines() or ['failed'])[-1]
+                print(f"{case} gallery={gallery_size} batch_size={batch_size}: {error}")
+                results.append({'case': case, 'gallery_size': gallery_size, 'batch_size': batch_size,
+                                'error': error})
+                continue
+            result = json.loads(completed.stdout.strip().splitlines()[-1])
+            results.append(result)
+            latency = (f", p50={result['latency_p50'] * 1000:.1f}ms p99={result['latency_p99'] * 1000:.1f}ms"
+                       if result['latency_p50'] is not None else '')
+            print(f"{case} gallery={gallery_size} batch_size={batch_size}: "
+                  f"{result['images_per_second']:.2f} images/s{latency}, peak rss {result['peak_rss_mb']:.0f}MB")
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump({'environment': environment(),
+                   'settings': {'gallery_sizes': list(gallery_sizes), 'batch_sizes': list(batch_sizes),
+                                'images': images, 'classes': classes, 'runs': runs, 'source': source, 'seed': seed,
+                                'threads': threads},
+                   'results': results}, file, indent=2)
+    print(f"results saved in {output}")
+
+
+def compare_suites(baseline, current, tolerance=0.1):
+    """
+    Compare the throughput of two runs of the suite, case by case.
+    :param baseline: The JSON file of the older run.
+    :param current: The JSON file of the newer run.
+    :param tolerance: How much slower a case may be before it counts as a regression.
+    :return: Whether no case regressed.
+    """
+    import json
+
+    def load(path):
+        with open(path, encoding='utf-8') as file:
+            return {(result['case'], result['gallery_size'], result['batch_size']): result
+                    for result in json.load(file)['results'] if 'error' not in result}
+
+    baseline, current = load(baseline), load(current)
+    passed = True
+    for key in sorted(baseline.keys() & current.keys()):
+        before, after = baseline[key]['images_per_second'], current[key]['images_per_second']
+        change = after / before - 1
+        regressed = change < -tolerance
+        passed = passed and not regressed
+        print(f"{key[0]} gallery={key[1]} batch_size={key[2]}: {before:.2f} -> {after:.2f} images/s "
+              f"({change:+.1%}){' REGRESSION' if regressed else ''}")
+    for key in sorted(baseline.keys() ^ current.keys()):
+        print(f"{key[0]} gallery={key[1]} batch_size={key[2]}: only in {'baseline' if key in baseline else 'current'}")
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Face Recognition benchmarks')
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    startup_parser = subparsers.add_parser("startup", help="Start-up time of the commands of main.py")
+    startup_parser.add_argument("-n", "--runs", type=int, default=5, help="Runs of every command")
+
+    server_parser = subparsers.add_parser("server", help="Cold CLI calls against a warm recognition server")
+    server_parser.add_argument("image", type=str, help="Path to a picture with a face")
+    server_parser.add_argument("-n", "--runs", type=int, default=5, help="Runs of every mode")
+    server_parser.add_argument("-p", "--port", type=int, default=8799, help="Port for the temporary server")
+    server_parser.add_argument("-c", "--cpu", action='store_true', help="Use CPU")
+
+    batching_parser = subparsers.add_parser("batching", help="Concurrent requests through the request batching")
+    batching_parser.add_argument("images", type=str, nargs="+", help="Paths to pictures")
+    batching_parser.add_argument("-n", "--requests", type=int, default=64, help="Number of requests")
+    batching_parser.add_argument("-t", "--clients", type=int, nargs="+", default=[1, 8],
+                                 help="Numbers of concurrent clients to try")
+    batching_parser.add_argument("-bs", "--max-batch-size", type=int, nargs="+", default=[1, 16],
+                                 help="Batch sizes to try")
+    batching_parser.add_argument("-w", "--max-wait", type=float, default=10,
+                                 help="Milliseconds a request waits for others to join its batch")
+    batching_parser.add_argument("-c", "--cpu", action='store_true', help="Use CPU")
+
+    ann_parser = subparsers.add_parser("ann", help="Approximate search index against exact search")
+    ann_parser.add_argument("-n", "--persons", type=int, default=100000, help="Number of persons in the gallery")
+    ann_parser.add_argument("-q", "--queries", type=int, default=200, help="Number of queries")
+    ann_parser.add_argument("-l", "--lists", type=int, default=None, help="Number of clusters of the index")
+    ann_parser.add_argument("-np", "--probe", type=int, nargs="+", default=[1, 4, 8, 16],
+                            help="Numbers of searched clusters to try")
+    ann_parser.add_argument("-k", type=int, default=1, help="Number of neighbours")
+
+    enroll_parser = subparsers.add_parser("enroll_memory", help="Peak memory of init on a synthetic dataset")
+    enroll_parser.add_argument("-d", "--dataset", type=str, default=None,
+                               help="Existing dataset to use instead of a synthetic one")
+    enroll_parser.add_argument("-s", "--source", type=str, default=None,
+                               help="Picture with a face to make the synthetic images from, drawn faces by default")
+    enroll_parser.add_argument("-n", "--images", type=int, default=10000, help="Number of synthetic images")
+    enroll_parser.add_argument("-bs", "--batch-size", type=int, nargs="+", default=[8, 32, 128],
+                               help="Batch sizes to try")
+    enroll_parser.add_argument("-c", "--cpu", action='store_true', help="Use CPU")
+
+    enroll_worker_parser = subparsers.add_parser("enroll_worker", help="One run of enroll_memory")
+    enroll_worker_parser.add_argument("dataset", type=str)
+    enroll_worker_parser.add_argument("-bs", "--batch-size", type=int, default=32)
+    enroll_worker_parser.add_argument("-c", "--cpu", action='store_true')
+
+    load_parser = subparsers.add_parser("load", help="Loading a pickled memory against the gallery format")
+    load_parser.add_argument("-n", "--persons", type=int, default=100000, help="Number of persons in the memory")
+    load_parser.add_argument("-r", "--runs", type=int, default=5, help="Loads of every format")
+
+    prototypes_parser = subparsers.add_parser("prototypes", help="Matching means against matching prototypes")
+    prototypes_parser.add_argument("-n", "--persons", type=int, default=10000, help="Number of persons in the memory")
+    prototypes_parser.add_argument("-sp", "--samples", type=int, default=8, help="Enrolled pictures per person")
+    prototypes_parser.add_argument("-q", "--queries", type=int, default=1000, help="Number of queries")
+    prototypes_parser.add_argument("-pt", "--prototypes", type=int, nargs="+", default=[0, 2, 4, 8],
+                                   help="Most prototypes per person to try, 0 matches the means")
+    prototypes_parser.add_argument("-bs", "--batch-size", type=int, default=32, help="Queries searched together")
+
+    shards_parser = subparsers.add_parser("shards", help="Searching the memory in 1 to n worker processes")
+    shards_parser.add_argument("-n", "--persons", type=int, default=500000, help="Number of persons in the memory")
+    shards_parser.add_argument("-w", "--workers", type=int, nargs="+", default=[1, 2, 4, 8],
+                               help="Numbers of worker processes to try")
+    shards_parser.add_argument("-bs", "--batch-size", type=int, default=32, help="Faces searched together")
+    shards_parser.add_argument("-r", "--runs", type=int, default=20, help="Batches searched by every setting")
+
+    decode_parser = subparsers.add_parser("decode", help="Decoding throughput against the number of workers")
+    decode_parser.add_argument("-d", "--directory", type=str, default=None,
+                               help="Directory of pictures to decode instead of synthetic ones")
+    decode_parser.add_argument("-n", "--images", type=int, default=200, help="Number of synthetic pictures")
+    decode_parser.add_argument("-w", "--workers", type=int, nargs="+", default=[0, 1, 2, 4],
+                               help="Numbers of workers to try")
+    decode_parser.add_argument("-dp", "--decode-processes", action='store_true',
+                               help="Decode in processes instead of threads")
+
+    backend_parser = subparsers.add_parser("backend", help="Latency and embedding drift of the embedding backends")
+    backend_parser.add_argument("-i", "--images", type=str, nargs="+", default=None,
+                                help="Pictures with faces to embed instead of random faces")
+    backend_parser.add_argument("-n", "--faces", type=int, default=64, help="Number of random faces")
+    backend_parser.add_argument("-b", "--backends", type=str, nargs="+",
+                                default=['eager', 'quantized', 'torchscript', 'onnx'], help="Backends to compare")
+    backend_parser.add_argument("-bs", "--batch-size", type=int, default=16, help="Faces embedded at once")
+    backend_parser.add_argument("-r", "--runs", type=int, default=10, help="Runs of every backend")
+    backend_parser.add_argument("-g", "--gpu", action='store_true', help="Use the GPU if there is one")
+
+    detect_parser = subparsers.add_parser("detect", help="Full, downscaled and two-pass face detection")
+    detect_parser.add_argument("-i", "--images", type=str, nargs="+", default=None,
+                               help="Pictures or directories of pictures to detect instead of synthetic ones")
+    detect_parser.add_argument("-s", "--source", type=str, default=None,
+                               help="Picture with a face to make the synthetic pictures from")
+    detect_parser.add_argument("-n", "--count", type=int, default=20, help="Number of synthetic pictures")
+    detect_parser.add_argument("-ds", "--detect-size", type=int, nargs="+", default=[960, 640],
+                               help="Longest sides to downscale to")
+    detect_parser.add_argument("-fd", "--fast-detect", type=int, nargs="+", default=[320],
+                               help="Longest sides of the first pass")
+    detect_parser.add_argument("-mfs", "--min-face-size", type=int, default=20, help="Smallest face detected")
+    detect_parser.add_argument("-g", "--gpu", action='store_true', help="Use the GPU if there is one")
+
+    suite_parser = subparsers.add_parser("suite", help="Reproducible init, rec and rec_all timings saved as JSON")
+    suite_parser.add_argument("-o", "--output", type=str,
+                              default=os.path.join(current_folder(), '../benchmarks',
+                                                   time.strftime('suite-%Y%m%d-%H%M%S.json')),
+                              help="JSON file to save the results in")
+    suite_parser.add_argument("-g", "--gallery-sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                              help="Numbers of persons in the memory")
+    suite_parser.add_argument("-bs", "--batch-sizes", type=int, nargs="+", default=[8, 32],
+                              help="Batch sizes of init and rec_all")
+    suite_parser.add_argument("-n", "--images", type=int, default=64, help="Pictures in every dataset")
+    suite_parser.add_argument("-cl", "--classes", type=int, default=8, help="Persons in the init dataset")
+    suite_parser.add_argument("-r", "--runs", type=int, default=20, help="Pictures recognized one by one by rec")
+    suite_parser.add_argument("-s", "--source", type=str, default=None,
+                              help="Picture with a face to make the synthetic images from, drawn faces by default")
+    suite_parser.add_argument("--seed", type=int, default=0, help="Random seed of the data and the weights")
+    suite_parser.add_argument("-t", "--threads", type=int, default=None, help="Threads used by torch")
+
+    suite_worker_parser = subparsers.add_parser("suite_worker", help="One case of suite")
+    suite_worker_parser.add_argument("case", type=str, choices=SUITE_CASES)
+    suite_worker_parser.add_argument("path", type=str)
+    suite_worker_parser.add_argument("-g", "--gallery-size", type=int, default=1000)
+    suite_worker_parser.add_argument("-bs", "--batch-size", type=int, default=16)
+    suite_worker_parser.add_argument("-r", "--runs", type=int, default=20)
+    suite_worker_parser.add_argument("--seed", type=int, default=0)
+    suite_worker_parser.add_argument("-t", "--threads", type=int, default=None)
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two results of suite")
+    compare_parser.add_argument("baseline", type=str, help="Results of the older run")
+    compare_parser.add_argument("current", type=str, help="Results of the newer run")
+    compare_parser.add_argument("-tl", "--tolerance", type=float, default=0.1,
+                                help="Slowdown counted as a regression, 0.1 is 10%%")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "startup":
+        bench_startup(args.runs)
+
+    if args.benchmark == "server":
+        bench_server(args.image, args.runs, args.port, args.cpu)
+
+    if args.benchmark == "batching":
+        from main import get_device, get_mtcnn, get_resnet
+        from memory import Memory
+        from process import load_image
+
+        device = get_device(args.cpu)
+        mtcnn = get_mtcnn(device)
+        resnet = get_resnet(device)
+        memory = Memory.load_memory()
+        images = [load_image(path) for path in args.images]
+        for clients in args.clients:
+            for max_batch_size in args.max_batch_size:
+                bench_batching(memory, device, mtcnn, resnet, images, args.requests, clients, max_batch_size,
+                               args.max_wait / 1000)
+
+    if args.benchmark == "ann":
+        bench_ann(args.persons, args.queries, args.lists, args.probe, args.k)
+
+    if args.benchmark == "enroll_memory":
+        if args.dataset is not None:
+            bench_enroll_memory(args.dataset, args.batch_size, args.cpu)
+        else:
+            with tempfile.TemporaryDirectory() as tree:
+                make_image_tree(tree, args.images, source=args.source, synthetic_faces=True)
+                bench_enroll_memory(tree, args.batch_size, args.cpu)
+
+    if args.benchmark == "enroll_worker":
+        enroll_worker(args.dataset, args.batch_size, args.cpu)
+
+    if args.benchmark == "load":
+        bench_gallery_load(args.persons, args.runs)
+
+    if args.benchmark == "shards":
+        bench_shards(args.persons, args.workers, args.batch_size, args.runs)
+
+    if args.benchmark == "prototypes":
+        bench_prototypes(args.persons, args.samples, args.queries, args.prototypes, args.batch_size)
+
+    if args.benchmark == "decode":
+        from process import list_images
+
+        if args.directory is not None:
+            bench_decode(list_images([args.directory]), args.workers, processes=args.decode_processes)
+        else:
+            with tempfile.TemporaryDirectory() as tree:
+                make_image_tree(tree, args.images, classes=1, size=(1600, 1200))
+                bench_decode(list_images([os.path.join(tree, 'class_0')]), args.workers,
+                             processes=args.decode_processes)
+
+    if args.benchmark == "backend":
+        import torch
+        from embedding_backend import load_resnet
+        from main import get_device
+
+        device = get_device(not args.gpu)
+        if args.images is not None:
+            from main import get_mtcnn
+            from process import load_image
+
+            mtcnn = get_mtcnn(torch.device('cpu'))
+            faces = [mtcnn(load_image(path)) for path in args.images]
+            faces = torch.stack([face for face in faces if face is not None])
+        else:
+            faces = torch.randn(args.faces, 3, 160, 160, generator=torch.Generator().manual_seed(0))
+        bench_backends(load_resnet(torch.device('cpu')), device, faces, args.backends, args.batch_size,
+                       args.runs)
+
+    if args.benchmark == "detect":
+        from process import list_images, load_image
+
+        if args.images is not None:
+            bench_detect([load_image(path) for path in list_images(args.images)], args.detect_size,
+                         args.fast_detect, args.min_face_size, not args.gpu)
+        else:
+            with tempfile.TemporaryDirectory() as tree:
+                make_image_tree(tree, args.count, classes=1, size=(1600, 1200), source=args.source,
+                                synthetic_faces=True)
+                bench_detect([load_image(path) for path in list_images([os.path.join(tree, 'class_0')])],
+                             args.detect_size, args.fast_detect, args.min_face_size, not args.gpu)
+
+    if args.benchmark == "suite":
+        run_suite(args.output, args.gallery_sizes, args.batch_sizes, args.images, args.classes, args.runs,
+                  args.source, args.seed, args.threads)
+
+    if args.benchmark == "suite_worker":
+        suite_worker(args.case, args.path, args.gallery_size, args.batch_size, args.runs, args.seed, args.threads)
+
+    if args.benchmark == "compare":
+        if not compare_suites(args.baseline, args.current, args.tolerance):
+            exit(1)
@@ -0,0 +1,11 @@
+import os
+
+from process import current_folder
+
+# the defaults the command line needs to parse its arguments, kept out of the modules using them so that the command
+# line does not import torch before it knows whether the command needs it
+DATA_FOLDER = os.path.join(current_folder(), '../data')
+MEMORY_PATH = os.path.join(DATA_FOLDER, 'faces_memory.fgal')
+LEGACY_MEMORY_PATH = os.path.join(DATA_FOLDER, 'faces_memory.mpt')
+EMBEDDING_CACHE_PATH = os.path.join(DATA_FOLDER, 'embedding_cache.sqlite')
+BACKENDS = ('eager', 'quantized', 'torchscript', 'onnx')
@@ -0,0 +1,150 @@
+import time
+import numpy as np
+from facenet_pytorch import MTCNN
+from PIL import Image
+from profiler import stage, observe
+
+
+def detect_batch(mtcnn: MTCNN, images: list, save_path=None, return_boxes: bool = False):
+    """
+    Crop the faces of same-size pictures, like mtcnn(images, save_path=save_path).
+    MTCNN fails on a batch in which only some of the pictures have a face when keep_all is off, because of the way it
+    selects the faces, so the faces are cropped from the boxes of detect, in which the first face is the one MTCNN
+    would select.
+    :param return_boxes: Whether to also return the boxes and the probabilities of the faces.
+    :return: The faces of every picture as mtcnn returns them, None for the pictures without a face. With
+             return_boxes, (faces, boxes, probs), where the boxes and the probabilities of every picture are in the
+             order of its faces.
+    """
+    boxes, probs = mtcnn.detect(images)
+    faces = mtcnn.extract(images, boxes, save_path)
+    if return_boxes:
+        return faces, boxes, probs
+    return faces
+
+
+class FaceDetector(MTCNN):
+    """
+    MTCNN with cheaper detection. It is called like MTCNN, so it can be passed wherever a mtcnn is expected.
+    - With detect_size, pictures larger than detect_size are downscaled before detection and the boxes are mapped back,
+      so the faces are still cropped from the full picture. min_face_size is measured on the downscaled picture.
+    - With fast_size, every picture is first detected downscaled to fast_size and with fast_min_face_size, which
+      skips most of the image pyramid. Only the pictures in which no face is found are detected again normally.
+    The time spent in every stage is counted, see stats, and profiled as the detect_fast, detect_full and
+    detect_extract stages, see profiler.
+    """
+
+    def __init__(self, detect_size: int = None, fast_size: int = None, fast_min_face_size: int = 40, **kwargs):
+        """
+        :param detect_size: The longest side pictures are downscaled to before detection, or None not to downscale.
+        :param fast_size: The longest side of the pictures in the first pass, or None for no first pass.
+        :param fast_min_face_size: The min_face_size of the first pass.
+        :param kwargs: The arguments of MTCNN, such as device, min_face_size and factor.
+        """
+        super().__init__(**kwargs)
+        self.detect_size = detect_size
+        self.fast_size = fast_size
+        self.fast_min_face_size = fast_min_face_size
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.timings = {'fast': 0.0, 'full': 0.0, 'extract': 0.0}
+        self.counts = {'fast': 0, 'fast_found': 0, 'full': 0}
+
+    def stats(self):
+        """
+        :return: The time spent in the first pass, in the normal detection and in cropping the faces, and how many
+                 pictures went through each pass.
+        """
+        return {**{f'{stage}_time': seconds for stage, seconds in self.timings.items()},
+                'fast_images': self.counts['fast'], 'fast_found': self.counts['fast_found'],
+                'full_images': self.counts['full']}
+
+    def describe(self):
+        """
+        Describe the settings which change the detected faces besides those of MTCNN, empty if there are none.
+        """
+        if self.detect_size is None and self.fast_size is None:
+            return ''
+        return f'detect_size={self.detect_size},fast_size={self.fast_size},fast_min={self.fast_min_face_size}'
+
+    def detect(self, img, landmarks=False):
+        batch = isinstance(img, (list, tuple))
+        images = list(img) if batch else [img]
+        if not all(isinstance(image, Image.Image) for image in images):
+            # arrays and tensors are detected as they are
+            return super().detect(img, landmarks)
+
+        boxes = [None] * len(images)
+        probs = [[None]] * len(images)
+        points = [None] * len(images)
+        remaining = list(range(len(images)))
+
+        if self.fast_size is not None:
+            start = time.perf_counter()
+            with stage('detect_fast'):
+                found = self._detect_scaled(images, self.fast_size, self.fast_min_face_size)
+            self.timings['fast'] += time.perf_counter() - start
+            self.counts['fast'] += len(images)
+            remaining = []
+            for i, (box, prob, point) in enumerate(zip(*found)):
+                observe('fast_found', 0 if box is None else 1)
+                if box is None:
+                    remaining.append(i)
+                else:
+                    boxes[i], probs[i], points[i] = box, prob, point
+            self.counts['fast_found'] += len(images) - len(remaining)
+
+        if remaining:
+            start = time.perf_counter()
+            with stage('detect_full'):
+                found = self._detect_scaled([images[i] for i in remaining], self.detect_size, self.min_face_size)
+            self.timings['full'] += time.perf_counter() - start
+            self.counts['full'] += len(remaining)
+            for i, box, prob, point in zip(remaining, *found):
+                boxes[i], probs[i], points[i] = box, prob, point
+
+        if batch:
+            boxes = np.array(boxes, dtype=object)
+            probs = np.array(probs, dtype=object)
+            points = np.array(points, dtype=object)
+        else:
+            boxes, probs, points = boxes[0], probs[0], points[0]
+        if landmarks:
+            return boxes, probs, points
+        return boxes, probs
+
+    def _detect_scaled(self, images: list, size: int, min_face_size: int):
+        """
+        Detect the faces of same-size pictures downscaled so that their longest side is at most size.
+        :return: (boxes, probs, points) for every picture, in the coordinates of the full pictures.
+        """
+        scale = 1.0
+        if size is not None and max(images[0].size) > size:
+            scale = size / max(images[0].size)
+            scaled_size = (max(1, round(images[0].width * scale)), max(1, round(images[0].height * scale)))
+            images = [image.resize(scaled_size, Image.BILINEAR) for image in images]
+
+        if min(images[0].size) < min_face_size:
+            # no face fits, and MTCNN fails on pictures smaller than its first pyramid level
+            return [None] * len(images), [[None]] * len(images), [None] * len(images)
+
+        min_face_size, self.min_face_size = self.min_face_size, min_face_size
+        try:
+            boxes, probs, points = super().detect(images, landmarks=True)
+        finally:
+            self.min_face_size = min_face_size
+
+        # the arrays of a batch may be object arrays, the arrays of a single picture are not
+        boxes = [None if box is None else np.asarray(box, dtype=np.float32) / scale for box in boxes]
+        probs = [[None] if box is None else np.asarray(prob, dtype=np.float32) for box, prob in zip(boxes, probs)]
+        points = [None if point is None else np.asarray(point, dtype=np.float32) / scale for point in points]
+        return boxes, probs, points
+
+    def extract(self, img, batch_boxes, save_path):
+        start = time.perf_counter()
+        try:
+            with stage('detect_extract'):
+                return super().extract(img, batch_boxes, save_path)
+        finally:
+            self.timings['extract'] += time.perf_counter() - start
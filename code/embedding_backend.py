@@ -0,0 +1,174 @@
+import os
+import copy
+import functools
+import hashlib
+import inspect
+import torch
+from facenet_pytorch import InceptionResnetV1
+
+from defaults import BACKENDS, DATA_FOLDER
+
+ONNX_FOLDER = DATA_FOLDER
+
+
+def weights_digest(weights: dict):
+    """
+    A digest of the weights of a model: every parameter and buffer of its state_dict with its name, so that a change
+    to any layer gives another digest. The counters of the batch norms are left out, as they do not change what the
+    model computes.
+    """
+    digest = hashlib.sha1()
+    for name, tensor in weights.items():
+        if not tensor.is_floating_point():
+            continue
+        digest.update(name.encode('utf-8'))
+        digest.update(tensor.detach().float().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+class EmbeddingBackend(torch.nn.Module):
+    """
+    Runs a resnet to get the embeddings of aligned faces, under torch.inference_mode.
+    It is called like the resnet itself, so it can be passed wherever a resnet is expected.
+    The subclasses run other versions of the same resnet, which are faster but give slightly different embeddings.
+    """
+    backend = 'eager'
+
+    def __init__(self, resnet: InceptionResnetV1, device: torch.device):
+        super().__init__()
+        self.device = device
+        # the weights of the eager resnet, only digested when needed, see digest
+        self.weights = resnet.state_dict()
+        self.model = self.prepare(resnet.eval().to(device))
+
+    @functools.cached_property
+    def digest(self):
+        """
+        The digest of the weights of the eager resnet, so embeddings of the same weights run by other backends are
+        told apart. Hashing the weights takes a while, so it is only done by the commands that need it.
+        """
+        return weights_digest(self.weights)
+
+    def prepare(self, resnet: InceptionResnetV1):
+        return resnet
+
+    def run(self, faces: torch.Tensor):
+        return self.model(faces)
+
+    def forward(self, faces: torch.Tensor):
+        with torch.inference_mode():
+            embeddings = self.run(faces)
+        # inference tensors cannot be changed in place outside inference mode, so callers get a normal tensor
+        return embeddings.clone()
+
+
+class QuantizedBackend(EmbeddingBackend):
+    """
+    The linear layers quantized to int8 with dynamic quantization. Quantized layers only run on CPU, so the faces are
+    embedded on CPU whatever the device.
+    """
+    backend = 'quantized'
+
+    def prepare(self, resnet: InceptionResnetV1):
+        return torch.ao.quantization.quantize_dynamic(copy.deepcopy(resnet).cpu(), {torch.nn.Linear},
+                                                      dtype=torch.qint8)
+
+    def run(self, faces: torch.Tensor):
+        return self.model(faces.cpu()).to(faces.device)
+
+
+class TorchScriptBackend(EmbeddingBackend):
+    """
+    The resnet traced and frozen by TorchScript, which folds the batch normalizations into the convolutions.
+    """
+    backend = 'torchscript'
+
+    def prepare(self, resnet: InceptionResnetV1):
+        with torch.inference_mode(False), torch.no_grad():
+            traced = torch.jit.trace(resnet, torch.zeros(2, 3, 160, 160, device=self.device))
+            return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+
+class OnnxBackend(EmbeddingBackend):
+    """
+    The resnet exported to ONNX and run by ONNX Runtime. The export is kept next to the memory and reused while the
+    weights do not change.
+    """
+    backend = 'onnx'
+
+    def prepare(self, resnet: InceptionResnetV1):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise Exception('The onnx backend needs onnxruntime, run "pip install onnxruntime".')
+
+        path = os.path.join(ONNX_FOLDER, f'resnet_{self.digest[:16]}.onnx')
+        if not os.path.exists(path):
+            os.makedirs(ONNX_FOLDER, exist_ok=True)
+            # newer versions of torch export with dynamo by default, which needs more packages
+            options = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+            temp_path = f'{path}.{os.getpid()}.tmp'
+            torch.onnx.export(resnet, torch.zeros(1, 3, 160, 160, device=self.device), temp_path,
+                              input_names=['faces'], output_names=['embeddings'],
+                              dynamic_axes={'faces': {0: 'batch'}, 'embeddings': {0: 'batch'}}, **options)
+            os.replace(temp_path, path)
+
+        providers = ['CPUExecutionProvider']
+        if self.device.type == 'cuda' and 'CUDAExecutionProvider' in onnxruntime.get_available_providers():
+            providers.insert(0, 'CUDAExecutionProvider')
+        self.session = onnxruntime.InferenceSession(path, providers=providers)
+        return None
+
+    def run(self, faces: torch.Tensor):
+        embeddings = self.session.run(None, {'faces': faces.detach().cpu().numpy()})[0]
+        return torch.from_numpy(embeddings).to(faces.device)
+
+
+VGGFACE2_WEIGHTS = '20180402-114759-vggface2.pt'
+VGGFACE2_URL = f'https://github.com/timesler/facenet-pytorch/releases/download/v2.2.9/{VGGFACE2_WEIGHTS}'
+VGGFACE2_CLASSES = 8631
+
+
+def find_weights(path: str = None):
+    """
+    Find the vggface2 weights of the resnet on disk: path, else $FACE_RECOGNITION_WEIGHTS, else data/, else the
+    checkpoints of torch, where facenet_pytorch downloads them.
+    :return: The path of the weights.
+    """
+    torch_home = os.path.expanduser(os.getenv('TORCH_HOME', os.path.join(os.getenv('XDG_CACHE_HOME', '~/.cache'),
+                                                                         'torch')))
+    candidates = [path, os.getenv('FACE_RECOGNITION_WEIGHTS'), os.path.join(DATA_FOLDER, VGGFACE2_WEIGHTS),
+                  os.path.join(torch_home, 'checkpoints', VGGFACE2_WEIGHTS)]
+    for candidate in candidates:
+        if candidate and os.path.isfile(candidate):
+            return candidate
+    if path is not None:
+        raise Exception(f'Weights {path} not found.')
+    raise Exception(f'The resnet weights are not found. Download {VGGFACE2_URL} into {os.path.abspath(DATA_FOLDER)} '
+                    f'or {os.path.join(torch_home, "checkpoints")}, or set FACE_RECOGNITION_WEIGHTS to their path.')
+
+
+def load_resnet(device: torch.device, path: str = None):
+    """
+    The resnet pretrained on vggface2, like InceptionResnetV1(pretrained='vggface2') but never downloading the weights,
+    see find_weights.
+    """
+    resnet = InceptionResnetV1()
+    # the classification layer is unused, but kept so that the model is the same as the one of facenet_pytorch
+    resnet.logits = torch.nn.Linear(512, VGGFACE2_CLASSES)
+    resnet.load_state_dict(torch.load(find_weights(path), map_location='cpu'))
+    resnet.device = device
+    return resnet.eval().to(device)
+
+
+def create_backend(backend: str, resnet: InceptionResnetV1, device: torch.device):
+    """
+    :param backend: One of BACKENDS.
+    :param resnet: The eager resnet.
+    :param device: The device to run on.
+    :return: An EmbeddingBackend.
+    """
+    backends = {cls.backend: cls for cls in (EmbeddingBackend, QuantizedBackend, TorchScriptBackend, OnnxBackend)}
+    if backend not in backends:
+        raise Exception(f'Unknown embedding backend {backend}, choose from {", ".join(BACKENDS)}.')
+    return backends[backend](resnet, device)
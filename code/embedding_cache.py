@@ -0,0 +1,131 @@
+import os
+import hashlib
+import sqlite3
+import torch
+
+from defaults import EMBEDDING_CACHE_PATH
+from embedding_backend import EmbeddingBackend, weights_digest
+from detector import FaceDetector
+
+
+class EmbeddingCache:
+    """
+    An on-disk cache of face embeddings, keyed by the content of the image file and the settings used to get the
+    embedding. Images in which no face is detected are cached too, so they are not detected again.
+    When the cache holds more than max_entries images, the least recently used ones are evicted.
+    The new embeddings are committed every commit_every images, so an interrupted run keeps most of its work.
+    """
+    DEFAULT_PATH = EMBEDDING_CACHE_PATH
+
+    def __init__(self, path: str = DEFAULT_PATH, max_entries: int = 100000, settings: str = '',
+                 commit_every: int = 64):
+        """
+        :param path: The path of the cache file.
+        :param max_entries: The most images kept in the cache.
+        :param settings: A description of everything besides the image which changes the embedding,
+                         see EmbeddingCache.describe_settings.
+        :param commit_every: How many images are cached between two commits.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.settings = settings
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS embeddings '
+                                '(key TEXT PRIMARY KEY, embedding BLOB, last_used INTEGER NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+        self.count, clock = self.connection.execute('SELECT COUNT(*), MAX(last_used) FROM embeddings').fetchone()
+        self.clock = clock or 0
+
+    @staticmethod
+    def describe_settings(mtcnn, resnet, rotation: bool, enrollment_filter=None):
+        """
+        Describe the detection settings, the weights and the embedding backend of the resnet and whether the EXIF
+        rotation is handled, and the quality checks of the enrollment filter, which cache the faces they reject as
+        missing.
+        """
+        if isinstance(resnet, EmbeddingBackend):
+            weights, backend = resnet.digest, resnet.backend
+        else:
+            weights, backend = weights_digest(resnet.state_dict()), EmbeddingBackend.backend
+        settings = (f'mtcnn={mtcnn.image_size},{mtcnn.margin},{mtcnn.min_face_size},{list(mtcnn.thresholds)},'
+                    f'{mtcnn.factor},{mtcnn.post_process},{mtcnn.selection_method};'
+                    f'resnet={weights};rotation={rotation}')
+        # settings added later are only described when used, so the keys of older caches stay valid
+        if backend != EmbeddingBackend.backend:
+            settings += f';backend={backend}'
+        if isinstance(mtcnn, FaceDetector) and mtcnn.describe():
+            settings += f';{mtcnn.describe()}'
+        if enrollment_filter is not None and enrollment_filter.describe():
+            settings += f';{enrollment_filter.describe()}'
+        return settings
+
+    def key(self, file_path: str):
+        digest = hashlib.sha256(self.settings.encode('utf-8'))
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        """
+        :return: (hit, embedding). embedding is None if the image is cached but has no face.
+        """
+        row = self.connection.execute('SELECT embedding FROM embeddings WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return False, None
+
+        self.hits += 1
+        self.clock += 1
+        self.connection.execute('UPDATE embeddings SET last_used = ? WHERE key = ?', (self.clock, key))
+        if row[0] is None:
+            return True, None
+        return True, torch.frombuffer(bytearray(row[0]), dtype=torch.float32)
+
+    def put(self, key: str, embedding: torch.Tensor = None):
+        """
+        Cache the embedding of an image, or None if no face is detected in it.
+        """
+        blob = None if embedding is None else embedding.detach().float().cpu().numpy().tobytes()
+        known = self.connection.execute('SELECT 1 FROM embeddings WHERE key = ?', (key,)).fetchone() is not None
+        self.clock += 1
+        self.connection.execute('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)', (key, blob, self.clock))
+        if not known:
+            self.count += 1
+        if self.count > self.max_entries:
+            self.evict(self.count - self.max_entries)
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def evict(self, n: int):
+        self.connection.execute('DELETE FROM embeddings WHERE key IN '
+                                '(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)', (n,))
+        self.count -= n
+        self.evictions += n
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': self.count,
+                'hit_rate': self.hits / total if total else 0.0}
+
+    def commit(self):
+        self.connection.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
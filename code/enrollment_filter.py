@@ -0,0 +1,103 @@
+import numpy as np
+from collections import defaultdict
+from PIL import Image
+
+
+def dhash(image: Image.Image, size: int = 8):
+    """
+    The difference hash of a picture: whether each pixel of a size + 1 by size grayscale thumbnail is brighter than
+    its left neighbour. Resized, recompressed or slightly edited copies of a picture have hashes only a few bits apart.
+    :return: The hash as an int of size * size bits.
+    """
+    pixels = np.asarray(image.convert('L').resize((size + 1, size), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming(a: int, b: int):
+    return bin(a ^ b).count('1')
+
+
+class EnrollmentFilter:
+    """
+    Cheap checks choosing which pictures of a dataset are worth embedding, so that large and redundant datasets are
+    embedded in proportion to what they add.
+    - With dedup_distance, a picture whose hash is at most dedup_distance bits from a picture already kept for the
+      same person is a near duplicate and is skipped before detection, see dhash.
+    - A face detected with a probability under min_probability, or whose box is smaller than min_box_size pixels on
+      its shorter side, is skipped before the resnet.
+    - With max_per_person, a person keeps the first max_per_person faces passing the other checks, and their other
+      pictures are not decoded any more.
+    The number of pictures skipped by every check is counted, see stats.
+    """
+
+    def __init__(self, dedup_distance: int = None, min_probability: float = 0.0, min_box_size: int = 0,
+                 max_per_person: int = None):
+        """
+        :param dedup_distance: The most bits two hashes may differ by to be near duplicates, None not to look for them.
+        :param min_probability: The lowest detection probability of a face kept.
+        :param min_box_size: The shortest side in pixels of the box of a face kept.
+        :param max_per_person: The most faces kept for every person, None for all of them.
+        """
+        self.dedup_distance = dedup_distance
+        self.min_probability = min_probability
+        self.min_box_size = min_box_size
+        self.max_per_person = max_per_person
+        self.hashes = defaultdict(list)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.counts = {'duplicates': 0, 'low_quality': 0, 'over_limit': 0}
+
+    def stats(self):
+        return dict(self.counts)
+
+    def describe(self):
+        """
+        Describe the checks which change the embedding found for a single picture, empty if there are none.
+        The other checks depend on the other pictures of the dataset.
+        """
+        if not self.min_probability and not self.min_box_size:
+            return ''
+        return f'min_probability={self.min_probability},min_box_size={self.min_box_size}'
+
+    def is_full(self, count: int, max_per_person: int = None):
+        """
+        Whether a person with count faces kept takes no more pictures.
+        :param max_per_person: Overrides the max_per_person of the filter, for one read of a dataset.
+        """
+        if max_per_person is None:
+            max_per_person = self.max_per_person
+        return max_per_person is not None and count >= max_per_person
+
+    def skip_full(self, count: int, max_per_person: int = None):
+        if self.is_full(count, max_per_person):
+            self.counts['over_limit'] += 1
+            return True
+        return False
+
+    def is_duplicate(self, person, image: Image.Image):
+        """
+        Whether image is a near duplicate of a picture kept for person. If it is not, it is kept.
+        """
+        if self.dedup_distance is None:
+            return False
+        image_hash = dhash(image)
+        hashes = self.hashes[person]
+        if any(hamming(image_hash, kept) <= self.dedup_distance for kept in hashes):
+            self.counts['duplicates'] += 1
+            return True
+        hashes.append(image_hash)
+        return False
+
+    def accepts(self, box, probability):
+        """
+        Whether a face detected in box with probability is good enough to be embedded.
+        """
+        if probability is not None and probability < self.min_probability:
+            self.counts['low_quality'] += 1
+            return False
+        if box is not None and min(box[2] - box[0], box[3] - box[1]) < self.min_box_size:
+            self.counts['low_quality'] += 1
+            return False
+        return True
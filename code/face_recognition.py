@@ -2,18 +2,21 @@ import os.path
 from facenet_pytorch import MTCNN, InceptionResnetV1
 import torch
 from PIL import Image
-from datetime import datetime
-from torch.utils.data import DataLoader
+from collections import defaultdict
 
 from memory import Memory
 from images_dataset import ImageDataset
-from process import current_folder
+from process import current_folder, DecodePool
+from embedding_cache import EmbeddingCache
+from detector import detect_batch
+from face_writer import FaceWriter, open_writer
+from profiler import stage, observe
 
 
 def face_recognition(memory: Memory, device: torch.device, mtcnn: MTCNN, resnet: InceptionResnetV1, image: Image.Image,
                      multi_face: bool = False, save_detections: bool = False,
                      save_detections_path: str = os.path.join(current_folder(), "../record/"),
-                     threshold: float = 0.85):
+                     threshold: float = 0.85, image_name: str = None):
     """
     Recognize the faces in an image.
     :param memory: The memory of the program.
@@ -23,10 +26,11 @@ def face_recognition(memory: Memory, device: torch.device, mtcnn: MTCNN, resnet:
     :param image: The image to recognize. Only one image is permitted.
     :param multi_face: Whether to use multi-face recognition.
     :param save_detections: Whether to save the detected faces.
-    :param save_detections_path: The path to save the detected faces.
+    :param save_detections_path: The directory or the .tar archive to save the detected faces in, see FaceWriter.
     :param threshold: The threshold for face recognition. If the distance between the two faces is greater than the
                       threshold, the face is considered not possibly be this person. If cannot find any person for
                       the face, it is considered a stranger, or 'NOBODY'.
+    :param image_name: The name the saved faces are named after. By default the file name of the image, if known.
     :return: return a tensor of face recognition results. If n faces is detected, a tensor of face recognition results
              is a tensor whose length is n. The number in the tensor refers to the index of the person. For 'NOBODY',
              the number is -1.
@@ -40,6 +44,8 @@ def face_recognition(memory: Memory, device: torch.device, mtcnn: MTCNN, resnet:
     if mtcnn.device != device:
         raise Exception("The device is different than the mtcnn device.")
 
+    if image_name is None:
+        image_name = getattr(image, 'filename', None) or 'face'
     image = image.convert('RGB')
 
     mtcnn = mtcnn.eval()
@@ -47,39 +53,44 @@ def face_recognition(memory: Memory, device: torch.device, mtcnn: MTCNN, resnet:
 
     mtcnn.keep_all = multi_face
 
-    if save_detections:
-        path = os.path.join(save_detections_path, datetime.now().strftime("%Y-%m-%d-%H-%M-%S")+'.jpg')
-        faces = mtcnn(image, save_path=path)
-    else:
+    with stage('detect'):
         faces = mtcnn(image)
 
     if faces is None:
+        observe('faces_per_image', 0)
         return []
 
-    faces = faces.to(device)
-
     if not multi_face:
         faces = torch.unsqueeze(faces, 0)
+    observe('faces_per_image', len(faces))
 
-    embeddings = resnet(faces)
+    with open_writer(save_detections, save_detections_path) as writer:
+        if writer is not None:
+            with stage('save'):
+                writer.write_faces(faces, image_name, mtcnn.post_process)
 
-    distances = torch.cdist(embeddings, memory.get_embeddings(device), p=2)
-    min_distances, min_indices = torch.min(distances, dim=1)
-    min_indices[min_distances > threshold] = -1
+        with stage('embed'), torch.inference_mode():
+            embeddings = resnet(faces.to(device))
 
-    return memory.get_names(min_indices)
+        with stage('search'):
+            distances, indices = memory.search(embeddings, device)
+        min_distances, min_indices = distances[:, 0], indices[:, 0]
+        min_indices[min_distances > threshold] = -1
+
+        with stage('names'):
+            return memory.get_names(min_indices)
 
 
 def multi_faces_recognition(memory: Memory, device: torch.device, mtcnn: MTCNN, resnet: InceptionResnetV1,
                             images_dataset: ImageDataset, save_detections: bool = False,
                             save_detections_path: str = os.path.join(current_folder(), "../record/"),
-                            threshold: float = 0.85):
+                            threshold: float = 0.85, decode_pool: DecodePool = None, batch_size: int = 16):
     if not memory.is_initialized():
         raise Exception('Memory is not initialized.')
 
     if mtcnn.device != device:
         raise Exception("The device is different than the mtcnn device.")
-    dataloader = DataLoader(images_dataset, batch_size=16, collate_fn=collate_fn)
+    dataloader = images_dataset.batches(batch_size, decode_pool)
 
     mtcnn = mtcnn.eval()
     resnet = resnet.eval().to(device)
@@ -89,38 +100,285 @@ def multi_faces_recognition(memory: Memory, device: torch.device, mtcnn: MTCNN,
     all_names = []
     all_classes = []
 
-    for images, names in dataloader:
-        if save_detections:
-            path = [os.path.join(save_detections_path, datetime.now().strftime("%Y-%m-%d-%H-%M-%S") + f'{name}.jpg')
-                    for name in names]
-            faces = mtcnn(images, save_path=path)
-        else:
-            faces = mtcnn(images)
+    with open_writer(save_detections, save_detections_path) as writer:
+        for images, names in dataloader:
+            observe('batch_size', len(images))
+            with stage('detect'):
+                faces = detect_batch(mtcnn, images)
+            for face in faces:
+                observe('faces_per_image', 0 if face is None else 1)
 
-        faces = torch.stack(faces, dim=0).to(device)
+            # like the other modes, the pictures without a face are left out, and only the faces found are embedded
+            found = [i for i, face in enumerate(faces) if face is not None]
+            if len(found) == 0:
+                continue
 
-        embeddings = resnet(faces)
-        distances = torch.cdist(embeddings, memory.get_embeddings(device), p=2)
-        min_distances, min_indices = torch.min(distances, dim=1)
-        min_indices[min_distances > threshold] = -1
-        all_names.extend(names)
-        all_classes.extend(memory.get_names(min_indices))
+            faces = torch.stack([faces[i] for i in found], dim=0)
+            if writer is not None:
+                with stage('save'):
+                    for face, i in zip(faces, found):
+                        writer.write(face, names[i], 0, mtcnn.post_process)
+
+            with stage('embed'), torch.inference_mode():
+                embeddings = resnet(faces.to(device))
+            with stage('search'):
+                distances, indices = memory.search(embeddings, device)
+            min_distances, min_indices = distances[:, 0], indices[:, 0]
+            min_indices[min_distances > threshold] = -1
+            all_names.extend(names[i] for i in found)
+            with stage('names'):
+                all_classes.extend(memory.get_names(min_indices))
 
     return all_names, all_classes
 
 
-def collate_fn(batch):
-    images = [item[0] for item in batch]
-    filenames = [item[1] for item in batch]
-    return images, filenames
+def batch_face_recognition(memory: Memory, device: torch.device, mtcnn: MTCNN, resnet: InceptionResnetV1,
+                           images: list, multi_face=False, threshold=0.85, writer: FaceWriter = None,
+                           image_names: list = None, return_details: bool = False):
+    """
+    Recognize the faces in several images with one resnet forward pass.
+    The images can be different sizes. Images of the same size are detected by mtcnn together, and the faces of all
+    the images are embedded together.
+    :param memory: The memory of the program.
+    :param device: The device to use.
+    :param mtcnn: The mtcnn model.
+    :param resnet: The resnet model.
+    :param images: A list of PIL Images.
+    :param multi_face: Whether to use multi-face recognition. Either one bool for all images or a list with one bool
+                       for each image.
+    :param threshold: The threshold for face recognition. Either one float for all images or a list with one float
+                      for each image.
+    :param writer: The writer saving the detected faces, or None not to save them.
+    :param image_names: The names the saved faces of each image are named after.
+    :param return_details: Whether to describe every face rather than only name it.
+    :return: A list with the result of face_recognition for each image. With return_details, every face of the result
+             is a dict with its "name", its "box" [x1, y1, x2, y2] in the image, the "probability" of the detection
+             and the "distance" to the nearest person, whatever the threshold.
+    """
+    if not memory.is_initialized():
+        raise Exception('Memory is not initialized.')
+
+    if mtcnn.device != device:
+        raise Exception("The device is different than the mtcnn device.")
+
+    if isinstance(multi_face, bool):
+        multi_face = [multi_face] * len(images)
+    if isinstance(threshold, (int, float)):
+        threshold = [threshold] * len(images)
+
+    mtcnn = mtcnn.eval()
+    resnet = resnet.eval().to(device)
+
+    # with keep_all the largest face comes first, which is the face found without keep_all
+    mtcnn.keep_all = any(multi_face)
+
+    images = [image.convert('RGB') for image in images]
+    same_size = defaultdict(list)
+    for i, image in enumerate(images):
+        same_size[image.size].append(i)
+
+    observe('batch_size', len(images))
+    detected = [None] * len(images)
+    boxes = [None] * len(images)
+    probs = [None] * len(images)
+    for indices in same_size.values():
+        with stage('detect'):
+            faces_list, boxes_list, probs_list = detect_batch(mtcnn, [images[i] for i in indices], return_boxes=True)
+        for i, faces, image_boxes, image_probs in zip(indices, faces_list, boxes_list, probs_list):
+            if faces is not None:
+                if not mtcnn.keep_all:
+                    faces = faces.unsqueeze(0)
+                detected[i] = faces if multi_face[i] else faces[:1]
+                boxes[i], probs[i] = image_boxes, image_probs
+
+    counts = [0 if faces is None else len(faces) for faces in detected]
+    for count in counts:
+        observe('faces_per_image', count)
+    if sum(counts) == 0:
+        return [[] for _ in images]
+
+    if writer is not None:
+        with stage('save'):
+            for faces, name in zip(detected, image_names):
+                if faces is not None:
+                    writer.write_faces(faces, name, mtcnn.post_process)
+
+    faces = torch.cat([faces for faces in detected if faces is not None]).to(device)
+    with stage('embed'), torch.inference_mode():
+        embeddings = resnet(faces)
+
+    thresholds = torch.tensor([t for t, count in zip(threshold, counts) for _ in range(count)], device=device)
+    with stage('search'):
+        distances, indices = memory.search(embeddings, device)
+    min_distances, min_indices = distances[:, 0], indices[:, 0]
+    min_indices[min_distances > thresholds] = -1
+
+    with stage('names'):
+        names = memory.get_names(min_indices)
+    if return_details:
+        min_distances = min_distances.tolist()
+    results = []
+    start = 0
+    for i, count in enumerate(counts):
+        if return_details:
+            results.append([{'name': names[start + j], 'box': [float(x) for x in boxes[i][j]],
+                             'probability': float(probs[i][j]), 'distance': min_distances[start + j]}
+                            for j in range(count)])
+        else:
+            results.append(names[start:start + count])
+        start += count
+    return results
+
+
+def images_recognition(memory: Memory, device: torch.device, mtcnn: MTCNN, resnet: InceptionResnetV1,
+                       images_dataset: ImageDataset, same_size: bool = False, save_detections: bool = False,
+                       save_detections_path: str = os.path.join(current_folder(), "../record/"),
+                       threshold: float = 0.85, cache: EmbeddingCache = None, decode_pool: DecodePool = None,
+                       batch_size: int = 16):
+    """
+    Recognize the largest face of every image in a dataset.
+    The images are recognized in batches. Images of different sizes are detected separately, but their faces are
+    still embedded together.
+    :param memory: The memory of the program.
+    :param device: The device to use.
+    :param mtcnn: The mtcnn model.
+    :param resnet: The resnet model.
+    :param images_dataset: The images to recognize.
+    :param same_size: Whether all the images are the same size, which allows batch processing.
+    :param save_detections: Whether to save the detected faces.
+    :param save_detections_path: The directory or the .tar archive to save the detected faces in, see FaceWriter.
+    :param threshold: The threshold for face recognition.
+    :param cache: The cache of embeddings, which must have been created with the same models and rotation as the
+                  dataset. The faces of images found in the cache are not saved again.
+    :param decode_pool: The pool decoding the images ahead of recognition. By default the images are decoded one by
+                        one when they are needed.
+    :param batch_size: How many images are recognized together.
+    :return: The filenames of the images with a detected face, and the recognized name for each of them.
+    """
+    if cache is not None:
+        return cached_images_recognition(memory, device, mtcnn, resnet, images_dataset, cache, same_size,
+                                         save_detections, save_detections_path, threshold, batch_size, decode_pool)
+
+    if same_size:
+        return multi_faces_recognition(memory, device, mtcnn, resnet, images_dataset,
+                                       save_detections, save_detections_path, threshold, decode_pool, batch_size)
+
+    names = []
+    classes = []
+    with open_writer(save_detections, save_detections_path) as writer:
+        for images, filenames in images_dataset.batches(batch_size, decode_pool):
+            results = batch_face_recognition(memory, device, mtcnn, resnet, images, False, threshold, writer,
+                                             filenames)
+            for name, cls in zip(filenames, results):
+                if len(cls) > 0:
+                    names.append(name)
+                    classes.append(cls[0])
+
+    return names, classes
+
+
+def iter_images_recognition(memory: Memory, device: torch.device, mtcnn: MTCNN, resnet: InceptionResnetV1,
+                            images_dataset: ImageDataset, multi_face: bool = True, save_detections: bool = False,
+                            save_detections_path: str = os.path.join(current_folder(), "../record/"),
+                            threshold: float = 0.85, decode_pool: DecodePool = None, batch_size: int = 16):
+    """
+    Recognize the faces of every image in a dataset, yielding the results of each batch as soon as it is recognized,
+    so that large directories can be consumed while they are processed.
+    All the faces of a batch are embedded in one resnet forward pass and searched in the memory together.
+    :param multi_face: Whether to recognize every face of the images, or only the largest.
+    :return: A generator of (filename, faces) for every image, in which faces are the details of
+             batch_face_recognition, empty if no face is found.
+    """
+    with open_writer(save_detections, save_detections_path) as writer:
+        for images, filenames in images_dataset.batches(batch_size, decode_pool):
+            results = batch_face_recognition(memory, device, mtcnn, resnet, images, multi_face, threshold, writer,
+                                             filenames, return_details=True)
+            yield from zip(filenames, results)
+
+
+def cached_images_recognition(memory: Memory, device: torch.device, mtcnn: MTCNN, resnet: InceptionResnetV1,
+                              images_dataset: ImageDataset, cache: EmbeddingCache, same_size: bool = False,
+                              save_detections: bool = False,
+                              save_detections_path: str = os.path.join(current_folder(), "../record/"),
+                              threshold: float = 0.85, batch_size: int = 16, decode_pool: DecodePool = None):
+    """
+    images_recognition, but only the images missing in the cache are read and detected.
+    """
+    if not memory.is_initialized():
+        raise Exception('Memory is not initialized.')
+
+    if mtcnn.device != device:
+        raise Exception("The device is different than the mtcnn device.")
+
+    mtcnn = mtcnn.eval()
+    resnet = resnet.eval().to(device)
+
+    mtcnn.keep_all = False
+
+    found = []
+    misses = []
+    for idx, path in enumerate(images_dataset.image_paths):
+        with stage('cache'):
+            key = cache.key(path)
+            hit, embedding = cache.get(key)
+        if not hit:
+            misses.append((idx, key))
+        elif embedding is not None:
+            found.append((idx, embedding))
+
+    batches = images_dataset.batches(batch_size, decode_pool, [idx for idx, _ in misses])
+    with open_writer(save_detections, save_detections_path) as writer:
+        for start, (images, names) in zip(range(0, len(misses), batch_size), batches):
+            batch = misses[start:start + batch_size]
+            observe('batch_size', len(images))
+            with stage('detect'):
+                if same_size:
+                    faces = detect_batch(mtcnn, images)
+                else:
+                    faces = [mtcnn(image) for image in images]
+
+            detected = [(idx, key, face) for (idx, key), face in zip(batch, faces) if face is not None]
+            for (idx, key), face in zip(batch, faces):
+                observe('faces_per_image', 0 if face is None else 1)
+                if face is None:
+                    cache.put(key, None)
+            if len(detected) == 0:
+                continue
+
+            if writer is not None:
+                with stage('save'):
+                    for face, name in zip(faces, names):
+                        if face is not None:
+                            writer.write(face, name, 0, mtcnn.post_process)
+
+            with stage('embed'), torch.inference_mode():
+                embeddings = resnet(torch.stack([face for _, _, face in detected]).to(device)).cpu()
+            for (idx, key, _), embedding in zip(detected, embeddings):
+                cache.put(key, embedding)
+                found.append((idx, embedding))
+
+    if len(found) == 0:
+        return [], []
+
+    found.sort(key=lambda item: item[0])
+    embeddings = torch.stack([embedding for _, embedding in found])
+    with stage('search'):
+        distances, indices = memory.search(embeddings, device)
+    min_distances, min_indices = distances[:, 0], indices[:, 0]
+    min_indices[min_distances > threshold] = -1
+
+    names = [os.path.basename(images_dataset.image_paths[idx]) for idx, _ in found]
+    with stage('names'):
+        return names, memory.get_names(min_indices)
 
 
 if __name__ == '__main__':
     img = Image.open(os.path.join(current_folder(), '../test_pic/windy_on_train.jpg'))
     from process import handle_rotation
+    from embedding_backend import load_resnet
     img = handle_rotation(img)
     res = face_recognition(Memory.load_memory(), torch.device('cuda'), MTCNN(device=torch.device('cuda')),
-                     InceptionResnetV1(pretrained='vggface2'), img,
+                     load_resnet(torch.device('cuda')), img,
                      multi_face=False, save_detections=False)
 
     print(res)
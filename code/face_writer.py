@@ -0,0 +1,163 @@
+import io
+import os
+import time
+import tarfile
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+
+def face_image(face, post_process: bool = True):
+    """
+    The picture of a face cropped by mtcnn, as mtcnn saves it with save_path.
+    torch is not imported here, so that the command line can check the save path without importing it.
+    :param face: A face tensor returned by mtcnn, 3 x image_size x image_size.
+    :param post_process: Whether mtcnn standardized the face, see MTCNN.post_process.
+    """
+    if post_process:
+        face = face * 128 + 127.5
+    return Image.fromarray(face.round().clamp(0, 255).byte().permute(1, 2, 0).numpy())
+
+
+def is_archive(path: str):
+    return path.endswith('.tar')
+
+
+def valid_save_path(path: str):
+    """
+    Whether the faces can be saved in path: an existing directory, or a .tar archive in an existing directory.
+    """
+    if is_archive(path):
+        return os.path.isdir(os.path.dirname(os.path.abspath(path)))
+    return os.path.isdir(path)
+
+
+class FaceWriter:
+    """
+    Save the faces cropped by mtcnn in the background, so that encoding and writing them does not hold up
+    recognition. The faces are encoded and written by a pool of threads. At most queue_size faces wait to be written,
+    after which write blocks until the pool catches up.
+    A face is named after its picture and its index in the picture, "<picture>_<index>.jpg". A name already taken, by
+    an earlier run or by another picture with the same name, gets a number appended instead of being overwritten.
+    If path ends with .tar, the faces are appended to that archive instead of being written as separate files.
+    """
+
+    def __init__(self, path: str, workers: int = 2, queue_size: int = 64, quality: int = 75):
+        """
+        :param path: The directory, created if needed, or the .tar archive, created if needed.
+        :param workers: The number of threads encoding and writing the faces.
+        :param queue_size: The most faces waiting to be written.
+        :param quality: The JPEG quality, 75 is the default of PIL, with which mtcnn saves the faces.
+        """
+        self.path = path
+        self.quality = quality
+        self.archive = None
+        self.taken = set()
+        self.lock = threading.Lock()
+        self.errors = []
+        self.written = 0
+        if is_archive(path):
+            self.archive = tarfile.open(path, 'a')
+            self.taken.update(self.archive.getnames())
+        else:
+            os.makedirs(path, exist_ok=True)
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.executor = ThreadPoolExecutor(workers)
+
+    def write(self, face, image_name: str, index: int = 0, post_process: bool = True):
+        """
+        Queue one face to be saved.
+        :param face: A face tensor returned by mtcnn.
+        :param image_name: The name or the path of the picture the face was found in.
+        :param index: The index of the face in the picture.
+        :param post_process: Whether mtcnn standardized the face, see MTCNN.post_process.
+        """
+        # a copy, so that the batch the face comes from can be freed before the face is written
+        face = face.detach().to('cpu', copy=True)
+        stem = os.path.splitext(os.path.basename(image_name))[0]
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self._write, face, stem, index, post_process)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+
+    def write_faces(self, faces, image_name: str, post_process: bool = True):
+        """
+        Queue all the faces mtcnn found in a picture, with or without keep_all.
+        """
+        if faces.dim() == 3:
+            faces = faces.unsqueeze(0)
+        for index, face in enumerate(faces):
+            self.write(face, image_name, index, post_process)
+
+    def names(self, stem: str, index: int):
+        yield f'{stem}_{index}.jpg'
+        n = 1
+        while True:
+            yield f'{stem}_{index}-{n}.jpg'
+            n += 1
+
+    def _write(self, face, stem, index, post_process):
+        try:
+            buffer = io.BytesIO()
+            face_image(face, post_process).save(buffer, 'JPEG', quality=self.quality)
+            data = buffer.getvalue()
+            if self.archive is not None:
+                self._add(stem, index, data)
+            else:
+                self._save(stem, index, data)
+            with self.lock:
+                self.written += 1
+        except Exception as e:
+            with self.lock:
+                self.errors.append(e)
+
+    def _add(self, stem, index, data):
+        with self.lock:
+            name = next(name for name in self.names(stem, index) if name not in self.taken)
+            self.taken.add(name)
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def _save(self, stem, index, data):
+        for name in self.names(stem, index):
+            with self.lock:
+                if name in self.taken:
+                    continue
+                self.taken.add(name)
+            try:
+                # exclusive creation, so that the faces of an earlier run are never overwritten
+                with open(os.path.join(self.path, name), 'xb') as file:
+                    file.write(data)
+                return
+            except FileExistsError:
+                continue
+
+    def close(self):
+        """
+        Wait until all the faces are saved.
+        """
+        self.executor.shutdown(wait=True)
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+        if self.errors:
+            raise Exception(f'{len(self.errors)} faces could not be saved, the first error: {self.errors[0]}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_writer(save_detections: bool, path: str):
+    """
+    A FaceWriter saving in path if save_detections, else a context giving None.
+    """
+    return FaceWriter(path) if save_detections else nullcontext()
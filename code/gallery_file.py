@@ -0,0 +1,128 @@
+import os
+import json
+import struct
+import numpy as np
+import torch
+
+MAGIC = b'FGAL'
+VERSION = 2
+# files without prototypes are written as version 1, which older versions can still read
+BASE_VERSION = 1
+ALIGNMENT = 64
+# magic, version, length of the metadata
+HEADER = struct.Struct('<4sIQ')
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_gallery(path: str, names: list, embeddings: torch.Tensor, sums: torch.Tensor, counts: torch.Tensor,
+                  index=None, half: bool = False, prototypes: torch.Tensor = None, owners: torch.Tensor = None,
+                  max_prototypes: int = 0):
+    """
+    Write a gallery file. The file is
+    [header][metadata json][sections], and every section is a raw little-endian array aligned to 64 bytes:
+    embeddings (n, d) float32 or float16, sums (n, d) float32, counts (n,) float32, the names as one utf-8 string with
+    their (n + 1,) uint64 offsets, the centroids and assignments of the index if there is one, and the prototypes
+    (m, d) float32 and their (m,) int64 classes if there are any.
+    The file is written next to path and then renamed, so processes which mapped the old file keep it intact.
+    :param path: The path of the file.
+    :param names: The class name of every row.
+    :param embeddings: A (n, d) tensor of the mean embedding of every class.
+    :param sums: A (n, d) tensor of the sum of the embeddings of every class.
+    :param counts: A (n,) tensor of the number of embeddings of every class.
+    :param index: The IVFIndex of the embeddings, or None.
+    :param half: Whether to store the embeddings as float16, which halves the size of the file.
+    :param prototypes: A (m, d) tensor of the prototype embeddings of the classes, or None.
+    :param owners: A (m,) tensor of the class of every prototype.
+    :param max_prototypes: The most prototypes kept for a class.
+    """
+    encoded = [name.encode('utf-8') for name in names]
+    arrays = {
+        'embeddings': embeddings.detach().cpu().numpy().astype('<f2' if half else '<f4'),
+        'sums': sums.detach().cpu().numpy().astype('<f4'),
+        'counts': counts.detach().cpu().numpy().astype('<f4'),
+        'names': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+        'name_offsets': np.cumsum([0] + [len(name) for name in encoded], dtype='<u8'),
+    }
+    index_params = None
+    if index is not None:
+        arrays['centroids'] = index.centroids.numpy().astype('<f4')
+        arrays['assignments'] = index.assignments.numpy().astype('<i8')
+        index_params = {'n_lists': index.n_lists, 'n_probe': index.n_probe, 'iterations': index.iterations,
+                        'seed': index.seed}
+    if prototypes is not None:
+        arrays['prototypes'] = prototypes.detach().cpu().numpy().astype('<f4')
+        arrays['prototype_owners'] = owners.detach().cpu().numpy().astype('<i8')
+
+    sections = {}
+    offset = 0
+    for name, array in arrays.items():
+        sections[name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        offset = _align(offset + array.nbytes)
+    metadata = {'sections': sections, 'index': index_params}
+    if prototypes is not None:
+        metadata['max_prototypes'] = max_prototypes
+    metadata = json.dumps(metadata).encode('utf-8')
+    data_start = _align(HEADER.size + len(metadata))
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION if prototypes is not None else BASE_VERSION, len(metadata)))
+        file.write(metadata)
+        for name, array in arrays.items():
+            file.seek(data_start + sections[name]['offset'])
+            file.write(array.tobytes())
+    os.replace(temp_path, path)
+
+
+def is_gallery_file(path: str):
+    with open(path, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def read_gallery(path: str):
+    """
+    Map a gallery file written by write_gallery into memory without copying it.
+    The arrays are copy-on-write: reads share the page cache with every other process mapping the file, and writes
+    stay private to this process.
+    :return: A dict with names, embeddings, sums and counts, and the index params, centroids and assignments if the
+             file has an index, and the prototypes, their owners and max_prototypes if the file has prototypes.
+    """
+    with open(path, 'rb') as file:
+        magic, version, length = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC:
+            raise Exception(f'{path} is not a gallery file.')
+        if version > VERSION:
+            raise Exception(f'{path} is version {version}, only version {VERSION} and older are supported.')
+        metadata = json.loads(file.read(length))
+    data_start = _align(HEADER.size + length)
+
+    arrays = {}
+    for name, section in metadata['sections'].items():
+        shape = tuple(section['shape'])
+        if 0 in shape:
+            arrays[name] = np.zeros(shape, dtype=section['dtype'])
+        else:
+            arrays[name] = np.memmap(path, dtype=section['dtype'], mode='c', offset=data_start + section['offset'],
+                                     shape=shape)
+
+    name_bytes = arrays['names'].tobytes()
+    offsets = arrays['name_offsets'].tolist()
+    gallery = {
+        'names': [name_bytes[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)],
+        'embeddings': torch.from_numpy(arrays['embeddings']),
+        'sums': torch.from_numpy(arrays['sums']),
+        'counts': torch.from_numpy(arrays['counts']),
+        'index': metadata['index'],
+    }
+    if metadata['index'] is not None:
+        gallery['centroids'] = torch.from_numpy(arrays['centroids'])
+        gallery['assignments'] = torch.from_numpy(arrays['assignments'])
+    if 'prototypes' in arrays:
+        gallery['prototypes'] = torch.from_numpy(arrays['prototypes'])
+        gallery['prototype_owners'] = torch.from_numpy(arrays['prototype_owners'])
+        gallery['max_prototypes'] = metadata['max_prototypes']
+    return gallery
@@ -1,7 +1,7 @@
 import os
 from torch.utils.data import Dataset
 
-from process import load_image
+from process import load_image, DecodePool
 
 
 class ImageDataset(Dataset):
@@ -20,3 +20,33 @@ class ImageDataset(Dataset):
         image = load_image(img_path, self.rotation)
         filename = os.path.basename(img_path)
         return image, filename
+
+    def iterate(self, decode_pool: DecodePool = None, indices=None):
+        """
+        Iterate over (image, filename) like the dataset itself, with the images decoded by the decode pool.
+        :param decode_pool: The pool decoding the images. By default they are decoded one by one.
+        :param indices: The indices of the images to iterate over. All of them by default.
+        """
+        if decode_pool is None:
+            decode_pool = DecodePool()
+        if indices is None:
+            indices = range(len(self))
+        paths = [self.image_paths[idx] for idx in indices]
+        for path, image in zip(paths, decode_pool.map(paths, self.rotation)):
+            yield image, os.path.basename(path)
+
+    def batches(self, batch_size: int, decode_pool: DecodePool = None, indices=None):
+        """
+        Like iterate, but yield lists of at most batch_size images and their filenames.
+        """
+        images = []
+        filenames = []
+        for image, filename in self.iterate(decode_pool, indices):
+            images.append(image)
+            filenames.append(filename)
+            if len(images) == batch_size:
+                yield images, filenames
+                images = []
+                filenames = []
+        if len(images) > 0:
+            yield images, filenames
@@ -1,17 +1,39 @@
 import os
+import atexit
 import argparse
-from facenet_pytorch import MTCNN, InceptionResnetV1
-import torch
 
-from memory import Memory
-from read_dataset import read_dataset
-from face_recognition import face_recognition, multi_faces_recognition
-from process import load_image, resize_images, current_folder
-from images_dataset import ImageDataset
+# only the modules the command line needs to parse its arguments and to forward commands are imported here, every
+# command imports the rest, so that commands which do not need torch never import it
+from process import current_folder, file_version
+from defaults import BACKENDS, EMBEDDING_CACHE_PATH, MEMORY_PATH, LEGACY_MEMORY_PATH
+from face_writer import valid_save_path
+from results_output import ResultsWriter, OUTPUT_FORMATS
+from profiler import PROFILER
+from server_client import server_available, server_settings, mismatched_settings, reload_server, forward, \
+    parse_address, DEFAULT_HOST, DEFAULT_PORT
+
+
+def add_detector_arguments(parser):
+    parser.add_argument("-ds", "--detect-size", type=int, default=None,
+                        help="Downscale pictures to this longest side before detecting faces")
+    parser.add_argument("-mfs", "--min-face-size", type=int, default=20,
+                        help="Smallest face detected, in pixels of the picture detected")
+    parser.add_argument("-pyf", "--pyramid-factor", type=float, default=0.709,
+                        help="Scale factor between the levels of the detection pyramid, smaller is faster")
+    parser.add_argument("-fd", "--fast-detect", type=int, nargs="?", const=320, default=None,
+                        help="Detect first on pictures downscaled to this longest side, and normally only if no "
+                             "face is found")
 
 
 def argparse_process():
     parser = argparse.ArgumentParser(description='Face Recognition')
+    # upper case, as the options of the commands, such as serve -p, must not be prefixes of these
+    parser.add_argument("-P", "--profile", action='store_true',
+                        help="Print where the time goes when the command ends")
+    parser.add_argument("-PO", "--profile-output", type=str, default=None,
+                        help="Also save the profile to this file, as JSON if it ends with .json, else for Prometheus")
+    parser.add_argument("-TP", "--torch-profile", type=str, default=None,
+                        help="Run torch.profiler and save its trace in this directory for TensorBoard")
     subparsers = parser.add_subparsers(dest="command")
 
     init_parser = subparsers.add_parser("init", help="Initialize the database")
@@ -23,6 +45,56 @@ def argparse_process():
     init_parser.add_argument("-sg", "--single", action='store_true',
                              help="Read only one picture for each class")
     init_parser.add_argument("-c", "--cpu", action='store_true', help="Use CPU")
+    init_parser.add_argument("-eb", "--embedding-backend", type=str, choices=BACKENDS, default="eager",
+                             help="How the embeddings are computed, quantized always runs on CPU")
+    add_detector_arguments(init_parser)
+    init_parser.add_argument("-bs", "--batch-size", type=int, default=32,
+                             help="Number of pictures read at a time, which bounds the memory used")
+    init_parser.add_argument("-dw", "--decode-workers", type=int, default=0,
+                             help="Number of workers decoding pictures ahead of recognition")
+    init_parser.add_argument("-dp", "--decode-processes", action='store_true',
+                             help="Decode in processes instead of threads")
+    init_parser.add_argument("-pf", "--prefetch", type=int, default=None,
+                             help="Pictures decoded ahead, twice the decode workers by default")
+    init_parser.add_argument("-ec", "--embedding-cache", type=str, nargs="?", const=EMBEDDING_CACHE_PATH,
+                             help="Cache the embeddings of the pictures, so unchanged pictures are not read again")
+    init_parser.add_argument("-cs", "--cache-size", type=int, default=100000,
+                             help="Most pictures kept in the embedding cache")
+    init_parser.add_argument("-pt", "--prototypes", type=int, default=0,
+                             help="Match up to this many embeddings of every person instead of their mean, "
+                                  "0 matches the mean only")
+    init_parser.add_argument("-dd", "--dedup", type=int, nargs="?", const=4, default=None,
+                             help="Skip pictures of a person whose hash is at most this many bits from a picture "
+                                  "already read for them")
+    init_parser.add_argument("-mpb", "--min-probability", type=float, default=0.0,
+                             help="Skip faces detected with a lower probability")
+    init_parser.add_argument("-mbs", "--min-box-size", type=int, default=0,
+                             help="Skip faces whose box is smaller than this many pixels on its shorter side")
+    init_parser.add_argument("-mpp", "--max-per-person", type=int, default=None,
+                             help="Embed at most this many faces of every person")
+
+    enroll_parser = subparsers.add_parser("enroll", help="Add pictures of one person to the database")
+    enroll_parser.add_argument("name", type=str, help="Name of the person")
+    enroll_parser.add_argument("paths", type=str, nargs="+", help="Paths to pictures or directories of pictures")
+    enroll_parser.add_argument("-r", "--rotation", action='store_true',
+                               help="Handle the EXIF rotation")
+    enroll_parser.add_argument("-c", "--cpu", action='store_true', help="Use CPU")
+    enroll_parser.add_argument("-eb", "--embedding-backend", type=str, choices=BACKENDS, default="eager",
+                               help="How the embeddings are computed, quantized always runs on CPU")
+    add_detector_arguments(enroll_parser)
+
+    update_parser = subparsers.add_parser("update", help="Replace the pictures of one person in the database")
+    update_parser.add_argument("name", type=str, help="Name of the person")
+    update_parser.add_argument("paths", type=str, nargs="+", help="Paths to pictures or directories of pictures")
+    update_parser.add_argument("-r", "--rotation", action='store_true',
+                               help="Handle the EXIF rotation")
+    update_parser.add_argument("-c", "--cpu", action='store_true', help="Use CPU")
+    update_parser.add_argument("-eb", "--embedding-backend", type=str, choices=BACKENDS, default="eager",
+                               help="How the embeddings are computed, quantized always runs on CPU")
+    add_detector_arguments(update_parser)
+
+    remove_parser = subparsers.add_parser("remove", help="Remove one person from the database")
+    remove_parser.add_argument("name", type=str, help="Name of the person")
 
     rec_parser = subparsers.add_parser("rec", help="Recognize one picture")
     rec_parser.add_argument("filepath", type=str, help="Path to the picture")
@@ -32,23 +104,108 @@ def argparse_process():
                              help="Handle the EXIF rotation")
     rec_parser.add_argument("-sf", "--save-faces", type=str, nargs="?",
                             const=os.path.join(current_folder(), "../record"),
-                            help="save detected faces")
+                            help="save detected faces, in a directory or in a .tar archive")
     rec_parser.add_argument("-c", "--cpu", action='store_true', help="Use CPU")
+    rec_parser.add_argument("-eb", "--embedding-backend", type=str, choices=BACKENDS, default="eager",
+                            help="How the embeddings are computed, quantized always runs on CPU")
+    add_detector_arguments(rec_parser)
+    rec_parser.add_argument("-sw", "--search-workers", type=int, default=0,
+                            help="Processes searching the memory in parallel, each a shard of the persons")
     rec_parser.add_argument("-th", "--threshold", type=float, default=0.85,
                             help="Threshold for detecting faces")
+    rec_parser.add_argument("-sv", "--server", type=str, default=f"{DEFAULT_HOST}:{DEFAULT_PORT}",
+                            help="Address of the recognition server to forward to if it is running")
+    rec_parser.add_argument("-ns", "--no-server", action='store_true',
+                            help="Never forward to a recognition server")
 
     rec_all_parser = subparsers.add_parser("rec_all", help="Recognize all pictures in one directory")
     rec_all_parser.add_argument("filepath", type=str, help="Path to the directory")
     rec_all_parser.add_argument("-ss", "--same-size", action='store_true',
                                 help="Use quicker recognition mode if all your pictures are same size")
+    rec_all_parser.add_argument("-m", "--multi-faces", action='store_true',
+                                help="Recognize every face of the pictures rather than the largest")
+    rec_all_parser.add_argument("-o", "--output", type=str, default=None,
+                                help="Write the faces with their boxes, probabilities and distances to this file as "
+                                     "they are recognized, - for the standard output")
+    rec_all_parser.add_argument("-of", "--output-format", type=str, choices=OUTPUT_FORMATS, default=None,
+                                help="Format of the output, csv if the output ends with .csv and jsonl otherwise")
     rec_all_parser.add_argument("-r", "--rotation", action='store_true',
                                 help="Handle the EXIF rotation")
     rec_all_parser.add_argument("-sf", "--save-faces", type=str, nargs="?",
                                 const=os.path.join(current_folder(), "../record"),
-                                help="save detected faces")
+                                help="save detected faces, in a directory or in a .tar archive")
     rec_all_parser.add_argument("-c", "--cpu", action='store_true', help="Use CPU")
+    rec_all_parser.add_argument("-eb", "--embedding-backend", type=str, choices=BACKENDS, default="eager",
+                                help="How the embeddings are computed, quantized always runs on CPU")
+    add_detector_arguments(rec_all_parser)
+    rec_all_parser.add_argument("-sw", "--search-workers", type=int, default=0,
+                                help="Processes searching the memory in parallel, each a shard of the persons")
     rec_all_parser.add_argument("-th", "--threshold", type=float, default=0.85,
                                 help="Threshold for detecting faces")
+    rec_all_parser.add_argument("-bs", "--batch-size", type=int, default=16,
+                                help="Number of pictures recognized together, whatever their sizes")
+    rec_all_parser.add_argument("-dw", "--decode-workers", type=int, default=0,
+                                help="Number of workers decoding pictures ahead of recognition")
+    rec_all_parser.add_argument("-dp", "--decode-processes", action='store_true',
+                                help="Decode in processes instead of threads")
+    rec_all_parser.add_argument("-pf", "--prefetch", type=int, default=None,
+                                help="Pictures decoded ahead, twice the decode workers by default")
+    rec_all_parser.add_argument("-ec", "--embedding-cache", type=str, nargs="?", const=EMBEDDING_CACHE_PATH,
+                                help="Cache the embeddings of the pictures, so unchanged pictures are not read again")
+    rec_all_parser.add_argument("-cs", "--cache-size", type=int, default=100000,
+                                help="Most pictures kept in the embedding cache")
+    rec_all_parser.add_argument("-sv", "--server", type=str, default=f"{DEFAULT_HOST}:{DEFAULT_PORT}",
+                                help="Address of the recognition server to forward to if it is running")
+    rec_all_parser.add_argument("-ns", "--no-server", action='store_true',
+                                help="Never forward to a recognition server")
+
+    rec_stream_parser = subparsers.add_parser("rec_stream", help="Recognize the faces of a video or a camera")
+    rec_stream_parser.add_argument("source", type=str,
+                                   help="Camera index, video file, stream URL, or directory of frames")
+    rec_stream_parser.add_argument("-n", "--detect-every", type=int, default=5,
+                                   help="Detect faces on one frame out of n, and track them in between")
+    rec_stream_parser.add_argument("-cd", "--confidence-drop", type=float, default=0.05,
+                                   help="Drop of detection confidence after which a tracked face is recognized again")
+    rec_stream_parser.add_argument("-r", "--rotation", action='store_true',
+                                   help="Handle the EXIF rotation of a directory of frames")
+    rec_stream_parser.add_argument("-c", "--cpu", action='store_true', help="Use CPU")
+    rec_stream_parser.add_argument("-eb", "--embedding-backend", type=str, choices=BACKENDS, default="eager",
+                                   help="How the embeddings are computed, quantized always runs on CPU")
+    add_detector_arguments(rec_stream_parser)
+    rec_stream_parser.add_argument("-sw", "--search-workers", type=int, default=0,
+                                   help="Processes searching the memory in parallel, each a shard of the persons")
+    rec_stream_parser.add_argument("-th", "--threshold", type=float, default=0.85,
+                                   help="Threshold for detecting faces")
+
+    serve_parser = subparsers.add_parser("serve", help="Keep the models loaded and serve recognition requests")
+    serve_parser.add_argument("-H", "--host", type=str, default=DEFAULT_HOST, help="Host to listen on")
+    serve_parser.add_argument("-p", "--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+    serve_parser.add_argument("-c", "--cpu", action='store_true', help="Use CPU")
+    serve_parser.add_argument("-eb", "--embedding-backend", type=str, choices=BACKENDS, default="eager",
+                              help="How the embeddings are computed, quantized always runs on CPU")
+    add_detector_arguments(serve_parser)
+    serve_parser.add_argument("-sw", "--search-workers", type=int, default=0,
+                              help="Processes searching the memory in parallel, each a shard of the persons")
+    serve_parser.add_argument("-bs", "--max-batch-size", type=int, default=16,
+                              help="Most images recognized together in one batch")
+    serve_parser.add_argument("-w", "--max-wait", type=float, default=10,
+                              help="Milliseconds a request waits for others to join its batch")
+
+    index_parser = subparsers.add_parser("index", help="Build an approximate search index for large memories")
+    index_parser.add_argument("-l", "--lists", type=int, default=None,
+                              help="Number of clusters of the index, 4 * sqrt(number of persons) by default")
+    index_parser.add_argument("-np", "--probe", type=int, default=8,
+                              help="Number of clusters searched for every face")
+    index_parser.add_argument("-d", "--drop", action='store_true',
+                              help="Drop the index and search all persons again")
+
+    migrate_parser = subparsers.add_parser("migrate", help="Convert a memory file to the current format")
+    migrate_parser.add_argument("-s", "--source", type=str, default=LEGACY_MEMORY_PATH,
+                                help="Path to the memory to convert, either format")
+    migrate_parser.add_argument("-o", "--output", type=str, default=MEMORY_PATH,
+                                help="Path to save the converted memory")
+    migrate_parser.add_argument("-hf", "--half", action='store_true',
+                                help="Save the embeddings as float16, which halves the size of the file")
 
     resize_parser = subparsers.add_parser("resize", help="Resize pictures in a directory")
     resize_parser.add_argument("width", type=int, help="Width of output picture")
@@ -57,11 +214,19 @@ def argparse_process():
     resize_parser.add_argument("output_directory", type=str, help="Path to the output directory")
     resize_parser.add_argument("-r", "--rotation", action='store_true',
                                help="Handle the EXIF rotation")
+    resize_parser.add_argument("-w", "--workers", type=int, default=None,
+                               help="Processes resizing pictures in parallel, the number of cores by default")
+    resize_parser.add_argument("-q", "--quality", type=int, default=90, help="Quality of JPEG outputs, 1 to 95")
+    resize_parser.add_argument("-rc", "--recursive", action='store_true', help="Also resize the subdirectories")
+    resize_parser.add_argument("-f", "--force", action='store_true',
+                               help="Resize all pictures, even those whose output is newer than them")
 
     return parser.parse_args()
 
 
 def get_device(cpu=False):
+    import torch
+
     if cpu:
         return torch.device('cpu')
     if torch.cuda.is_available():
@@ -70,26 +235,189 @@ def get_device(cpu=False):
         return torch.device('cpu')
 
 
-def get_mtcnn(device):
-    return MTCNN(device=device)
+def get_mtcnn(device, detect_size=None, min_face_size=20, factor=0.709, fast_size=None):
+    from detector import FaceDetector
+
+    return FaceDetector(detect_size, fast_size, device=device, min_face_size=min_face_size, factor=factor)
+
+
+def get_resnet(device, backend='eager'):
+    from embedding_backend import create_backend, load_resnet
+
+    return create_backend(backend, load_resnet(device), device)
 
 
-def get_resnet(device):
-    return InceptionResnetV1(device=device, pretrained='vggface2')
+def get_cache(path, size, mtcnn, resnet, rotation, enrollment_filter=None):
+    if path is None:
+        return None
+    from embedding_cache import EmbeddingCache
+
+    return EmbeddingCache(path, size, EmbeddingCache.describe_settings(mtcnn, resnet, rotation, enrollment_filter))
+
+
+def recognition_settings(args):
+    """
+    The options of rec, rec_all and serve which change the faces found and the names given to them, or where they are
+    computed. A running server only takes requests asking for its own settings, see server.RecognitionServer.
+    The device and the search workers are only compared when they are asked for.
+    """
+    settings = {"embedding_backend": args.embedding_backend, "detect_size": args.detect_size,
+                "min_face_size": args.min_face_size, "pyramid_factor": args.pyramid_factor,
+                "fast_detect": args.fast_detect}
+    if args.cpu:
+        settings["device"] = "cpu"
+    if args.search_workers > 0:
+        settings["search_workers"] = args.search_workers
+    return settings
+
+
+def runs_here(args):
+    """
+    Whether the options are about this process itself, profiling it or decoding in its workers, so that the command
+    is never forwarded to a server.
+    """
+    if PROFILER.enabled:
+        return True
+    return args.command == "rec_all" and (args.decode_workers > 0 or args.decode_processes
+                                          or args.prefetch is not None)
+
+
+def notify_server():
+    """
+    Make a server running on the default address answer from the memory just saved, and say so. The server would
+    otherwise only load it on its next request.
+    """
+    if not server_available(DEFAULT_HOST, DEFAULT_PORT):
+        return
+    result = reload_server(DEFAULT_HOST, DEFAULT_PORT)
+    if result is not None and result.get("memory") == list(file_version(MEMORY_PATH)):
+        print(f"The server on {DEFAULT_HOST}:{DEFAULT_PORT} now answers from the new memory.")
+    else:
+        print(f"The server on {DEFAULT_HOST}:{DEFAULT_PORT} will load the new memory on its next request.")
+
+
+def start_profiling(summary=True, output=None, trace_directory=None):
+    """
+    Profile the run, and report the profile when the program exits, whichever way it exits.
+    """
+    PROFILER.enable(summary or output is not None)
+    trace = PROFILER.trace(trace_directory) if trace_directory is not None else None
+
+    def report():
+        if trace is not None:
+            trace.stop()
+        if summary:
+            print(PROFILER.summary())
+        if output is not None:
+            PROFILER.export(output)
+
+    atexit.register(report)
+
+
+def print_cache_stats(cache):
+    if cache is not None:
+        stats = cache.stats()
+        print(f"embedding cache: {stats['hits']} hit(s), {stats['misses']} miss(es), "
+              f"{stats['evictions']} eviction(s), {stats['entries']} entries")
 
 
 if __name__ == '__main__':
     args = argparse_process()
 
+    if args.profile or args.profile_output is not None or args.torch_profile is not None:
+        start_profiling(args.profile, args.profile_output, args.torch_profile)
+
     if args.command == "resize":
+        from process import resize_images
+
         try:
-            resize_images(args.input_directory, args.output_directory, (args.width, args.height), args.rotation)
+            stats = resize_images(args.input_directory, args.output_directory, (args.width, args.height),
+                                  args.rotation, args.workers, args.quality, args.recursive, args.force)
         except Exception as e:
             print("resize failed")
             print(e)
             exit(1)
+
+        seconds = max(stats['seconds'], 1e-9)
+        print(f"{stats['resized']} picture(s) resized, {stats['skipped']} up to date, {len(stats['failed'])} failed "
+              f"in {stats['seconds']:.2f}s: {stats['resized'] / seconds:.1f} pictures/s, "
+              f"{stats['bytes_read'] / seconds / 2 ** 20:.1f}MB/s read, "
+              f"{stats['bytes_written'] / seconds / 2 ** 20:.1f}MB/s written")
+        if stats['failed']:
+            print("resize failed for:")
+            for path, error in stats['failed']:
+                print(f"{path}: {error}")
+            exit(1)
+        exit(0)
+
+    if args.command == "migrate":
+        from memory import Memory
+        from gallery_file import is_gallery_file
+
+        try:
+            if is_gallery_file(args.source):
+                memory = Memory.load(args.source)
+            else:
+                memory = Memory.load_legacy(args.source)
+            if not memory.is_initialized():
+                print("Not initialized")
+                exit(25)
+            memory.half = args.half
+            memory.save(args.output)
+        except Exception as e:
+            print("migrate failed:")
+            print(e)
+            exit(26)
+        if os.path.abspath(args.output) == os.path.abspath(MEMORY_PATH):
+            notify_server()
         exit(0)
 
+    # the server answers rec_all with one name per picture, so the faces of every picture are recognized here
+    detailed = args.command == "rec_all" and (args.multi_faces or args.output is not None)
+    if args.command in ("rec", "rec_all") and not args.no_server and not detailed and not runs_here(args):
+        host, port = parse_address(args.server)
+        settings = recognition_settings(args)
+        if os.path.exists(MEMORY_PATH):
+            # the server must answer from the memory file this command would read
+            settings["memory"] = list(file_version(MEMORY_PATH))
+        server = server_settings(host, port)
+        mismatched = mismatched_settings(settings, server) if server is not None else []
+        if mismatched:
+            print(f"The server on {host}:{port} runs with other {', '.join(mismatched)}, recognizing here instead.")
+        if server is not None and not mismatched:
+            save_faces_path = os.path.abspath(args.save_faces) if args.save_faces is not None else None
+            if save_faces_path is not None and not valid_save_path(save_faces_path):
+                print(f"Save faces path {save_faces_path} not exist or is not a directory or a .tar archive.")
+                exit(5 if args.command == "rec" else 10)
+            payload = {"filepath": os.path.abspath(args.filepath), "rotation": args.rotation,
+                       "save_faces": save_faces_path, "threshold": args.threshold, "settings": settings}
+            if args.command == "rec":
+                payload["multi_faces"] = args.multi_faces
+            else:
+                payload["same_size"] = args.same_size
+                payload["batch_size"] = args.batch_size
+                if args.embedding_cache is not None:
+                    payload["cache"] = os.path.abspath(args.embedding_cache)
+                    payload["cache_size"] = args.cache_size
+
+            try:
+                result = forward(args.command, payload, host, port)
+            except Exception as e:
+                print("face recognition failed:" if args.command == "rec" else "faces recognition failed:")
+                print(e)
+                exit(7 if args.command == "rec" else 13)
+
+            if args.command == "rec":
+                print("detected face(s):")
+                for i, name in enumerate(result["names"]):
+                    print(f"{i}: {name}")
+            else:
+                for name, cls in zip(result["names"], result["classes"]):
+                    print(f"{name}: {cls}")
+            exit(0)
+
+    from memory import Memory
+
     try:
         memory = Memory.load_memory()
     except Exception as e:
@@ -97,28 +425,126 @@ if __name__ == '__main__':
         print(e)
         exit(2)
 
+    if args.command in ("rec", "rec_all", "rec_stream", "serve") and args.search_workers > 0 \
+            and memory.is_initialized():
+        try:
+            memory.use_shards(args.search_workers)
+        except Exception as e:
+            print("start search workers failed:")
+            print(e)
+            exit(29)
+
     if args.command == "init":
+        from read_dataset import read_dataset
+        from enrollment_filter import EnrollmentFilter
+        from process import DecodePool
+
         device = get_device(args.cpu)
-        mtcnn = get_mtcnn(device)
-        resnet = get_resnet(device)
+        mtcnn = get_mtcnn(device, args.detect_size, args.min_face_size, args.pyramid_factor, args.fast_detect)
+        try:
+            resnet = get_resnet(device, args.embedding_backend)
+        except Exception as e:
+            print("load resnet failed:")
+            print(e)
+            exit(32)
         dataset_path = args.filepath
         exif_rotation = args.rotation
         single_picture = args.single
+        enrollment_filter = EnrollmentFilter(args.dedup, args.min_probability, args.min_box_size,
+                                             args.max_per_person)
 
         try:
-            read_dataset(memory, device, mtcnn, resnet, dataset_path, single_picture, exif_rotation)
+            cache = get_cache(args.embedding_cache, args.cache_size, mtcnn, resnet, exif_rotation,
+                              enrollment_filter)
+        except Exception as e:
+            print("open embedding cache failed:")
+            print(e)
+            exit(24)
+
+        decode_pool = DecodePool(args.decode_workers, args.decode_processes, args.prefetch)
+        try:
+            read_dataset(memory, device, mtcnn, resnet, dataset_path, single_picture, exif_rotation, cache,
+                         args.batch_size, decode_pool, args.prototypes, enrollment_filter)
         except Exception as e:
             print("read dataset failed:")
             print(e)
             exit(3)
+        finally:
+            decode_pool.close()
+            if cache is not None:
+                cache.close()
+        print_cache_stats(cache)
+        skipped = enrollment_filter.stats()
+        if any(skipped.values()):
+            print(f"skipped: {skipped['duplicates']} near duplicate(s), {skipped['low_quality']} poor face(s), "
+                  f"{skipped['over_limit']} picture(s) over the limit per person")
+        notify_server()
+
+    if args.command in ("enroll", "update"):
+        if args.command == "update" and (not memory.is_initialized() or args.name not in memory.class_to_idx):
+            print(f"{args.name} is not known")
+            exit(19)
+        from read_dataset import embed_images
+        from process import list_images
+
+        device = get_device(args.cpu)
+        mtcnn = get_mtcnn(device, args.detect_size, args.min_face_size, args.pyramid_factor, args.fast_detect)
+        try:
+            resnet = get_resnet(device, args.embedding_backend)
+        except Exception as e:
+            print("load resnet failed:")
+            print(e)
+            exit(32)
+
+        try:
+            image_paths = list_images(args.paths)
+        except Exception as e:
+            print("load images failed:")
+            print(e)
+            exit(20)
+
+        if len(image_paths) == 0:
+            print("No images")
+            exit(21)
+
+        try:
+            embeddings = embed_images(device, mtcnn, resnet, image_paths, args.rotation)
+            if args.command == "enroll":
+                memory.enroll(args.name, embeddings)
+            else:
+                memory.update(args.name, embeddings)
+        except Exception as e:
+            print(f"{args.command} failed:")
+            print(e)
+            exit(22)
+
+        print(f"{len(embeddings)} of {len(image_paths)} picture(s) of {args.name} read")
+        notify_server()
+
+    if args.command == "remove":
+        try:
+            memory.remove(args.name)
+        except Exception as e:
+            print("remove failed:")
+            print(e)
+            exit(23)
+        notify_server()
 
     if args.command == "rec":
         if not memory.is_initialized():
             print("Not initialized")
             exit(4)
+        from face_recognition import face_recognition
+        from process import load_image
+
         device = get_device(args.cpu)
-        mtcnn = get_mtcnn(device)
-        resnet = get_resnet(device)
+        mtcnn = get_mtcnn(device, args.detect_size, args.min_face_size, args.pyramid_factor, args.fast_detect)
+        try:
+            resnet = get_resnet(device, args.embedding_backend)
+        except Exception as e:
+            print("load resnet failed:")
+            print(e)
+            exit(32)
         filepath = args.filepath
         rotation = args.rotation
         multi_faces = args.multi_faces
@@ -126,8 +552,8 @@ if __name__ == '__main__':
         save_faces_path = args.save_faces
         threshold = args.threshold
 
-        if save_faces and not os.path.isdir(save_faces_path):
-            print(f"Save faces path {save_faces_path} not exist or is not a directory.")
+        if save_faces and not valid_save_path(save_faces_path):
+            print(f"Save faces path {save_faces_path} not exist or is not a directory or a .tar archive.")
             exit(5)
 
         try:
@@ -139,7 +565,7 @@ if __name__ == '__main__':
 
         try:
             names = face_recognition(memory, device, mtcnn, resnet, img, multi_faces,
-                                     save_faces, save_faces_path, threshold)
+                                     save_faces, save_faces_path, threshold, filepath)
         except Exception as e:
             print("face recognition failed:")
             print(e)
@@ -153,9 +579,18 @@ if __name__ == '__main__':
         if not memory.is_initialized():
             print("Not initialized")
             exit(8)
+        from face_recognition import images_recognition, iter_images_recognition
+        from images_dataset import ImageDataset
+        from process import DecodePool
+
         device = get_device(args.cpu)
-        mtcnn = get_mtcnn(device)
-        resnet = get_resnet(device)
+        mtcnn = get_mtcnn(device, args.detect_size, args.min_face_size, args.pyramid_factor, args.fast_detect)
+        try:
+            resnet = get_resnet(device, args.embedding_backend)
+        except Exception as e:
+            print("load resnet failed:")
+            print(e)
+            exit(32)
         filepath = args.filepath
         same_size = args.same_size
         rotation = args.rotation
@@ -167,8 +602,8 @@ if __name__ == '__main__':
             print(f"filepath {filepath} not exist or is not a directory")
             exit(9)
 
-        if save_faces and not os.path.isdir(save_faces_path):
-            print(f"Save faces path {save_faces_path} not exist or is not a directory")
+        if save_faces and not valid_save_path(save_faces_path):
+            print(f"Save faces path {save_faces_path} not exist or is not a directory or a .tar archive")
             exit(10)
 
         try:
@@ -182,29 +617,135 @@ if __name__ == '__main__':
             print("No images")
             exit(12)
 
-        if same_size:
+        if detailed:
+            if args.embedding_cache is not None:
+                print("The embedding cache cannot be used with --multi-faces or --output")
+                exit(30)
+            try:
+                output = ResultsWriter(args.output, args.output_format) if args.output is not None else None
+            except Exception as e:
+                print(f"open output {args.output} failed:")
+                print(e)
+                exit(31)
+
+            decode_pool = DecodePool(args.decode_workers, args.decode_processes, args.prefetch)
             try:
-                names, classes = multi_faces_recognition(memory, device, mtcnn, resnet, images,
-                                                         save_faces, save_faces_path, threshold)
+                for name, faces in iter_images_recognition(memory, device, mtcnn, resnet, images, args.multi_faces,
+                                                           save_faces, save_faces_path, threshold, decode_pool,
+                                                           args.batch_size):
+                    if output is not None:
+                        output.write(name, faces)
+                    elif len(faces) > 0:
+                        print(f"{name}: {', '.join(face['name'] for face in faces)}")
             except Exception as e:
                 print("faces recognition failed:")
                 print(e)
-                exit(13)
-        else:
-            names = []
-            classes = []
-
-            for image, name in images:
-                try:
-                    cls = face_recognition(memory, device, mtcnn, resnet, image, False,
-                                           save_faces, save_faces_path, threshold)
-                except Exception as e:
-                    print("faces recognition failed:")
-                    print(e)
-                    exit(14)
-                if cls is not None and len(cls) > 0:
-                    names.append(name)
-                    classes.append(cls[0])
+                exit(14)
+            finally:
+                decode_pool.close()
+                if output is not None:
+                    output.close()
+
+            if output is not None and args.output != '-':
+                print(f"{output.faces} faces in {output.images} pictures written to {args.output}")
+            exit(0)
+
+        try:
+            cache = get_cache(args.embedding_cache, args.cache_size, mtcnn, resnet, rotation)
+        except Exception as e:
+            print("open embedding cache failed:")
+            print(e)
+            exit(24)
+
+        decode_pool = DecodePool(args.decode_workers, args.decode_processes, args.prefetch)
+        try:
+            names, classes = images_recognition(memory, device, mtcnn, resnet, images, same_size,
+                                                save_faces, save_faces_path, threshold, cache, decode_pool,
+                                                args.batch_size)
+        except Exception as e:
+            print("faces recognition failed:")
+            print(e)
+            exit(13 if same_size else 14)
+        finally:
+            decode_pool.close()
+            if cache is not None:
+                cache.close()
 
         for name, cls in zip(names, classes):
             print(f"{name}: {cls}")
+        print_cache_stats(cache)
+
+    if args.command == "rec_stream":
+        if not memory.is_initialized():
+            print("Not initialized")
+            exit(27)
+        from stream import StreamRecognizer, read_frames
+
+        device = get_device(args.cpu)
+        mtcnn = get_mtcnn(device, args.detect_size, args.min_face_size, args.pyramid_factor, args.fast_detect)
+        try:
+            resnet = get_resnet(device, args.embedding_backend)
+        except Exception as e:
+            print("load resnet failed:")
+            print(e)
+            exit(32)
+
+        try:
+            recognizer = StreamRecognizer(memory, device, mtcnn, resnet, args.detect_every, args.threshold,
+                                          confidence_drop=args.confidence_drop)
+            for frame_index, tracks, recognized, lost in recognizer.run(read_frames(args.source, args.rotation)):
+                for track in recognized:
+                    print(f"frame {frame_index}: face {track.id}: {track.name}")
+                for track in lost:
+                    print(f"frame {frame_index}: face {track.id} left")
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            print("stream recognition failed:")
+            print(e)
+            exit(28)
+
+        stats = recognizer.stats()
+        print(f"{stats['frames']} frame(s), {stats['detections']} detection(s), "
+              f"{stats['embeddings']} face(s) recognized, {stats['fps']:.1f} fps")
+
+    if args.command == "serve":
+        if not memory.is_initialized():
+            print("Not initialized")
+            exit(15)
+        from server import serve
+
+        device = get_device(args.cpu)
+        mtcnn = get_mtcnn(device, args.detect_size, args.min_face_size, args.pyramid_factor, args.fast_detect)
+        try:
+            resnet = get_resnet(device, args.embedding_backend)
+        except Exception as e:
+            print("load resnet failed:")
+            print(e)
+            exit(32)
+        settings = recognition_settings(args)
+        settings.update(device=device.type, search_workers=args.search_workers)
+
+        try:
+            serve(memory, device, mtcnn, resnet, args.host, args.port, args.max_batch_size, args.max_wait / 1000,
+                  settings)
+        except Exception as e:
+            print("serve failed:")
+            print(e)
+            exit(16)
+
+    if args.command == "index":
+        if not memory.is_initialized():
+            print("Not initialized")
+            exit(17)
+
+        try:
+            if args.drop:
+                memory.drop_index()
+            else:
+                memory.build_index(args.lists, args.probe)
+        except Exception as e:
+            print("index failed:")
+            print(e)
+            exit(18)
+        notify_server()
@@ -1,11 +1,17 @@
 import os
+import numpy as np
 import torch
 
-from process import current_folder
+from defaults import MEMORY_PATH, LEGACY_MEMORY_PATH
+from ann_index import IVFIndex, exact_search, class_search, kmeans, squared_norms
+from gallery_file import write_gallery, read_gallery
+from sharded_search import ShardedSearch
 
 
 class Memory:
-    MEMORY_PATH = os.path.join(current_folder(), '../data/faces_memory.mpt')
+    MEMORY_PATH = MEMORY_PATH
+    # memories pickled by older versions, migrated to MEMORY_PATH when loaded
+    LEGACY_MEMORY_PATH = LEGACY_MEMORY_PATH
     NOBODY = 'Nobody'
 
     def __init__(self):
@@ -13,19 +19,233 @@ class Memory:
         self.idx_to_class = None
         self.class_to_idx = None
         self.embeddings = None
+        # the sum and the number of the embeddings of every class, so that classes can be changed one at a time
+        self.class_sums = None
+        self.class_counts = None
+        self.index = None
+        # whether the embeddings are saved as float16
+        self.half = False
+        # with max_prototypes, every class also keeps up to max_prototypes embeddings, which are matched instead of
+        # the means: all its embeddings while it has few, their k-means centroids otherwise
+        self.max_prototypes = 0
+        self.prototypes = None
+        self.prototype_owners = None
+        # the names in index order followed by NOBODY, so that index -1 is NOBODY, see get_names
+        self._names = None
+        # the searched rows copied to every device with their squared norms, see device_rows
+        self._device_rows = {}
+        # searches MEMORY_PATH in worker processes, see use_shards
+        self.shards = None
 
-    def initialize(self, class_to_idx, embeddings, device):
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = None
+        state['_device_rows'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # memories saved before the index and the class sums existed
+        self.__dict__.setdefault('index', None)
+        self.__dict__.setdefault('half', False)
+        self.__dict__.setdefault('max_prototypes', 0)
+        self.__dict__.setdefault('prototypes', None)
+        self.__dict__.setdefault('prototype_owners', None)
+        self._names = None
+        self._device_rows = {}
+        self.shards = None
+        if 'class_sums' not in state:
+            embeddings = state['embeddings']
+            self.class_sums = embeddings.clone() if embeddings is not None else None
+            self.class_counts = torch.ones(len(embeddings), device=embeddings.device) if embeddings is not None \
+                else None
+        # older versions kept the memory on the device it was made on
+        for name in ('embeddings', 'class_sums', 'class_counts', 'prototypes', 'prototype_owners'):
+            if getattr(self, name) is not None:
+                setattr(self, name, getattr(self, name).cpu())
+
+    def initialize(self, class_to_idx, embeddings, device, counts=None):
+        """
+        Replace all the known persons.
+        :param class_to_idx: The index of every class name.
+        :param embeddings: The mean embedding of every class.
+        :param device: The device the memory is searched on, see initialize_sums.
+        :param counts: The number of embeddings every mean was computed from. One for every class by default.
+        """
+        if counts is None:
+            counts = torch.ones(len(embeddings))
+        counts = counts.to(dtype=embeddings.dtype).cpu()
+        self.initialize_sums(class_to_idx, embeddings.detach().cpu() * counts.unsqueeze(1), counts, device)
+
+    def initialize_sums(self, class_to_idx, sums, counts, device, max_prototypes=None, samples=None,
+                        sample_classes=None):
+        """
+        Replace all the known persons.
+        :param class_to_idx: The index of every class name.
+        :param sums: The sum of the embeddings of every class.
+        :param counts: The number of embeddings of every class.
+        :param device: The device the memory is searched on, which gets its copy of the memory now. The memory
+                       itself is always kept on CPU, so it is saved and loaded the same way whatever the device.
+        :param max_prototypes: The most prototypes kept for every class, 0 to match the means only. The current
+                               setting by default.
+        :param samples: A (m, 512) tensor of the embeddings the sums were made of, to make the prototypes from.
+                        Without them, the mean is the only prototype of every class.
+        :param sample_classes: The (m,) class index of every sample.
+        """
         self.class_to_idx = class_to_idx.copy()
         self.class_to_idx[self.NOBODY] = -1
         self.idx_to_class = {i: c for c, i in self.class_to_idx.items()}
+        self._names = None
+        self._device_rows = {}
 
-        self.embeddings = embeddings.to(device)
+        self.class_sums = sums.detach().cpu()
+        self.class_counts = counts.to(dtype=sums.dtype).cpu()
+        self.embeddings = self.class_sums / self.class_counts.unsqueeze(1)
         self.initialized = True
+
+        if max_prototypes is not None:
+            self.max_prototypes = max_prototypes
+        self.prototypes = None
+        self.prototype_owners = None
+        if self.max_prototypes:
+            if samples is None:
+                samples, sample_classes = self.embeddings, torch.arange(len(self.embeddings))
+            order = torch.argsort(sample_classes.cpu(), stable=True)
+            sizes = torch.bincount(sample_classes.cpu(), minlength=len(self.embeddings)).tolist()
+            samples = samples.detach().cpu()[order].float()
+            prototypes = [self.make_prototypes(class_samples) for class_samples in samples.split(sizes)]
+            self.prototypes = torch.cat(prototypes)
+            self.prototype_owners = torch.cat([torch.full((len(p),), i, dtype=torch.long)
+                                               for i, p in enumerate(prototypes)])
+            # the index is built on the means, which are not matched any more
+            self.index = None
+
+        if self.index is not None:
+            self.index.build(self.embeddings)
+        self.save()
+        self.device_rows(device)
+
+    def make_prototypes(self, samples: torch.Tensor):
+        """
+        :param samples: The embeddings of one class.
+        :return: The samples if there are at most max_prototypes of them, else max_prototypes k-means centroids.
+        """
+        if len(samples) <= self.max_prototypes:
+            return samples
+        return kmeans(samples, self.max_prototypes)[0]
+
+    def set_prototypes(self, idx, samples: torch.Tensor):
+        """
+        Replace the prototypes of a class, or add them if the class is new.
+        """
+        prototypes = self.make_prototypes(samples.detach().cpu().float())
+        keep = self.prototype_owners != idx
+        self.prototypes = torch.cat([self.prototypes[keep], prototypes])
+        self.prototype_owners = torch.cat([self.prototype_owners[keep],
+                                           torch.full((len(prototypes),), idx, dtype=torch.long)])
+
+    def enroll(self, name, embeddings: torch.Tensor, replace=False):
+        """
+        Add embeddings to a class, or create the class if it is not known yet.
+        Only the row of this class is changed, the other classes keep their embeddings and indices.
+        :param name: The name of the class.
+        :param embeddings: A (n, 512) tensor of new face embeddings of the class.
+        :param replace: Whether to forget the old embeddings of the class.
+        """
+        if name == self.NOBODY:
+            raise Exception(f'{self.NOBODY} cannot be used as a class name.')
+        if len(embeddings) == 0:
+            raise Exception(f'No face found for {name}.')
+
+        if not self.is_initialized():
+            self.initialize_sums({name: 0}, embeddings.detach().sum(dim=0, keepdim=True),
+                                 torch.tensor([len(embeddings)]), embeddings.device, samples=embeddings,
+                                 sample_classes=torch.zeros(len(embeddings), dtype=torch.long))
+            return
+
+        self._device_rows = {}
+        total = embeddings.detach().to(device='cpu', dtype=self.class_sums.dtype).sum(dim=0)
+        idx = self.class_to_idx.get(name)
+        if idx is None:
+            idx = self.person_num()
+            self.class_to_idx[name] = idx
+            self.idx_to_class[idx] = name
+            self._names = None
+            self.class_sums = torch.cat([self.class_sums, total.unsqueeze(0)])
+            self.class_counts = torch.cat([self.class_counts, self.class_counts.new_tensor([len(embeddings)])])
+            self.embeddings = torch.cat([self.embeddings,
+                                         (total / len(embeddings)).unsqueeze(0).to(self.embeddings.dtype)])
+        else:
+            if replace:
+                self.class_sums[idx] = total
+                self.class_counts[idx] = len(embeddings)
+            else:
+                self.class_sums[idx] += total
+                self.class_counts[idx] += len(embeddings)
+            self.embeddings[idx] = self.class_sums[idx] / self.class_counts[idx]
+
+        if self.prototypes is not None:
+            samples = embeddings
+            if not replace:
+                # the old embeddings are not kept, the old prototypes stand in for them
+                old = self.prototypes[self.prototype_owners == idx]
+                samples = torch.cat([old, embeddings.detach().to(device='cpu', dtype=old.dtype)])
+            self.set_prototypes(idx, samples)
+
+        if self.index is not None:
+            self.index.set_row(idx, self.embeddings[idx])
+        self.save()
+
+    def update(self, name, embeddings: torch.Tensor):
+        """
+        Replace the embeddings of a known class.
+        """
+        if name not in self.class_to_idx or name == self.NOBODY:
+            raise Exception(f'{name} is not known.')
+        self.enroll(name, embeddings, replace=True)
+
+    def remove(self, name):
+        """
+        Forget a class. The classes after it move one index up.
+        """
+        if name not in self.class_to_idx or name == self.NOBODY:
+            raise Exception(f'{name} is not known.')
+
+        idx = self.class_to_idx.pop(name)
+        self._device_rows = {}
+        keep = torch.arange(len(self.embeddings)) != idx
+        self.class_sums = self.class_sums[keep]
+        self.class_counts = self.class_counts[keep]
+        self.embeddings = self.embeddings[keep]
+        for class_name, i in self.class_to_idx.items():
+            if i > idx:
+                self.class_to_idx[class_name] = i - 1
+        self.idx_to_class = {i: c for c, i in self.class_to_idx.items()}
+        self._names = None
+
+        if self.prototypes is not None:
+            keep = self.prototype_owners != idx
+            self.prototypes = self.prototypes[keep]
+            self.prototype_owners = self.prototype_owners[keep]
+            self.prototype_owners = self.prototype_owners - (self.prototype_owners > idx).long()
+
+        if self.index is not None:
+            if self.person_num() == 0:
+                self.index = None
+            else:
+                self.index.remove_row(idx)
         self.save()
 
-    def save(self):
-        os.makedirs(os.path.dirname(self.MEMORY_PATH), exist_ok=True)
-        torch.save(self, self.MEMORY_PATH)
+    def save(self, path=None):
+        """
+        Save the memory in the gallery format, see gallery_file.write_gallery.
+        :param path: The path to save to. MEMORY_PATH by default.
+        """
+        names = [self.idx_to_class[i] for i in range(self.person_num())]
+        write_gallery(path or self.MEMORY_PATH, names, self.embeddings, self.class_sums, self.class_counts,
+                      self.index, self.half, self.prototypes, self.prototype_owners, self.max_prototypes)
+        if self.shards is not None and os.path.abspath(path or self.MEMORY_PATH) == os.path.abspath(self.shards.path):
+            self.shards.update()
 
     def person_num(self):
         return len(self.class_to_idx) - 1
@@ -37,17 +257,133 @@ class Memory:
         self.save_detected = if_save_detected
 
     def get_embeddings(self, device=torch.device('cpu')):
-        return self.embeddings.to(device)
+        """
+        :return: The mean embedding of every person on device, as float32.
+        """
+        if self.prototypes is None:
+            return self.device_rows(device)[0]
+        return self.embeddings.to(device=device, dtype=torch.float32)
+
+    def device_rows(self, device=torch.device('cpu')):
+        """
+        The rows searched, which are the prototypes if there are any and the means otherwise, on device as one
+        contiguous float32 tensor, with their squared norms for the distances and the person of every prototype.
+        They are made once for every device and kept until the memory changes, so searches copy nothing to the device.
+        :return: (rows, squared_norms, owners), owners is None without prototypes.
+        """
+        if device not in self._device_rows:
+            rows = self.embeddings if self.prototypes is None else self.prototypes
+            rows = rows.to(device=device, dtype=torch.float32).contiguous()
+            owners = None if self.prototype_owners is None else self.prototype_owners.to(device)
+            self._device_rows[device] = (rows, squared_norms(rows), owners)
+        return self._device_rows[device]
 
     def get_names(self, indices: torch.Tensor):
-        names = []
-        for elem in indices:
-            names.append(self.idx_to_class[elem.item()])
-        return names
+        """
+        :param indices: A tensor of class indices, -1 for NOBODY.
+        :return: The list of their names.
+        """
+        if self._names is None:
+            self._names = np.array([self.idx_to_class[i] for i in range(self.person_num())] + [self.NOBODY],
+                                   dtype=object)
+        return self._names[indices.cpu().numpy()].tolist()
+
+    def build_index(self, n_lists=None, n_probe=8):
+        """
+        Build an approximate nearest neighbour index of the embeddings, which makes search much faster for large
+        galleries. The index is saved with the memory and rebuilt whenever the memory is initialized again.
+        :param n_lists: The number of clusters of the index. By default 4 * sqrt(person_num).
+        :param n_probe: How many clusters are searched for every face.
+        """
+        if not self.is_initialized():
+            raise Exception('Memory is not initialized.')
+        if self.prototypes is not None:
+            raise Exception('The index does not support prototypes, initialize the memory without prototypes.')
+        self.index = IVFIndex(n_lists, n_probe).build(self.embeddings)
+        self.save()
+
+    def use_shards(self, workers, threads=None):
+        """
+        Search the memory in worker processes, every one searching a shard of the persons, see ShardedSearch.
+        For memories too large for one process to search quickly. The memory must be saved in MEMORY_PATH.
+        :param workers: The number of worker processes, 0 to search in this process again.
+        :param threads: The threads of torch in every worker.
+        """
+        if self.shards is not None:
+            self.shards.close()
+            self.shards = None
+        if workers > 0:
+            if not self.is_initialized():
+                raise Exception('Memory is not initialized.')
+            self.shards = ShardedSearch(self.MEMORY_PATH, workers, threads)
+
+    def drop_index(self):
+        self.index = None
+        self.save()
+
+    def search(self, embeddings: torch.Tensor, device=torch.device('cpu'), k=1, exact=False):
+        """
+        Find the k nearest known persons of every embedding.
+        With prototypes, the distance to a person is the distance to their nearest prototype. Otherwise it is the
+        distance to their mean embedding, and the index is used if it is built, unless exact is True.
+        With shards, the search is exact and runs in the worker processes.
+        :param embeddings: A (n, 512) tensor of face embeddings.
+        :param device: The device to use.
+        :param k: How many persons to return for every embedding.
+        :param exact: Whether to search all persons even if there is an index.
+        :return: (distances, indices), two (n, k) tensors sorted by distance. Missing persons have index -1.
+        """
+        embeddings = embeddings.to(device)
+        if self.shards is not None:
+            return self.shards.search(embeddings, self.person_num(), k, self.prototype_owners)
+        rows, norms, owners = self.device_rows(device)
+        if owners is not None:
+            return class_search(embeddings, rows, owners, self.person_num(), k, squared_norms=norms)
+        if exact or self.index is None:
+            return exact_search(embeddings, rows, k, squared_norms=norms)
+        return self.index.search(embeddings, rows, k, squared_norms=norms)
+
+    @staticmethod
+    def load(path):
+        """
+        Load a memory saved in the gallery format. The embeddings are mapped from the file rather than read, so
+        loading is immediate and processes loading the same file share one copy of it.
+        """
+        gallery = read_gallery(path)
+        memory = Memory()
+        memory.class_to_idx = {name: i for i, name in enumerate(gallery['names'])}
+        memory.class_to_idx[Memory.NOBODY] = -1
+        memory.idx_to_class = {i: c for c, i in memory.class_to_idx.items()}
+        memory.embeddings = gallery['embeddings']
+        memory.class_sums = gallery['sums']
+        memory.class_counts = gallery['counts']
+        memory.half = memory.embeddings.dtype == torch.float16
+        if gallery['index'] is not None:
+            memory.index = IVFIndex(**gallery['index'])
+            memory.index.centroids = gallery['centroids']
+            memory.index.assignments = gallery['assignments']
+        if 'prototypes' in gallery:
+            memory.max_prototypes = gallery['max_prototypes']
+            memory.prototypes = gallery['prototypes']
+            memory.prototype_owners = gallery['prototype_owners']
+        memory.initialized = True
+        return memory
+
+    @staticmethod
+    def load_legacy(path):
+        """
+        Load a memory pickled by older versions. Tensors saved on a GPU are loaded on the CPU.
+        """
+        return torch.load(path, map_location='cpu', weights_only=False)
 
     @staticmethod
     def load_memory():
         if os.path.exists(Memory.MEMORY_PATH):
-            return torch.load(Memory.MEMORY_PATH)
+            return Memory.load(Memory.MEMORY_PATH)
+        elif os.path.exists(Memory.LEGACY_MEMORY_PATH):
+            memory = Memory.load_legacy(Memory.LEGACY_MEMORY_PATH)
+            if memory.is_initialized():
+                memory.save()
+            return memory
         else:
             return Memory()
@@ -1,6 +1,12 @@
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+from functools import partial
 from PIL import Image, ImageOps
 import os
+import json
+import time
+
+from profiler import stage
 
 
 def handle_rotation(img: Image.Image):
@@ -18,35 +24,281 @@ def handle_rotation(img: Image.Image):
     return ImageOps.exif_transpose(img)
 
 
-def handle_rotation_multithreading(img_list: list[Image.Image]):
-    with ProcessPoolExecutor() as executor:
-        rotated_img_list = list(executor.map(handle_rotation, img_list))
-    return rotated_img_list
-
-
 def load_image_with_exif(img: Image.Image):
     return ImageOps.exif_transpose(img)
 
 
 def load_image(file_path: str, rotation: bool = False):
-    img = Image.open(file_path).convert('RGB')
+    with stage('decode'):
+        img = Image.open(file_path).convert('RGB')
     if rotation:
-        img = handle_rotation(img)
+        with stage('exif_rotation'):
+            img = handle_rotation(img)
     return img
 
 
-def resize_images(input_folder, output_folder, size, rotation=False):
+class DecodePool:
+    """
+    Decode images in worker threads or processes, ahead of the code using them, so that decoding overlaps with
+    inference. With no workers the images are decoded when they are needed, in the calling thread.
+    """
+
+    def __init__(self, workers: int = 0, processes: bool = False, prefetch: int = None):
+        """
+        :param workers: The number of workers. 0 decodes in the calling thread.
+        :param processes: Whether the workers are processes rather than threads. JPEG decoding mostly releases the
+                          GIL, so threads are usually enough and avoid sending the decoded images between processes.
+        :param prefetch: How many images may be decoded ahead of the one being used. 2 * workers by default.
+        """
+        self.workers = workers
+        self.processes = processes
+        self.prefetch = prefetch or 2 * workers
+        self.executor = None
+        if workers > 0:
+            self.executor = ProcessPoolExecutor(workers) if processes else ThreadPoolExecutor(workers)
+
+    def map(self, paths, rotation: bool = False):
+        """
+        Decode the images like load_image.
+        :param paths: The paths of the images.
+        :param rotation: Whether to handle the EXIF rotation.
+        :return: A generator of the images, in the order of the paths.
+        """
+        load = partial(load_image, rotation=rotation)
+        if self.executor is None:
+            for path in paths:
+                yield load(path)
+            return
+
+        pending = deque()
+        for path in paths:
+            pending.append(self.executor.submit(load, path))
+            if len(pending) > self.prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def list_images(paths):
+    """
+    The image files among the paths, with the images directly inside the directories among the paths.
+    """
+    image_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            image_paths.extend(os.path.join(path, filename) for filename in sorted(os.listdir(path))
+                               if filename.endswith(('jpg', 'jpeg', 'png')))
+        elif os.path.isfile(path):
+            image_paths.append(path)
+        else:
+            raise FileNotFoundError(f'{path} not exist.')
+    return image_paths
+
+
+EXIF_ORIENTATION = 0x0112
+
+
+def resize_image(input_path: str, output_path: str, size: tuple, rotation: bool = False, quality: int = 90):
+    """
+    Resize one picture and save it in the format of its extension. JPEG pictures at least twice as large as size are
+    decoded at a reduced scale, which is much faster than decoding them fully, and the resize itself first reduces
+    the picture by whole factors, which costs little quality.
+    :param input_path: The path of the picture.
+    :param output_path: The path to save to. It is written next to it and renamed, so it is never left half written.
+    :param size: The (width, height) of the resized picture.
+    :param rotation: Whether to handle the EXIF rotation. Otherwise the EXIF data is kept.
+    :param quality: The quality of JPEG and WebP outputs, from 1 to 95.
+    :return: The number of bytes read and written.
+    """
+    with Image.open(input_path) as img:
+        draft_size = size
+        if rotation and img.getexif().get(EXIF_ORIENTATION) in (5, 6, 7, 8):
+            # the picture is turned by a quarter after decoding
+            draft_size = (size[1], size[0])
+        img.draft('RGB', draft_size)
+        exif = img.info.get('exif')
+        img = img.convert('RGB')
+    if rotation:
+        img = handle_rotation(img)
+        exif = None
+    resized = img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+    options = {'quality': quality} if output_path.lower().endswith(('jpg', 'jpeg', 'webp')) else {}
+    if exif:
+        options['exif'] = exif
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    root, extension = os.path.splitext(output_path)
+    temp_path = f'{root}.{os.getpid()}.tmp{extension}'
+    resized.save(temp_path, **options)
+    os.replace(temp_path, output_path)
+    return os.path.getsize(input_path), os.path.getsize(output_path)
+
+
+def _resize_job(input_path: str, output_path: str, size: tuple, rotation: bool, quality: int):
+    try:
+        return resize_image(input_path, output_path, size, rotation, quality), None
+    except Exception as e:
+        return (0, 0), f'{type(e).__name__}: {e}'
+
+
+def resize_jobs(input_folder: str, output_folder: str, recursive: bool = False):
+    """
+    The (input path, output path) of every picture to resize, found while walking the input folder.
+    The output folder mirrors the input folder.
+    """
+    output_folder = os.path.abspath(output_folder)
+    for directory, subdirectories, filenames in os.walk(input_folder):
+        if recursive:
+            # do not resize the outputs again when they are inside the input folder
+            subdirectories[:] = sorted(subdirectory for subdirectory in subdirectories
+                                       if os.path.abspath(os.path.join(directory, subdirectory)) != output_folder)
+        else:
+            subdirectories.clear()
+        for filename in sorted(filenames):
+            if filename.lower().endswith(('jpg', 'jpeg', 'png')):
+                input_path = os.path.join(directory, filename)
+                yield input_path, os.path.join(output_folder, os.path.relpath(input_path, input_folder))
+
+
+RESIZE_SETTINGS = '.resize.json'
+
+
+def read_resize_settings(output_folder: str):
+    """
+    The settings of the last run which resized into output_folder, None if there is no record of them.
+    """
+    try:
+        with open(os.path.join(output_folder, RESIZE_SETTINGS), encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_resize_settings(output_folder: str, settings):
+    path = os.path.join(output_folder, RESIZE_SETTINGS)
+    if settings is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(settings, file)
+
+
+def is_up_to_date(input_path: str, output_path: str, size: tuple):
+    """
+    Whether the output of a picture is newer than it and has the given (width, height).
+    Only the header of the output is read.
+    """
+    if not os.path.exists(output_path) or os.path.getmtime(output_path) < os.path.getmtime(input_path):
+        return False
+    try:
+        with Image.open(output_path) as img:
+            return img.size == tuple(size)
+    except Exception:
+        return False
+
+
+def resize_images(input_folder, output_folder, size, rotation=False, workers=None, quality=90, recursive=False,
+                  force=False):
+    """
+    Resize all the pictures of a folder, see resize_image.
+    The pictures are resized by worker processes, which are only sent the paths, while the folder is still being
+    walked. A picture which fails is reported and the others are still resized.
+    :param input_folder: The folder of the pictures.
+    :param output_folder: The folder to save the resized pictures in, with the same names and subfolders.
+    :param size: The (width, height) of the resized pictures.
+    :param rotation: Whether to handle the EXIF rotation.
+    :param workers: The number of worker processes, 0 to resize in this process. The number of cores by default.
+    :param quality: The quality of JPEG and WebP outputs.
+    :param recursive: Whether to resize the pictures of the subfolders too.
+    :param force: Whether to resize the pictures whose output is up to date, which are skipped by default. An output
+                  is up to date if it is newer than its picture, has the given size, and the settings recorded in the
+                  output folder by the last run are the same as these, see read_resize_settings. They are only
+                  recorded when no picture fails.
+    :return: A dict with the number of pictures resized and skipped, the failures as (path, error), the bytes read
+             and written and the seconds spent.
+    """
+    if not os.path.isdir(input_folder):
+        raise Exception(f'{input_folder} not exist or is not a directory.')
     os.makedirs(output_folder, exist_ok=True)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    settings = {'width': size[0], 'height': size[1], 'rotation': rotation, 'quality': quality}
+    # the outputs can only be trusted if the last run used the same settings, and its record is removed until this
+    # run ends, so that a run stopped halfway is never taken for a complete one
+    skip = not force and read_resize_settings(output_folder) == settings
+    write_resize_settings(output_folder, None)
+
+    stats = {'resized': 0, 'skipped': 0, 'failed': [], 'bytes_read': 0, 'bytes_written': 0}
 
-    for filename in os.listdir(input_folder):
-        if filename.endswith(('jpg', 'jpeg', 'png')):
-            img_path = os.path.join(input_folder, filename)
-            img = load_image(img_path, rotation=rotation)
+    def collect(input_path, result):
+        (read, written), error = result
+        if error is None:
+            stats['resized'] += 1
+            stats['bytes_read'] += read
+            stats['bytes_written'] += written
+        else:
+            stats['failed'].append((input_path, error))
 
-            img_resized = img.resize(size, Image.LANCZOS)
+    start = time.perf_counter()
+    executor = ProcessPoolExecutor(workers) if workers > 0 else None
+    pending = deque()
+    try:
+        for input_path, output_path in resize_jobs(input_folder, output_folder, recursive):
+            if skip and is_up_to_date(input_path, output_path, size):
+                stats['skipped'] += 1
+                continue
+            if executor is None:
+                collect(input_path, _resize_job(input_path, output_path, size, rotation, quality))
+                continue
+            pending.append((input_path, executor.submit(_resize_job, input_path, output_path, size, rotation,
+                                                        quality)))
+            if len(pending) > 2 * workers:
+                input_path, future = pending.popleft()
+                collect(input_path, future.result())
+        while pending:
+            input_path, future = pending.popleft()
+            collect(input_path, future.result())
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    if not stats['failed']:
+        # an output left from other settings by a picture which failed must not be taken for up to date next time
+        write_resize_settings(output_folder, settings)
+    stats['seconds'] = time.perf_counter() - start
+    return stats
 
-            output_path = os.path.join(output_folder, filename)
-            img_resized.save(output_path)
+
+def percentile(values, q):
+    """
+    The q-th percentile (0 <= q <= 100) of the values, with linear interpolation.
+    """
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    pos = (len(values) - 1) * q / 100
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def file_version(path: str):
+    """
+    What changes whenever a gallery file is written again, as write_gallery replaces the file.
+    """
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
 
 
 def current_folder():
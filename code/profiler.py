@@ -0,0 +1,209 @@
+import sys
+import json
+import time
+import threading
+from contextlib import nullcontext
+
+PROMETHEUS_PREFIX = 'face_recognition'
+
+
+class StageTimer:
+    def __init__(self, profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+        self.function = None
+
+    def __enter__(self):
+        if self.profiler.record_functions:
+            import torch
+
+            # the stages show up as labels in the trace of torch.profiler
+            self.function = torch.profiler.record_function(self.name)
+            self.function.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.profiler.enabled:
+            self.profiler.add_time(self.name, time.perf_counter() - self.start)
+        if self.function is not None:
+            self.function.__exit__(exc_type, exc_val, exc_tb)
+
+
+class Profiler:
+    """
+    Counters of where the time of a run goes. Disabled by default, in which case stage and observe cost almost
+    nothing, so the pipeline is always instrumented.
+    The stages are:
+    decode, exif_rotation: reading the pictures, see process.load_image
+    cache: hashing the pictures and looking them up in the embedding cache
+    detect: mtcnn, including cropping the faces
+    detect_fast, detect_full, detect_extract: the parts of detect with a FaceDetector, the first pass of -fd, the
+    normal detection and cropping the faces
+    embed: the resnet forward pass
+    search: comparing the embeddings with the memory
+    names: turning the indices found into names
+    save: handing the detected faces to the FaceWriter, which only waits when the writer is behind
+    The observations are the batch sizes (images per batch), the faces found per image and, with -fd, whether the
+    first pass found a face in each image.
+    Pictures decoded in worker processes are not counted, decode in threads to profile decoding.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.record_functions = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time.perf_counter()
+            # name -> [count, total, max]
+            self.stages = {}
+            # name -> [count, total, min, max]
+            self.observations = {}
+
+    def enable(self, enabled: bool = True):
+        self.enabled = enabled
+        self.reset()
+
+    def stage(self, name: str):
+        """
+        A context manager timing a stage of the pipeline.
+        """
+        if not self.enabled and not self.record_functions:
+            return nullcontext()
+        return StageTimer(self, name)
+
+    def add_time(self, name: str, seconds: float):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+            stage[0] += 1
+            stage[1] += seconds
+            stage[2] = max(stage[2], seconds)
+
+    def observe(self, name: str, value: float):
+        if not self.enabled:
+            return
+        with self.lock:
+            observation = self.observations.setdefault(name, [0, 0.0, value, value])
+            observation[0] += 1
+            observation[1] += value
+            observation[2] = min(observation[2], value)
+            observation[3] = max(observation[3], value)
+
+    def snapshot(self):
+        """
+        :return: A dict with the wall time of the run, every stage, every observation and the peak memory.
+        """
+        with self.lock:
+            return {
+                'wall_time': time.perf_counter() - self.start_time,
+                'stages': {name: {'count': count, 'total': total, 'mean': total / count, 'max': longest}
+                           for name, (count, total, longest) in self.stages.items()},
+                'observations': {name: {'count': count, 'mean': total / count, 'min': low, 'max': high}
+                                 for name, (count, total, low, high) in self.observations.items()},
+                'peak_memory': peak_memory(),
+            }
+
+    def summary(self):
+        """
+        :return: The snapshot as a table.
+        """
+        snapshot = self.snapshot()
+        wall_time = snapshot['wall_time']
+        lines = [f"{'stage':<16}{'calls':>8}{'total s':>10}{'mean ms':>10}{'max ms':>10}{'share':>8}"]
+        for name, stage in sorted(snapshot['stages'].items(), key=lambda item: -item[1]['total']):
+            lines.append(f"{name:<16}{stage['count']:>8}{stage['total']:>10.3f}{stage['mean'] * 1000:>10.1f}"
+                         f"{stage['max'] * 1000:>10.1f}{stage['total'] / wall_time:>8.1%}")
+        lines.append(f"{'wall time':<16}{'':>8}{wall_time:>10.3f}")
+        if snapshot['observations']:
+            lines.append('')
+            lines.append(f"{'observation':<16}{'count':>8}{'mean':>10}{'min':>10}{'max':>10}")
+            for name, observation in sorted(snapshot['observations'].items()):
+                lines.append(f"{name:<16}{observation['count']:>8}{observation['mean']:>10.2f}"
+                             f"{observation['min']:>10g}{observation['max']:>10g}")
+        if snapshot['peak_memory']:
+            lines.append('')
+            lines.extend(f"peak {name}: {value / 2 ** 20:.1f}MB" for name, value in snapshot['peak_memory'].items())
+        return '\n'.join(lines)
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        """
+        :return: The snapshot in the Prometheus text format.
+        """
+        snapshot = self.snapshot()
+        lines = [f'# TYPE {PROMETHEUS_PREFIX}_stage_seconds summary']
+        for name, stage in snapshot['stages'].items():
+            lines.append(f'{PROMETHEUS_PREFIX}_stage_seconds_sum{{stage="{name}"}} {stage["total"]}')
+            lines.append(f'{PROMETHEUS_PREFIX}_stage_seconds_count{{stage="{name}"}} {stage["count"]}')
+        lines.append(f'# TYPE {PROMETHEUS_PREFIX}_observation summary')
+        for name, observation in snapshot['observations'].items():
+            lines.append(f'{PROMETHEUS_PREFIX}_observation_sum{{name="{name}"}} '
+                         f'{observation["mean"] * observation["count"]}')
+            lines.append(f'{PROMETHEUS_PREFIX}_observation_count{{name="{name}"}} {observation["count"]}')
+        lines.append(f'# TYPE {PROMETHEUS_PREFIX}_peak_memory_bytes gauge')
+        for name, value in snapshot['peak_memory'].items():
+            lines.append(f'{PROMETHEUS_PREFIX}_peak_memory_bytes{{memory="{name}"}} {value}')
+        lines.append(f'# TYPE {PROMETHEUS_PREFIX}_wall_seconds gauge')
+        lines.append(f'{PROMETHEUS_PREFIX}_wall_seconds {snapshot["wall_time"]}')
+        return '\n'.join(lines) + '\n'
+
+    def trace(self, directory: str):
+        """
+        Run torch.profiler until the returned profiler is stopped, and save its trace in directory for TensorBoard.
+        The stages are labelled in the trace.
+        """
+        import torch
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True,
+                                          on_trace_ready=torch.profiler.tensorboard_trace_handler(directory))
+        self.record_functions = True
+        profiler.start()
+        return profiler
+
+    def export(self, path: str):
+        """
+        Write the snapshot to path, as JSON if path ends with .json and in the Prometheus text format otherwise.
+        """
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(self.to_json() if path.endswith('.json') else self.to_prometheus())
+
+
+def peak_memory():
+    """
+    :return: The peak resident memory of the process and the peak memory allocated on the GPU, in bytes, when known.
+    """
+    peaks = {}
+    try:
+        import resource
+
+        # ru_maxrss is in kilobytes on linux and in bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peaks['rss'] = rss if sys.platform == 'darwin' else rss * 1024
+    except ImportError:
+        pass
+
+    # only a command which imported torch can have used the GPU, and importing it now would slow the exit down
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        peaks['cuda'] = torch.cuda.max_memory_allocated()
+    return peaks
+
+
+PROFILER = Profiler()
+
+
+def stage(name: str):
+    return PROFILER.stage(name)
+
+
+def observe(name: str, value: float):
+    PROFILER.observe(name, value)
@@ -1,16 +1,22 @@
 from facenet_pytorch import MTCNN, InceptionResnetV1
 from torchvision import datasets
-from collections import defaultdict
 import torch
 import os
+from collections import defaultdict, deque
 
 from memory import Memory
-from process import load_image_with_exif
+from process import load_image, DecodePool
+from embedding_cache import EmbeddingCache
+from detector import detect_batch
+from enrollment_filter import EnrollmentFilter
+from profiler import stage, observe
 
 
 def read_dataset(memory: Memory, device: torch.device, mtcnn: MTCNN, resnet: InceptionResnetV1,
                  dataset_path: str = '../data/faces_memory', only_one_picture: bool = False,
-                 exif_rotation: bool = False):
+                 exif_rotation: bool = False, cache: EmbeddingCache = None, batch_size: int = 32,
+                 decode_pool: DecodePool = None, max_prototypes: int = None,
+                 enrollment_filter: EnrollmentFilter = None):
     """
     Read the dataset of known faces, generate their embeddings and save them in memory.
     :param memory: The memory of the program.
@@ -18,8 +24,20 @@ def read_dataset(memory: Memory, device: torch.device, mtcnn: MTCNN, resnet: Inc
     :param mtcnn: The mtcnn model.
     :param resnet: The resnet model.
     :param dataset_path: The path to the dataset.
-    :param only_one_picture: Whether to only read one picture for every person for generate embeddings.
+    :param only_one_picture: Whether to only read one picture for every person for generate embeddings. The same as
+                             an enrollment filter with max_per_person=1.
     :param exif_rotation: Whether to rotate the image with exif or not.
+    :param cache: The cache of embeddings, which must have been created with the same models, exif_rotation and
+                  quality checks of the enrollment filter. Images found in the cache are not read again, unless
+                  near duplicates are looked for, in which case they are decoded to be hashed but not embedded.
+    :param batch_size: How many images are detected and embedded together. Only one batch of images is kept in
+                       memory at a time, however large the dataset is.
+    :param decode_pool: The pool decoding the images ahead of detection. By default the images are decoded one by
+                        one when they are needed.
+    :param max_prototypes: The most embeddings kept for every person to be matched against, see Memory. 0 keeps only
+                           the mean embedding of every person. The setting of the memory by default.
+    :param enrollment_filter: The checks skipping near duplicates, poor faces and the pictures of persons who have
+                              enough, see EnrollmentFilter. By default every picture is embedded.
     """
 
     if mtcnn.device != device:
@@ -29,12 +47,15 @@ def read_dataset(memory: Memory, device: torch.device, mtcnn: MTCNN, resnet: Inc
     resnet = resnet.eval().to(device)
     mtcnn.keep_all = False
 
+    if enrollment_filter is None:
+        enrollment_filter = EnrollmentFilter()
+    # the filter of the caller is left as it is
+    max_per_person = 1 if only_one_picture else None
+
     try:
         os.makedirs(os.path.dirname(dataset_path), exist_ok=True)
-        if exif_rotation:
-            dataset = datasets.ImageFolder(dataset_path, transform=load_image_with_exif)
-        else:
-            dataset = datasets.ImageFolder(dataset_path)
+        # only the structure of the dataset is used, the images are decoded by the decode pool
+        dataset = datasets.ImageFolder(dataset_path)
     except FileNotFoundError as e:
         raise Exception(f'Read {dataset_path} failed.')
 
@@ -43,50 +64,173 @@ def read_dataset(memory: Memory, device: torch.device, mtcnn: MTCNN, resnet: Inc
 
     dataset.idx_to_class = {i: c for c, i in dataset.class_to_idx.items()}
 
-    aligned = []
-    names = []
-
-    # possible improvement: if the images are guaranteed to be the same size, batch process is possible.
-    for x, y in dataset:
-        if y == memory.NOBODY:
+    class_to_idx = dict()
+    class_sums = []
+    class_counts = []
+    # the embeddings themselves are only kept to make prototypes
+    if max_prototypes is None:
+        max_prototypes = memory.max_prototypes
+    samples = []
+    sample_classes = []
+    to_read = []
+    pending = []
+
+    def add_embedding(class_idx, embedding):
+        class_sums[class_idx] += embedding
+        class_counts[class_idx] += 1
+        if max_prototypes:
+            samples.append(embedding)
+            sample_classes.append(class_idx)
+
+    def embed_pending():
+        """
+        Detect the faces in the pending images and add their embeddings to the sums of their classes.
+        """
+        found = []
+        observe('batch_size', len(pending))
+        same_size = defaultdict(list)
+        for i, (_, x, _) in enumerate(pending):
+            same_size[x.size].append(i)
+        for indices in same_size.values():
+            with stage('detect'):
+                detected, boxes, probs = detect_batch(mtcnn, [pending[i][1] for i in indices], return_boxes=True)
+            for i, faces, image_boxes, image_probs in zip(indices, detected, boxes, probs):
+                class_idx, _, key = pending[i]
+                observe('faces_per_image', 0 if faces is None else 1)
+                if faces is not None and enrollment_filter.accepts(image_boxes[0], image_probs[0]):
+                    found.append((i, class_idx, faces, key))
+                elif cache is not None:
+                    # picture has no face detected, or none good enough, which the settings of the cache tell.
+                    cache.put(key, None)
+        pending.clear()
+
+        # the faces are kept in the order of the dataset, up to the limit of every class
+        kept = []
+        taken = defaultdict(int)
+        for i, class_idx, faces, key in sorted(found, key=lambda item: item[0]):
+            if not enrollment_filter.skip_full(class_counts[class_idx] + taken[class_idx], max_per_person):
+                taken[class_idx] += 1
+                kept.append((class_idx, faces, key))
+        found = kept
+        if len(found) == 0:
+            return
+
+        with stage('embed'), torch.inference_mode():
+            embeddings = resnet(torch.stack([faces for _, faces, _ in found]).to(device)).cpu()
+        for (class_idx, _, key), embedding in zip(found, embeddings):
+            add_embedding(class_idx, embedding)
+            if cache is not None:
+                cache.put(key, embedding)
+
+    # near duplicates are only known once the pictures are decoded, so the cached pictures are decoded too
+    dedup = enrollment_filter.dedup_distance is not None
+    for path, y in dataset.samples:
+        class_name = dataset.idx_to_class[y]
+        if class_name == memory.NOBODY:
             # cannot use NOBODY as a class name
             continue
 
-        if only_one_picture and y in names:
+        if class_name not in class_to_idx:
+            class_to_idx[class_name] = len(class_sums)
+            class_sums.append(torch.zeros(512))
+            class_counts.append(0)
+        class_idx = class_to_idx[class_name]
+        if enrollment_filter.skip_full(class_counts[class_idx], max_per_person):
             continue
 
-        faces = mtcnn(x)
-        if faces is not None:
-            aligned.append(faces)
-            names.append(dataset.idx_to_class[y])
-        else:
-            """
-            picture y has no face detected.
-            """
+        key, hit, embedding = None, False, None
+        if cache is not None:
+            with stage('cache'):
+                key = cache.key(path)
+                hit, embedding = cache.get(key)
+            if hit and not dedup:
+                if embedding is not None:
+                    add_embedding(class_idx, embedding)
+                continue
+
+        to_read.append((class_idx, path, key, hit, embedding))
+
+    queued = deque()
+
+    def paths_to_read():
+        # checked as the pictures are queued for decoding, so the pictures of full classes are never decoded
+        for entry in to_read:
+            if not enrollment_filter.skip_full(class_counts[entry[0]], max_per_person):
+                queued.append(entry)
+                yield entry[1]
+
+    if decode_pool is None:
+        decode_pool = DecodePool()
+    for x in decode_pool.map(paths_to_read(), exif_rotation):
+        class_idx, _, key, hit, embedding = queued.popleft()
+        if enrollment_filter.is_duplicate(class_idx, x):
+            continue
+        if hit:
+            if embedding is not None and not enrollment_filter.skip_full(class_counts[class_idx], max_per_person):
+                add_embedding(class_idx, embedding)
+            continue
+        pending.append((class_idx, x, key))
+        if len(pending) >= batch_size:
+            embed_pending()
 
-    aligned = torch.stack(aligned).to(device)
-    embeddings = resnet(aligned).detach().cpu()
+    embed_pending()
 
-    class_to_idx = dict()
-    class_to_features = defaultdict(list)
-    name_loc = 0
-    for i, class_name in enumerate(names):
-        class_to_features[class_name].append(embeddings[i])
-        if class_name not in class_to_idx:
-            class_to_idx[class_name] = name_loc
-            name_loc += 1
+    # classes without any detected face are left out
+    found_classes = [class_name for class_name, class_idx in class_to_idx.items() if class_counts[class_idx] > 0]
+    if len(found_classes) == 0:
+        if any(enrollment_filter.stats().values()):
+            raise Exception(f'No face found in {dataset_path} passed the enrollment filter.')
+        raise Exception(f'No face found in {dataset_path}.')
 
-    class_features = []
-    for class_name, features in class_to_features.items():
-        class_tensor = torch.stack(features)
-        class_mean_feature = class_tensor.mean(dim=0)
-        class_features.append(class_mean_feature)
+    class_sums = torch.stack([class_sums[class_to_idx[class_name]] for class_name in found_classes])
+    class_counts = torch.tensor([class_counts[class_to_idx[class_name]] for class_name in found_classes])
+    if max_prototypes:
+        new_idx = {class_to_idx[class_name]: i for i, class_name in enumerate(found_classes)}
+        samples = torch.stack(samples)
+        sample_classes = torch.tensor([new_idx[class_idx] for class_idx in sample_classes])
+    else:
+        samples, sample_classes = None, None
+    class_to_idx = {class_name: i for i, class_name in enumerate(found_classes)}
 
-    embeddings = torch.stack(class_features)
+    memory.initialize_sums(class_to_idx, class_sums, class_counts, device, max_prototypes, samples, sample_classes)
 
-    memory.initialize(class_to_idx, embeddings, device)
+
+def embed_images(device: torch.device, mtcnn: MTCNN, resnet: InceptionResnetV1, image_paths: list,
+                 exif_rotation: bool = False):
+    """
+    Generate the embedding of the largest face in every image.
+    :param device: The device to use.
+    :param mtcnn: The mtcnn model.
+    :param resnet: The resnet model.
+    :param image_paths: The paths of the images.
+    :param exif_rotation: Whether to rotate the image with exif or not.
+    :return: A (n, 512) tensor on cpu, for the n images in which a face is detected.
+    """
+    if mtcnn.device != device:
+        raise Exception("The device is different than the mtcnn device.")
+
+    mtcnn = mtcnn.eval()
+    resnet = resnet.eval().to(device)
+    mtcnn.keep_all = False
+
+    aligned = []
+    for path in image_paths:
+        image = load_image(path, exif_rotation)
+        with stage('detect'):
+            faces = mtcnn(image)
+        observe('faces_per_image', 0 if faces is None else 1)
+        if faces is not None:
+            aligned.append(faces)
+
+    if len(aligned) == 0:
+        return torch.empty(0, 512)
+
+    with stage('embed'), torch.inference_mode():
+        return resnet(torch.stack(aligned).to(device)).cpu()
 
 
 if __name__ == '__main__':
+    from embedding_backend import load_resnet
+
     read_dataset(Memory(), torch.device('cuda'), MTCNN(device=torch.device('cuda')),
-                 InceptionResnetV1(pretrained='vggface2'), exif_rotation=True)
+                 load_resnet(torch.device('cuda')), exif_rotation=True)
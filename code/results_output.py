@@ -0,0 +1,62 @@
+import sys
+import csv
+import json
+
+OUTPUT_FORMATS = ('jsonl', 'csv')
+CSV_FIELDS = ['image', 'face', 'name', 'distance', 'probability', 'x1', 'y1', 'x2', 'y2']
+
+
+def output_format(path: str):
+    """
+    The format of an output file from its extension, JSON Lines unless it ends with .csv.
+    """
+    return 'csv' if path.endswith('.csv') else 'jsonl'
+
+
+class ResultsWriter:
+    """
+    Write the results of recognition as they come, so that they can be read while a large directory is processed.
+    In JSON Lines every image is one line {"image": filename, "faces": [...]}, with the faces described like
+    batch_face_recognition describes them. In CSV every face is one row, and an image without faces is a row with
+    only its filename.
+    """
+
+    def __init__(self, path: str, format: str = None):
+        """
+        :param path: The file to write, overwritten if it exists, or '-' for the standard output.
+        :param format: 'jsonl' or 'csv'. By default from the extension of path.
+        """
+        self.format = format or output_format(path)
+        if self.format not in OUTPUT_FORMATS:
+            raise Exception(f'Unknown output format {self.format}.')
+        # line buffered, so every image reaches the file as soon as it is written
+        self.file = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8', newline='', buffering=1)
+        self.csv = None
+        if self.format == 'csv':
+            self.csv = csv.writer(self.file, lineterminator='\n')
+            self.csv.writerow(CSV_FIELDS)
+        self.images = 0
+        self.faces = 0
+
+    def write(self, filename: str, faces: list):
+        if self.csv is None:
+            self.file.write(json.dumps({'image': filename, 'faces': faces}) + '\n')
+        elif len(faces) == 0:
+            self.csv.writerow([filename])
+        else:
+            for i, face in enumerate(faces):
+                self.csv.writerow([filename, i, face['name'], face['distance'], face['probability'], *face['box']])
+        self.images += 1
+        self.faces += len(faces)
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+        else:
+            self.file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,226 @@
+import os
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from memory import Memory
+from images_dataset import ImageDataset
+from face_recognition import face_recognition, images_recognition
+from batching import MicroBatcher
+from embedding_cache import EmbeddingCache
+from process import load_image, current_folder, file_version
+from profiler import PROFILER
+from server_client import mismatched_settings, DEFAULT_HOST, DEFAULT_PORT
+
+DEFAULT_SAVE_PATH = os.path.join(current_folder(), "../record/")
+
+
+class RecognitionServer(ThreadingHTTPServer):
+    """
+    A local HTTP server which keeps the models and the memory loaded between requests.
+    The endpoints are:
+    GET  /health  -> {"status": "ok", "persons": n, "settings": {...}}
+    GET  /stats   -> the counters of the request batching, see BatchStats.snapshot
+    GET  /metrics -> the profile in the Prometheus text format, if the server is profiled
+    POST /rec     -> {"filepath": path, ...} gives {"names": [...]},
+                     {"filepaths": [path, ...], ...} gives {"results": [[...], ...]}
+    POST /rec_all -> {"filepath": directory, ...} gives {"names": [...], "classes": [...]}
+    POST /reload  -> {"persons": n, "reloaded": whether the memory was loaded again, "memory": its version}
+    The other keys of the request body are "multi_faces", "same_size", "rotation", "save_faces", "threshold",
+    "cache", "cache_size" and "batch_size", which mean the same as the options of the command line.
+    "settings" is the settings the request asks for, such as the embedding backend and the options of the detector,
+    as main.recognition_settings gives them. A request asking for settings the server does not run with is refused,
+    as the models cannot be changed for one request. The settings of the server include the version of the memory
+    file, so a client whose memory file is not the one served can tell.
+    The memory is loaded again as soon as a request sees that its file was saved since it was loaded, by init, enroll,
+    update, remove or migrate, so the answers always come from the memory as it is on disk.
+    Concurrent /rec requests, and the images of one /rec request, are recognized together in batches.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, memory: Memory, device, mtcnn, resnet, max_batch_size: int = 16,
+                 max_wait: float = 0.01, settings: dict = None, memory_path: str = None):
+        super().__init__(address, RecognitionHandler)
+        self.settings = settings or {}
+        self.memory = memory
+        self.memory_path = memory_path or Memory.MEMORY_PATH
+        self.memory_version = file_version(self.memory_path) if os.path.exists(self.memory_path) else None
+        self.device = device
+        self.mtcnn = mtcnn
+        self.resnet = resnet
+        # the models keep state (keep_all) between calls, so only one request may use them at a time
+        self.model_lock = threading.Lock()
+        self.batcher = MicroBatcher(memory, device, mtcnn, resnet, max_batch_size, max_wait, self.model_lock)
+
+    def server_close(self):
+        super().server_close()
+        self.batcher.close()
+
+    def current_settings(self):
+        if self.memory_version is None:
+            return self.settings
+        return dict(self.settings, memory=list(self.memory_version))
+
+    def refresh_memory(self):
+        """
+        Load the memory again if its file was saved since it was loaded. The searches of the shards, if any, move to
+        the new file, see ShardedSearch.update.
+        :return: Whether the memory was loaded again.
+        """
+        with self.model_lock:
+            if not os.path.exists(self.memory_path):
+                return False
+            version = file_version(self.memory_path)
+            if version == self.memory_version:
+                return False
+            memory = Memory.load(self.memory_path)
+            if self.memory.shards is not None:
+                memory.shards, self.memory.shards = self.memory.shards, None
+                memory.shards.update()
+            self.memory = self.batcher.memory = memory
+            self.memory_version = version
+            return True
+
+    def recognize_many(self, filepaths, multi_faces=False, rotation=False, save_faces=None, threshold=0.85):
+        if save_faces is not None:
+            return [self.recognize(path, multi_faces, rotation, save_faces, threshold) for path in filepaths]
+        futures = [self.batcher.submit(load_image(path, rotation), multi_faces, threshold) for path in filepaths]
+        return [future.result() for future in futures]
+
+    def recognize(self, filepath, multi_faces=False, rotation=False, save_faces=None, threshold=0.85):
+        img = load_image(filepath, rotation)
+        if save_faces is None:
+            return self.batcher.recognize(img, multi_faces, threshold)
+        with self.model_lock:
+            return face_recognition(self.memory, self.device, self.mtcnn, self.resnet, img, multi_faces,
+                                    True, save_faces, threshold, filepath)
+
+    def recognize_all(self, filepath, same_size=False, rotation=False, save_faces=None, threshold=0.85,
+                      cache=None, cache_size=100000, batch_size=16):
+        if not os.path.isdir(filepath):
+            raise Exception(f"filepath {filepath} not exist or is not a directory")
+        images = ImageDataset(filepath, self.device, rotation)
+        with self.model_lock:
+            if cache is not None:
+                cache = EmbeddingCache(cache, cache_size, EmbeddingCache.describe_settings(self.mtcnn, self.resnet,
+                                                                                           rotation))
+            try:
+                return images_recognition(self.memory, self.device, self.mtcnn, self.resnet, images, same_size,
+                                          save_faces is not None, save_faces or DEFAULT_SAVE_PATH, threshold, cache,
+                                          batch_size=batch_size)
+            finally:
+                if cache is not None:
+                    cache.close()
+
+
+class RecognitionHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/health':
+            try:
+                self.server.refresh_memory()
+            except Exception as e:
+                self.send_json(500, {'error': str(e)})
+                return
+            self.send_json(200, {'status': 'ok', 'persons': self.server.memory.person_num(),
+                                 'settings': self.server.current_settings()})
+        elif self.path == '/stats':
+            self.send_json(200, self.server.batcher.stats.snapshot())
+        elif self.path == '/metrics' and PROFILER.enabled:
+            self.send_text(200, PROFILER.to_prometheus())
+        else:
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as e:
+            self.send_json(400, {'error': f'Bad request: {e}'})
+            return
+        try:
+            reloaded = self.server.refresh_memory()
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        if self.path == '/reload':
+            self.send_json(200, {'persons': self.server.memory.person_num(), 'reloaded': reloaded,
+                                 'memory': self.server.current_settings().get('memory')})
+            return
+        settings = self.server.current_settings()
+        mismatched = mismatched_settings(body.get('settings', {}), settings)
+        if mismatched:
+            self.send_json(409, {'error': f'The server runs with other {", ".join(mismatched)}.',
+                                 'settings': settings})
+            return
+
+        options = {key: body[key] for key in ('rotation', 'save_faces', 'threshold') if key in body}
+        try:
+            if self.path == '/rec':
+                if 'multi_faces' in body:
+                    options['multi_faces'] = body['multi_faces']
+                if 'filepaths' in body:
+                    result = {'results': self.server.recognize_many(body['filepaths'], **options)}
+                else:
+                    result = {'names': self.server.recognize(body['filepath'], **options)}
+            elif self.path == '/rec_all':
+                options.update({key: body[key] for key in ('same_size', 'cache', 'cache_size', 'batch_size')
+                                if key in body})
+                names, classes = self.server.recognize_all(body['filepath'], **options)
+                result = {'names': names, 'classes': classes}
+            else:
+                self.send_json(404, {'error': f'Unknown path {self.path}'})
+                return
+        except KeyError as e:
+            self.send_json(400, {'error': f'Missing field {e}'})
+            return
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+
+        self.send_json(200, result)
+
+    def send_json(self, code, obj):
+        self.send_data(code, json.dumps(obj).encode('utf-8'), 'application/json')
+
+    def send_text(self, code, text):
+        self.send_data(code, text.encode('utf-8'), 'text/plain; version=0.0.4')
+
+    def send_data(self, code, data, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # keep the console quiet, the results are returned to the clients
+        pass
+
+
+def serve(memory: Memory, device, mtcnn, resnet, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+          max_batch_size: int = 16, max_wait: float = 0.01, settings: dict = None):
+    """
+    Serve face recognition until interrupted.
+    :param memory: The memory of the program. Must be initialized.
+    :param device: The device to use.
+    :param mtcnn: The mtcnn model.
+    :param resnet: The resnet model.
+    :param host: The host to listen on. Only local addresses are recommended, as file paths are sent.
+    :param port: The port to listen on.
+    :param max_batch_size: The most images recognized in one batch.
+    :param max_wait: The longest time in seconds a request waits for other requests to join its batch.
+    :param settings: The settings the models were made with, which the requests must ask for if they ask for any.
+    """
+    if not memory.is_initialized():
+        raise Exception('Memory is not initialized.')
+
+    mtcnn.eval()
+    resnet.eval().to(device)
+
+    with RecognitionServer((host, port), memory, device, mtcnn, resnet, max_batch_size, max_wait,
+                           settings) as server:
+        print(f"serving on http://{host}:{port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
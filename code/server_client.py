@@ -0,0 +1,75 @@
+import json
+from urllib import request, error
+
+# the client side of server.py, which only needs the standard library, so that forwarding a command is quick
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+
+def parse_address(address: str):
+    """
+    Parse "host:port", "host" or ":port" into a (host, port) tuple.
+    """
+    host, _, port = address.rpartition(':') if ':' in address else (address, '', '')
+    return host or DEFAULT_HOST, int(port) if port else DEFAULT_PORT
+
+
+def server_available(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, timeout: float = 0.5):
+    return server_settings(host, port, timeout) is not None
+
+
+def server_settings(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, timeout: float = 0.5):
+    """
+    The settings a running server recognizes with, see RecognitionServer, or None if no server is running.
+    """
+    try:
+        with request.urlopen(f'http://{host}:{port}/health', timeout=timeout) as response:
+            health = json.loads(response.read())
+    except (OSError, ValueError):
+        return None
+    return health.get('settings', {}) if health.get('status') == 'ok' else None
+
+
+def mismatched_settings(settings: dict, server: dict):
+    """
+    The names of the settings asked for which a server does not run with.
+    """
+    return sorted(key for key, value in settings.items() if server.get(key) != value)
+
+
+def reload_server(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, timeout: float = 2.0):
+    """
+    Make a running server load its memory file again, if it was saved since the server loaded it.
+    :return: {"persons": n, "reloaded": bool, "memory": the version of the file served}, or None if the server did
+             not answer in time.
+    """
+    req = request.Request(f'http://{host}:{port}/reload', data=b'{}', headers={'Content-Type': 'application/json'},
+                          method='POST')
+    try:
+        with request.urlopen(req, timeout=timeout) as response:
+            return json.loads(response.read())
+    except (OSError, ValueError):
+        return None
+
+
+def forward(command: str, payload: dict, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, timeout: float = None):
+    """
+    Forward a command to a running recognition server.
+    :param command: 'rec' or 'rec_all'.
+    :param payload: The request body. File paths must be absolute, as the server may run in another directory.
+    :param host: The host of the server.
+    :param port: The port of the server.
+    :param timeout: The timeout of the request in seconds.
+    :return: The decoded response.
+    """
+    req = request.Request(f'http://{host}:{port}/{command}', data=json.dumps(payload).encode('utf-8'),
+                          headers={'Content-Type': 'application/json'}, method='POST')
+    try:
+        with request.urlopen(req, timeout=timeout) as response:
+            return json.loads(response.read())
+    except error.HTTPError as e:
+        try:
+            message = json.loads(e.read()).get('error', str(e))
+        except ValueError:
+            message = str(e)
+        raise Exception(message)
@@ -0,0 +1,141 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+
+from gallery_file import read_gallery
+from process import file_version
+from ann_index import exact_search, class_search, squared_norms
+
+# the gallery mapped by a worker process, and the rows of its shard, see _shard
+_worker_state = {'path': None, 'version': None, 'gallery': None, 'bounds': None, 'shard': None}
+
+
+def _init_worker(threads: int):
+    torch.set_num_threads(threads)
+
+
+def _load(path: str, version: tuple):
+    """
+    Map the gallery file in a worker process, unless it is mapped already.
+    """
+    if _worker_state['path'] != path or _worker_state['version'] != version:
+        gallery = read_gallery(path)
+        if file_version(path) != version:
+            raise Exception(f'{path} was changed by another process, load the memory again.')
+        _worker_state.update(path=path, version=version, gallery=gallery, bounds=None, shard=None)
+    return _worker_state['gallery']
+
+
+def _shard(path: str, version: tuple, start: int, end: int):
+    """
+    The rows of the persons [start, end), their squared norms and the person of every row, relative to start.
+    The rows are copied once, so that the shard of a worker stays in its memory between searches.
+    """
+    gallery = _load(path, version)
+    if _worker_state['bounds'] != (start, end):
+        if 'prototypes' in gallery:
+            owners = gallery['prototype_owners']
+            rows = (owners >= start) & (owners < end)
+            embeddings, owners = gallery['prototypes'][rows].float(), owners[rows] - start
+        else:
+            embeddings, owners = gallery['embeddings'][start:end].float().clone(), None
+        shard = (embeddings, squared_norms(embeddings), owners)
+        _worker_state.update(bounds=(start, end), shard=shard)
+    return _worker_state['shard']
+
+
+def search_shard(path: str, version: tuple, start: int, end: int, queries: np.ndarray, k: int):
+    """
+    Find the k nearest persons among the persons [start, end) of a gallery file. Runs in the worker processes.
+    :return: (distances, indices) like exact_search as arrays, with the indices of the whole gallery.
+    """
+    embeddings, norms, owners = _shard(path, version, start, end)
+    queries = torch.from_numpy(queries)
+    if owners is None:
+        distances, indices = exact_search(queries, embeddings, k, squared_norms=norms)
+    else:
+        distances, indices = class_search(queries, embeddings, owners, end - start, k, squared_norms=norms)
+    indices = torch.where(indices >= 0, indices + start, indices)
+    return distances.numpy(), indices.numpy()
+
+
+def warm_up(path: str, version: tuple):
+    _load(path, version)
+
+
+class ShardedSearch:
+    """
+    Search a gallery file split into shards, every shard by its own worker process.
+    The workers map the file like Memory.load, so the gallery is not copied between processes, and every worker
+    keeps only its shard in memory. The shards are contiguous ranges of persons, recomputed before every search so
+    that they stay even as persons are enrolled or removed.
+    The search is exact, any search index of the memory is not used.
+    """
+
+    def __init__(self, path: str, workers: int, threads: int = None):
+        """
+        :param path: The gallery file, which the memory searched must be saved in.
+        :param workers: The number of shards and of worker processes.
+        :param threads: The threads of torch in every worker. The cores divided by the workers by default.
+        """
+        if workers < 1:
+            raise Exception('There must be at least one search worker.')
+        self.path = path
+        self.version = file_version(path)
+        threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        # spawned rather than forked, as forking a process which already ran torch may hang its thread pool
+        context = multiprocessing.get_context('spawn')
+        # one single-process pool per shard, so that a shard is always searched by the same worker
+        self.executors = [ProcessPoolExecutor(1, context, _init_worker, (threads,)) for _ in range(workers)]
+        for executor in self.executors:
+            executor.submit(warm_up, self.path, self.version)
+
+    def update(self):
+        """
+        Search the file as it is now, after the memory saved it.
+        """
+        self.version = file_version(self.path)
+
+    def bounds(self, persons: int, owners: torch.Tensor = None):
+        """
+        Split the persons into contiguous shards with about as many rows each.
+        :param persons: The number of persons.
+        :param owners: The person of every prototype if the memory has prototypes.
+        :return: The (start, end) of every non-empty shard.
+        """
+        workers = len(self.executors)
+        if owners is None:
+            edges = [persons * i // workers for i in range(workers + 1)]
+        else:
+            rows = torch.cumsum(torch.bincount(owners.cpu(), minlength=persons), dim=0)
+            targets = torch.tensor([len(owners) * i / workers for i in range(1, workers)], dtype=rows.dtype)
+            edges = [0] + (torch.searchsorted(rows, targets) + 1).clamp(max=persons).tolist() + [persons]
+        return [(start, end) for start, end in zip(edges[:-1], edges[1:]) if end > start]
+
+    def search(self, embeddings: torch.Tensor, persons: int, k: int = 1, owners: torch.Tensor = None):
+        """
+        Find the k nearest persons of every embedding in every shard, and merge the results.
+        :param embeddings: A (n, 512) tensor of face embeddings.
+        :param persons: The number of persons of the memory.
+        :param k: How many persons to return for every embedding.
+        :param owners: The person of every prototype if the memory has prototypes.
+        :return: (distances, indices) on the device of embeddings, like Memory.search.
+        """
+        bounds = self.bounds(persons, owners)
+        if len(bounds) == 0:
+            return exact_search(embeddings, embeddings.new_zeros((0, embeddings.shape[1])), k)
+
+        queries = embeddings.detach().float().cpu().numpy()
+        futures = [executor.submit(search_shard, self.path, self.version, start, end, queries, k)
+                   for executor, (start, end) in zip(self.executors, bounds)]
+        results = [future.result() for future in futures]
+        distances = torch.from_numpy(np.concatenate([distances for distances, _ in results], axis=1))
+        indices = torch.from_numpy(np.concatenate([indices for _, indices in results], axis=1))
+        distances, order = torch.topk(distances, k, dim=1, largest=False)
+        return distances.to(embeddings.device), torch.gather(indices, 1, order).to(embeddings.device)
+
+    def close(self):
+        for executor in self.executors:
+            executor.shutdown(cancel_futures=True)
@@ -0,0 +1,264 @@
+import os
+import time
+import numpy as np
+import torch
+from facenet_pytorch import MTCNN, InceptionResnetV1
+from PIL import Image, ImageSequence
+
+from memory import Memory
+from process import list_images, load_image
+from profiler import stage, observe
+
+IMAGE_EXTENSIONS = ('jpg', 'jpeg', 'png', 'gif', 'webp', 'tif', 'tiff')
+
+
+def read_frames(source: str, rotation: bool = False):
+    """
+    Decode the frames of a stream one by one.
+    :param source: A camera index such as "0", a video file or a stream URL, which need opencv-python,
+                   or a directory of pictures or an animated picture, which stand in for a video.
+    :param rotation: Whether to handle the EXIF rotation of the pictures of a directory.
+    :return: A generator of PIL Images.
+    """
+    if os.path.isdir(source):
+        for path in list_images([source]):
+            yield load_image(path, rotation)
+        return
+
+    if os.path.isfile(source) and source.lower().endswith(IMAGE_EXTENSIONS):
+        with Image.open(source) as img:
+            for frame in ImageSequence.Iterator(img):
+                yield frame.convert('RGB')
+        return
+
+    try:
+        import cv2
+    except ImportError:
+        raise Exception('Reading videos and cameras needs opencv-python, run "pip install opencv-python".')
+
+    capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    if not capture.isOpened():
+        raise Exception(f'Cannot open {source}.')
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                return
+            yield Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    finally:
+        capture.release()
+
+
+def box_iou(boxes1: np.ndarray, boxes2: np.ndarray):
+    """
+    The intersection over union of every pair of (x1, y1, x2, y2) boxes, as a (len(boxes1), len(boxes2)) array.
+    """
+    top_left = np.maximum(boxes1[:, None, :2], boxes2[None, :, :2])
+    bottom_right = np.minimum(boxes1[:, None, 2:], boxes2[None, :, 2:])
+    intersection = np.clip(bottom_right - top_left, 0, None).prod(axis=2)
+    area1 = (boxes1[:, 2:] - boxes1[:, :2]).prod(axis=1)
+    area2 = (boxes2[:, 2:] - boxes2[:, :2]).prod(axis=1)
+    return intersection / (area1[:, None] + area2[None, :] - intersection + 1e-9)
+
+
+class Track:
+    """
+    A face followed across frames. box is where the face is in the last frame processed: the detected box on the
+    frames it was detected in, and where its velocity takes the last detected box on the others.
+    """
+
+    def __init__(self, track_id: int, box: np.ndarray, prob: float, frame_index: int):
+        self.id = track_id
+        self.box = box
+        self.detected_box = box
+        self.prob = prob
+        # the box moves by velocity every frame between two detections
+        self.velocity = np.zeros(4)
+        self.last_detected = frame_index
+        self.missed = 0
+        self.name = None
+        self.distance = None
+        self.embedded_prob = None
+
+    def predict(self, frame_index: int):
+        return self.detected_box + self.velocity * (frame_index - self.last_detected)
+
+    def move(self, frame_index: int):
+        self.box = self.predict(frame_index)
+
+    def detected(self, box: np.ndarray, prob: float, frame_index: int):
+        self.velocity = (box - self.detected_box) / max(frame_index - self.last_detected, 1)
+        self.box = box
+        self.detected_box = box
+        self.prob = prob
+        self.last_detected = frame_index
+        self.missed = 0
+
+
+class FaceTracker:
+    """
+    Match the faces detected in a frame with the faces of the previous detections by the overlap of their boxes.
+    """
+
+    def __init__(self, iou_threshold: float = 0.3, max_missed: int = 2):
+        """
+        :param iou_threshold: The least overlap between a predicted box and a detected box for them to be one face.
+        :param max_missed: How many detections in a row may miss a face before its track is dropped.
+        """
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.tracks = []
+        self.next_id = 0
+
+    def update(self, frame_index: int, boxes: np.ndarray, probs: np.ndarray):
+        """
+        :return: (matched, new, lost), the tracks found again, the tracks started and the tracks dropped.
+        """
+        matched_tracks = set()
+        matched_boxes = set()
+        if self.tracks and len(boxes):
+            predicted = np.stack([track.predict(frame_index) for track in self.tracks])
+            iou = box_iou(predicted, boxes)
+            # greedy matching, best overlaps first
+            for t, b in zip(*np.unravel_index(np.argsort(-iou, axis=None), iou.shape)):
+                if iou[t, b] < self.iou_threshold:
+                    break
+                if t in matched_tracks or b in matched_boxes:
+                    continue
+                self.tracks[t].detected(boxes[b], float(probs[b]), frame_index)
+                matched_tracks.add(t)
+                matched_boxes.add(b)
+
+        matched = [self.tracks[t] for t in sorted(matched_tracks)]
+        lost = []
+        kept = []
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track.missed += 1
+                if track.missed > self.max_missed:
+                    lost.append(track)
+                    continue
+                track.move(frame_index)
+            kept.append(track)
+
+        new = []
+        for b in range(len(boxes)):
+            if b not in matched_boxes:
+                new.append(Track(self.next_id, boxes[b], float(probs[b]), frame_index))
+                self.next_id += 1
+        self.tracks = kept + new
+        return matched, new, lost
+
+    def move(self, frame_index: int):
+        """
+        Move every track to where it is predicted to be, on a frame without detection.
+        """
+        for track in self.tracks:
+            track.move(frame_index)
+
+
+class StreamRecognizer:
+    """
+    Recognize the faces of a video without running the models on every frame.
+    Faces are detected every detect_every frames and followed between detections by a FaceTracker. A face is only
+    embedded and searched in the memory when its track is new or when its detection confidence dropped since it was
+    last embedded, so a person standing in front of the camera costs one resnet pass rather than one per frame.
+    """
+
+    def __init__(self, memory: Memory, device: torch.device, mtcnn: MTCNN, resnet: InceptionResnetV1,
+                 detect_every: int = 5, threshold: float = 0.85, iou_threshold: float = 0.3, max_missed: int = 2,
+                 confidence_drop: float = 0.05):
+        """
+        :param memory: The memory of the program.
+        :param device: The device to use.
+        :param mtcnn: The mtcnn model.
+        :param resnet: The resnet model.
+        :param detect_every: Detect faces on one frame out of detect_every. 1 detects on every frame.
+        :param threshold: The threshold for face recognition.
+        :param iou_threshold: See FaceTracker.
+        :param max_missed: See FaceTracker.
+        :param confidence_drop: How much the detection confidence of a face may drop before it is embedded again.
+        """
+        if not memory.is_initialized():
+            raise Exception('Memory is not initialized.')
+
+        if mtcnn.device != device:
+            raise Exception("The device is different than the mtcnn device.")
+
+        if detect_every < 1:
+            raise Exception('detect_every must be at least 1.')
+
+        self.memory = memory
+        self.device = device
+        self.mtcnn = mtcnn.eval()
+        self.resnet = resnet.eval().to(device)
+        self.detect_every = detect_every
+        self.threshold = threshold
+        self.confidence_drop = confidence_drop
+        self.tracker = FaceTracker(iou_threshold, max_missed)
+
+        self.frames = 0
+        self.detections = 0
+        self.embeddings = 0
+        self.elapsed = 0.0
+
+    def process(self, frame_index: int, frame: Image.Image):
+        """
+        Recognize one frame. Frames must be passed in order.
+        :return: (tracks, recognized, lost), the faces in the frame, the faces which were just embedded, whose name
+                 may have changed, and the faces which left.
+        """
+        start = time.perf_counter()
+        self.frames += 1
+        recognized = []
+        lost = []
+        if frame_index % self.detect_every == 0:
+            frame = frame.convert('RGB')
+            with stage('detect'):
+                boxes, probs = self.mtcnn.detect(frame)
+            if boxes is None:
+                boxes, probs = np.zeros((0, 4)), np.zeros(0)
+            self.detections += 1
+            observe('faces_per_image', len(boxes))
+            matched, new, lost = self.tracker.update(frame_index, boxes, probs)
+            recognized = new + [track for track in matched
+                                if track.prob < track.embedded_prob - self.confidence_drop]
+            if recognized:
+                self.recognize(frame, recognized)
+        else:
+            self.tracker.move(frame_index)
+
+        self.elapsed += time.perf_counter() - start
+        return self.tracker.tracks, recognized, lost
+
+    def recognize(self, frame: Image.Image, tracks: list):
+        self.mtcnn.keep_all = True
+        with stage('detect'):
+            faces = self.mtcnn.extract(frame, np.stack([track.box for track in tracks]), None).to(self.device)
+        with stage('embed'), torch.inference_mode():
+            embeddings = self.resnet(faces)
+        self.embeddings += len(tracks)
+
+        with stage('search'):
+            distances, indices = self.memory.search(embeddings, self.device)
+        min_distances, min_indices = distances[:, 0], indices[:, 0]
+        min_indices[min_distances > self.threshold] = -1
+        with stage('names'):
+            names = self.memory.get_names(min_indices)
+        for track, name, distance in zip(tracks, names, min_distances.tolist()):
+            track.name = name
+            track.distance = distance
+            track.embedded_prob = track.prob
+
+    def run(self, frames):
+        """
+        Recognize the frames of a stream.
+        :param frames: An iterable of PIL Images, such as read_frames.
+        :return: A generator of (frame_index, tracks, recognized, lost) for every frame, see process.
+        """
+        for frame_index, frame in enumerate(frames):
+            yield (frame_index, *self.process(frame_index, frame))
+
+    def stats(self):
+        return {'frames': self.frames, 'detections': self.detections, 'embeddings': self.embeddings,
+                'fps': self.frames / self.elapsed if self.elapsed > 0 else 0.0}